@@ -1,24 +1,36 @@
 # -*- encoding: utf-8 -*-
 import tarfile
-import tempfile
 import os
 import sys
+import subprocess
 import ConfigParser
 from datetime import datetime, timedelta
 from getpass import getpass
 import logging
 import json
 import re
-import mimetypes
 import calendar
+from operator import itemgetter
 from contextlib import closing # for Python2.6 compatibility
-import boto
-from beefish import decrypt, encrypt_file
 import aaargh
-import grandfatherson
 
-from bakthat.backends import GlacierBackend, S3Backend, RotationConfig
+from bakthat.backends import GlacierBackend, S3Backend, get_backend, clear_backend_cache
+from bakthat.cache import CachingWriter, get_cache
 from bakthat.conf import config, DEFAULT_DESTINATION, DEFAULT_LOCATION
+from bakthat.compression import BlockCompressor, GzipStreamReader, parse_level
+from bakthat.extract import ParallelExtractor
+from bakthat.delta import DEFAULT_MAX_CHAIN, SignatureWriter, apply_delta, block_size_for, delete_delta_state, \
+                          load_delta_state, read_header, save_delta_state, write_delta
+from bakthat.scan import ExcludeRules, Scanner, add_to_tar, archive_size, total_size
+from bakthat.scheduler import BACKUP, RESTORE, VERIFY, ThrottledReader, with_priority
+from bakthat.shard import plan_shards, run_workers, shard_keys, worker_cancel
+from bakthat.sparse import SparseTarFile
+from bakthat.stream import CancellableReader, CancellableWriter, ChainReader, DecryptReader, EncryptWriter, \
+                           copy_stream
+from bakthat.tasks import TaskPool, wait
+from bakthat.transfer import MEGABYTE, TeeWriter, VolumeWriter
+from bakthat.integrity import BlockHasher, VERIFY_MODES, delete_checksums, load_checksums, missing_volumes, \
+                             save_checksums, verify_backup
 
 __version__ = "0.3.10"
 
@@ -34,7 +46,55 @@ STORAGE_BACKEND = dict(s3=S3Backend, glacier=GlacierBackend)
 def _get_store_backend(conf, destination=DEFAULT_DESTINATION):
     if not destination:
         destination = config.get("aws", "default_destination")
-    return STORAGE_BACKEND[destination](conf)
+
+    section = "destination:{0}".format(destination)
+    if destination not in STORAGE_BACKEND and config.has_section(section):
+        # Named destination (another bucket/vault/region), its options override [aws] and conf.
+        dest_conf = dict(config.items("aws")) if config.has_section("aws") else {}
+        dest_conf.update(conf or {})
+        dest_conf.update(config.items(section))
+        destination = dest_conf.pop("type", DEFAULT_DESTINATION)
+        conf = dest_conf
+
+    if destination not in STORAGE_BACKEND:
+        raise Exception("Unknown destination {0}".format(destination))
+    return get_backend(STORAGE_BACKEND[destination], conf)
+
+
+def _get_destinations(destination, conf=None):
+    """Return the backends of one or several destinations.
+
+    :type destination: str or list
+    :param destination: A destination, a comma separated list of destinations (s3,glacier),
+        or a list of destinations and (destination, conf) tuples.
+
+    :rtype: list
+    :return: A list of (name, backend), names are unique.
+
+    """
+    if not destination:
+        destinations = [None]
+    elif isinstance(destination, basestring):
+        destinations = [dest.strip() for dest in destination.split(",") if dest.strip()]
+    else:
+        destinations = list(destination)
+
+    backends = []
+    names = set()
+    for dest in destinations:
+        dest_conf = conf
+        if isinstance(dest, (tuple, list)):
+            dest, dest_conf = dest
+        backend = _get_store_backend(dest_conf, dest)
+
+        name = dest or "default"
+        i = 2
+        while name in names:
+            name = "{0}#{1}".format(dest, i)
+            i += 1
+        names.add(name)
+        backends.append((name, backend))
+    return backends
 
 
 def _match_filename(filename, destination=DEFAULT_DESTINATION, conf=None):
@@ -43,33 +103,140 @@ def _match_filename(filename, destination=DEFAULT_DESTINATION, conf=None):
         raise Exception("Filename can't be blank")
     storage_backend = _get_store_backend(conf, destination)
 
-    keys = [name for name in storage_backend.ls() if name.startswith(filename)]
+    # Only the keys under the prefix are listed (server-side with S3).
+    keys = [name for name in storage_backend.ls(prefix=filename) if name.startswith(filename)]
     keys.sort(reverse=True)
     return keys
 
 
+VOLUME_KEY_FMT = "{0}.part{1:04d}"
+VOLUME_PREFETCH = 2
+
+REGEX_KEY = re.compile(r"(?P<backup_name>.+)\.(?P<date_component>\d{14})\.(?P<ext>tgz|gz|delta)(?P<is_enc>\.enc)?"
+                       r"(?:\.part(?P<volume>\d{4,})|\.shard(?P<shard>\d{4,})of(?P<num_shards>\d{4,}))?$")
+
+# old regex for backward compatibility (for files without dot before the date component).
+OLD_REGEX_KEY = re.compile(r"(?P<backup_name>.+)(?P<date_component>\d{14})\.(?P<ext>tgz|gz|delta)(?P<is_enc>\.enc)?"
+                           r"(?:\.part(?P<volume>\d{4,})|\.shard(?P<shard>\d{4,})of(?P<num_shards>\d{4,}))?$")
+
+
+def _parse_date(date_component):
+    """Parse a %Y%m%d%H%M%S date component (strptime is 10 times slower, it matters for big buckets)."""
+    n = int(date_component)
+    return datetime(n // 10000000000, n // 100000000 % 100, n // 1000000 % 100,
+                    n // 10000 % 100, n // 100 % 100, n % 100)
+
+
+def _parse_key(key):
+    """Parse a stored key, return a dict with filename, key, backup_date, is_enc, ext (tgz,
+    gz for streams backups or delta), volume (only for the volumes of a split backup)
+    and shard (index, number of shards) for the shards of a sharded backup,
+    None if it's not a backup.
+
+    Listings may hold millions of keys: the dict is kept to 5 entries
+    (a 6th one makes python allocate a dict 4 times bigger).
+
+    """
+    match = REGEX_KEY.match(key)
+
+    # Backward compatibility
+    if not match:
+        match = OLD_REGEX_KEY.match(key)
+
+    if match:
+        backup_name, date_component, ext, is_enc, volume, shard = match.group("backup_name", "date_component",
+                                                                              "ext", "is_enc", "volume", "shard")
+        backup = {"filename": intern(backup_name),
+                  "key": key,
+                  "backup_date": _parse_date(date_component),
+                  "is_enc": is_enc is not None,
+                  "ext": ext}
+        if volume:
+            backup["volume"] = int(volume)
+        elif shard:
+            backup["shard"] = (int(shard), int(match.group("num_shards")))
+        return backup
+
+
+def _merge_volumes(backups):
+    """Merge the volumes of split backups, a volume set becomes a single backup dict
+    whose key is the key without the .partNNNN suffix, with the list of volumes keys
+    (sorted by index) and num_volumes (highest index + 1, see integrity.missing_volumes).
+    Shards of sharded backups are merged the same way (shards keys and num_shards).
+
+    :type backups: list
+    :param backups: Parsed keys (see _parse_key).
+
+    :rtype: list
+    :return: Backup dicts, in the same order.
+
+    """
+    merged = []
+    volume_sets = {}
+    for backup in backups:
+        volume = backup.pop("volume", None)
+        shard = backup.pop("shard", None)
+        if volume is None and shard is None:
+            merged.append(backup)
+            continue
+
+        if volume is not None:
+            key, parts, index = backup["key"].rsplit(".part", 1)[0], "volumes", volume
+        else:
+            key, parts, index = backup["key"].rsplit(".shard", 1)[0], "shards", shard[0]
+        if key not in volume_sets:
+            volume_sets[key] = dict(backup, key=key)
+            volume_sets[key][parts] = []
+            if shard is not None:
+                volume_sets[key]["num_shards"] = shard[1]
+            merged.append(volume_sets[key])
+        volume_sets[key][parts].append((index, backup["key"]))
+
+    for backup in volume_sets.values():
+        parts = "volumes" if "volumes" in backup else "shards"
+        # Indexes have 4 digits or more, part10000 sorts before part2000 as a string.
+        backup[parts].sort()
+        if parts == "volumes":
+            backup["num_volumes"] = backup["volumes"][-1][0] + 1
+        backup[parts] = [keyname for index, keyname in backup[parts]]
+    return merged
+
+
+def _backup_keys(backup):
+    """Return all the stored keys of a backup (the volumes/shards for a split/sharded backup)."""
+    return backup.get("volumes") or backup.get("shards") or [backup["key"]]
+
+
 def match_filename(filename, destination=DEFAULT_DESTINATION, conf=None):
-    """Return a list of dict with backup_name, date_component, and is_enc."""
+    """Return a list of dict with filename, key, backup_date, is_enc, ext (and volumes and num_volumes
+    for split backups, shards and num_shards for sharded backups), most recent first."""
     _keys = _match_filename(filename, destination, conf)
-    regex_key = re.compile(r"(?P<backup_name>.+)\.(?P<date_component>\d{14})\.tgz(?P<is_enc>\.enc)?")
 
-    # old regex for backward compatibility (for files without dot before the date component).
-    old_regex_key = re.compile(r"(?P<backup_name>.+)(?P<date_component>\d{14})\.tgz(?P<is_enc>\.enc)?")
-    
     keys = []
     for key in _keys:
-        match = regex_key.match(key)
+        backup = _parse_key(key)
+        if backup:
+            keys.append(backup)
+    return _merge_volumes(keys)
 
-        # Backward compatibility
-        if not match:
-            match = old_regex_key.match(key)
-        
-        if match:
-            keys.append(dict(filename=match.group("backup_name"),
-                        key=key,
-                        backup_date=datetime.strptime(match.group("date_component"), "%Y%m%d%H%M%S"),
-                        is_enc=bool(match.group("is_enc"))))
-    return keys
+
+def _group_backups(keys):
+    """Group stored keys by backup set.
+
+    :type keys: list
+    :param keys: Stored keys (from a single backend listing).
+
+    :rtype: dict
+    :return: backup_name => list of backup dict (see match_filename), most recent first.
+
+    """
+    backup_sets = {}
+    for backup in _merge_volumes(filter(None, map(_parse_key, keys))):
+        backup_sets.setdefault(backup["filename"], []).append(backup)
+
+    for backups in backup_sets.values():
+        backups.sort(key=itemgetter("key"), reverse=True)
+    return backup_sets
 
 
 def _interval_string_to_seconds(interval_string):
@@ -104,21 +271,139 @@ def _interval_string_to_seconds(interval_string):
     return seconds
 
 
-def _timedelta_total_seconds(td):
-    """Python 2.6 backward compatibility function for timedelta.total_seconds.
+ROTATION_OPTIONS = ["days", "weeks", "months", "first_week_day"]
+
+
+def _get_rotation_policy(backup_name=None, **kwargs):
+    """Return the rotation policy for a backup set.
+
+    Explicit keyword arguments take precedence over the [rotation:<backup_name>]
+    config section, which takes precedence over the [rotation] section.
+
+    :type backup_name: str
+    :param backup_name: Backup set name.
+
+    :rtype: dict
+    :return: A dict with days, weeks, months and first_week_day (as int).
+
+    """
+    policy = {}
+    sections = ["rotation"]
+    if backup_name:
+        sections.append("rotation:{0}".format(backup_name))
+    for section in sections:
+        if config.has_section(section):
+            policy.update((k, v) for k, v in config.items(section) if k in ROTATION_OPTIONS)
+    policy.update((k, kwargs[k]) for k in ROTATION_OPTIONS if kwargs.get(k) is not None)
+
+    if any(policy.get(k) in (None, "") for k in ROTATION_OPTIONS):
+        raise Exception("You must run bakthat configure_backups_rotation or provide rotation configuration.")
+
+    return dict((k, int(v)) for k, v in policy.items())
+
+
+def _get_max_age(backup_name, interval=None):
+    """Return the max age in seconds for a backup set, max_age in [rotation:<backup_name>] overrides interval."""
+    section = "rotation:{0}".format(backup_name)
+    if config.has_section(section) and config.has_option(section, "max_age"):
+        interval = config.get(section, "max_age")
+    if not interval:
+        return None
+    return _interval_string_to_seconds(interval)
+
+
+def _older_than(backups, interval_seconds, now=None):
+    """Return the backups older than interval_seconds."""
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=interval_seconds)
+    return [backup for backup in backups if backup["backup_date"] < cutoff]
+
+
+def _rotation_to_delete(backups, policy, now=None):
+    """Return the backups to delete according to the grandfather-father-son policy."""
+    import grandfatherson
+
+    now = now or datetime.utcnow()
+    # The days/weeks/months filters only keep the oldest backup of a period (and every
+    # backup from the future), only the oldest backup of each day needs to go through them.
+    oldest = {}
+    future = set()
+    for backup in backups:
+        date = backup["backup_date"]
+        if date > now:
+            future.add(date)
+        else:
+            day = date.date()
+            if day not in oldest or date < oldest[day]:
+                oldest[day] = date
+
+    to_keep = grandfatherson.to_keep(future.union(oldest.values()),
+                                     days=policy["days"],
+                                     weeks=policy["weeks"],
+                                     months=policy["months"],
+                                     firstweekday=policy["first_week_day"],
+                                     now=now)
+    return [backup for backup in backups if backup["backup_date"] not in to_keep]
+
+
+def _keep_delta_chains(backups, to_delete, container=None):
+    """Return to_delete without the backups needed to restore a kept delta backup.
+
+    A delta needs every backup of its chain: the full backup it was made
+    against and the deltas in between. Chains are rebuilt from the dates (a
+    delta belongs to the chain of the last full backup before it), the exact
+    chain of the last version is also read from the local state (see
+    bakthat.delta) if container is given.
+
+    """
+    deleted = set(backup["key"] for backup in to_delete)
+    backup_sets = {}
+    for backup in backups:
+        backup_sets.setdefault(backup["filename"], []).append(backup)
+
+    needed = set()
+    for backup_name, backup_set in backup_sets.items():
+        if not any(backup["ext"] == "delta" for backup in backup_set):
+            continue
+        chain = []
+        for backup in sorted(backup_set, key=itemgetter("backup_date")):
+            if backup["ext"] == "delta":
+                chain.append(backup["key"])
+                if backup["key"] not in deleted:
+                    needed.update(chain)
+            else:
+                chain = [backup["key"]]
+        delta_state = load_delta_state(container, backup_name) if container is not None else None
+        if delta_state is not None and delta_state["chain"][-1] not in deleted:
+            needed.update(delta_state["chain"])
+
+    for key in sorted(needed & deleted):
+        log.info("Keeping {0}, needed to restore a delta backup".format(key))
+    return [backup for backup in to_delete if backup["key"] not in needed]
 
-    :type td: timedelta object
-    :param td: timedelta object
 
-    :rtype: float
-    :return: The total number of seconds for the given timedelta object.
+def _forget_checksums(storage_backend, backups):
+    """Remove the checksums of deleted backups from the catalog."""
+    delete_checksums(storage_backend.container, [key for backup in backups
+                                                 for key in [backup["key"]] + backup.get("shards", [])])
+
+
+def _delete_plan(storage_backend, plan, dry_run=False):
+    """Delete the keys of a {backup_name: [keys]} plan with a single bulk request per backend.
+
+    :rtype: dict
+    :return: The executed (or planned if dry_run) plan.
 
     """
-    if hasattr(timedelta, "total_seconds"):
-        return getattr(td, "total_seconds")()
+    for backup_name in sorted(plan):
+        for key in plan[backup_name]:
+            log.info("{0}{1}".format("Would delete " if dry_run else "Deleting ", key))
+
+    if not dry_run:
+        keys = [key for backup_name in plan for key in plan[backup_name]]
+        if keys:
+            storage_backend.delete_many(keys)
 
-    # Python 2.6 backward compatibility
-    return (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / float(10**6)
+    return plan
 
 
 @app.cmd(help="Delete backups older than the given interval string.")
@@ -149,15 +434,11 @@ def delete_older_than(filename, interval, destination=DEFAULT_DESTINATION, **kwa
     storage_backend = _get_store_backend(conf, destination)
     interval_seconds = _interval_string_to_seconds(interval)
 
-    deleted = []
-
-    for key in match_filename(filename, destination, conf):
-        backup_age =  _timedelta_total_seconds(datetime.utcnow() - key.get("backup_date"))
-        if backup_age > interval_seconds:
-            real_key = key.get("key")
-            log.info("Deleting {0}".format(real_key))
-            storage_backend.delete(real_key)
-            deleted.append(real_key)
+    backups = match_filename(filename, destination, conf)
+    to_delete = _keep_delta_chains(backups, _older_than(backups, interval_seconds), storage_backend.container)
+    deleted = [key for backup in to_delete for key in _backup_keys(backup)]
+    _delete_plan(storage_backend, {filename: deleted})
+    _forget_checksums(storage_backend, to_delete)
 
     return deleted
 
@@ -194,42 +475,141 @@ def rotate_backups(filename, destination=DEFAULT_DESTINATION, **kwargs):
     """
     conf = kwargs.get("conf", None)
     storage_backend = _get_store_backend(conf, destination)
-    rotate = RotationConfig(kwargs)
-    if not rotate:
-        raise Exception("You must run bakthat configure_backups_rotation or provide rotation configuration.")
-
-    deleted = []
+    policy = _get_rotation_policy(filename.strip("/").split("/")[-1], **kwargs)
 
     backups = match_filename(filename, destination, conf)
-    backups_date = [backup["backup_date"] for backup in backups]
 
-    to_delete = grandfatherson.to_delete(backups_date, days=int(rotate.conf["days"]),
-                                                    weeks=int(rotate.conf["weeks"]),
-                                                    months=int(rotate.conf["months"]),
-                                                    firstweekday=int(rotate.conf["first_week_day"]),
-                                                    now=datetime.utcnow())
-    
-    for key in backups:
-        if key.get("backup_date") in to_delete:
-            real_key = key.get("key")
-            log.info("Deleting {0}".format(real_key))
-            storage_backend.delete(real_key)
-            deleted.append(real_key)
+    to_delete = _keep_delta_chains(backups, _rotation_to_delete(backups, policy), storage_backend.container)
+    deleted = [key for backup in to_delete for key in _backup_keys(backup)]
+    _delete_plan(storage_backend, {filename: deleted})
+    _forget_checksums(storage_backend, to_delete)
 
     return deleted
 
+
+@app.cmd(help="Rotate every backup set in a single pass (Grandfather-father-son), per-set policies from [rotation:<name>].")
+@app.cmd_arg('-d', '--destination', type=str, help="s3|glacier")
+@app.cmd_arg('--dry-run', action="store_true", default=False, help="Only show what would be deleted")
+def rotate_all(destination=None, dry_run=False, **kwargs):
+    """Rotate all backup sets, the backend is listed only once.
+
+    :type destination: str
+    :param destination: s3|glacier
+
+    :type dry_run: bool
+    :param dry_run: Only log/return the keys that would be deleted.
+
+    :type conf: dict
+    :keyword conf: Override/set AWS configuration.
+
+    :type days: int
+    :keyword days: Number of days to keep (override config for all sets).
+
+    :type weeks: int
+    :keyword weeks: Number of weeks to keep (override config for all sets).
+
+    :type months: int
+    :keyword months: Number of months to keep (override config for all sets).
+
+    :type first_week_day: str
+    :keyword first_week_day: First week day (override config for all sets).
+
+    :rtype: dict
+    :return: A dict backup_name => list of deleted keys.
+
+    """
+    conf = kwargs.get("conf", None)
+    storage_backend = _get_store_backend(conf, destination)
+
+    plan = {}
+    deleted_backups = []
+    for backup_name, backups in _group_backups(storage_backend.ls()).items():
+        policy = _get_rotation_policy(backup_name, **kwargs)
+        to_delete = _keep_delta_chains(backups, _rotation_to_delete(backups, policy), storage_backend.container)
+        if to_delete:
+            plan[backup_name] = [key for backup in to_delete for key in _backup_keys(backup)]
+            deleted_backups.extend(to_delete)
+
+    _delete_plan(storage_backend, plan, dry_run)
+    if not dry_run:
+        _forget_checksums(storage_backend, deleted_backups)
+    return plan
+
+
+@app.cmd(help="Delete backups older than the given interval for every backup set in a single pass.")
+@app.cmd_arg('-i', '--interval', type=str, default=None, help="Interval string like 1M, 1W, 1M3W4h2s")
+@app.cmd_arg('-d', '--destination', type=str, help="s3|glacier")
+@app.cmd_arg('--dry-run', action="store_true", default=False, help="Only show what would be deleted")
+def prune_all(interval=None, destination=None, dry_run=False, **kwargs):
+    """Delete backups older than interval for all backup sets, the backend is listed only once.
+
+    max_age in a [rotation:<backup_name>] config section overrides interval for this set,
+    sets without interval nor max_age are left untouched.
+
+    :type interval: str
+    :param interval: Interval string like 1M, 1W, 1M3W4h2s...
+
+    :type destination: str
+    :param destination: s3|glacier
+
+    :type dry_run: bool
+    :param dry_run: Only log/return the keys that would be deleted.
+
+    :type conf: dict
+    :keyword conf: Override/set AWS configuration.
+
+    :rtype: dict
+    :return: A dict backup_name => list of deleted keys.
+
+    """
+    conf = kwargs.get("conf", None)
+    storage_backend = _get_store_backend(conf, destination)
+    now = datetime.utcnow()
+
+    plan = {}
+    deleted_backups = []
+    for backup_name, backups in _group_backups(storage_backend.ls()).items():
+        interval_seconds = _get_max_age(backup_name, interval)
+        if interval_seconds is None:
+            continue
+        to_delete = _keep_delta_chains(backups, _older_than(backups, interval_seconds, now),
+                                       storage_backend.container)
+        if to_delete:
+            plan[backup_name] = [key for backup in to_delete for key in _backup_keys(backup)]
+            deleted_backups.extend(to_delete)
+
+    _delete_plan(storage_backend, plan, dry_run)
+    if not dry_run:
+        _forget_checksums(storage_backend, deleted_backups)
+    return plan
+
 @app.cmd(help="Backup a file or a directory, backup the current directory if no arg is provided.")
 @app.cmd_arg('-f', '--filename', type=str, default=os.getcwd())
-@app.cmd_arg('-d', '--destination', type=str, help="s3|glacier")
+@app.cmd_arg('-d', '--destination', type=str, help="s3|glacier|<name>, comma separated to backup to several destinations")
 @app.cmd_arg('-p', '--prompt', type=str, help="yes|no", default="yes")
-def backup(filename, destination=None, prompt="yes", **kwargs):
+@app.cmd_arg('-x', '--exclude', action="append", default=None, help="gitignore-style pattern (can be repeated)")
+@app.cmd_arg('--exclude-from', type=str, default=None, help="File containing exclude patterns")
+@app.cmd_arg('--one-file-system', action="store_true", default=False, help="Don't cross filesystem boundaries")
+@app.cmd_arg('--volume-size', type=int, default=None, help="Split the archive in volumes of N MB")
+@app.cmd_arg('--shards', type=int, default=None, help="Split a directory in N archives built and uploaded in parallel")
+@app.cmd_arg('--workers', type=int, default=None, help="Shards built at once (default: number of CPUs)")
+@app.cmd_arg('--stdin', action="store_true", default=False, help="Backup the data read from stdin (needs --name)")
+@app.cmd_arg('--exec', dest="command", type=str, default=None, help="Backup the output of a shell command (needs --name)")
+@app.cmd_arg('--name', type=str, default=None, help="Backup set name for --stdin/--exec")
+@app.cmd_arg('--compression-level', type=str, default=None, help="auto (follow the CPU/upload bottleneck)|0-9")
+@app.cmd_arg('--delta', action="store_true", default=False, help="Only upload the changes since the previous backup of a file")
+@app.cmd_arg('--max-chain', type=int, default=None, help="Deltas before a new full backup (default {0})".format(DEFAULT_MAX_CHAIN))
+@with_priority(BACKUP)
+def backup(filename=None, destination=None, prompt="yes", **kwargs):
     """Perform backup.
 
     :type filename: str
-    :param filename: File/directory to backup.
+    :param filename: File/directory to backup, the current directory by default.
             
-    :type destination: str
-    :param destination: s3|glacier
+    :type destination: str or list
+    :param destination: s3|glacier|<name> (a [destination:<name>] config section),
+        a comma separated list or a list of destinations and (destination, conf) tuples
+        to upload the same archive to several destinations concurrently.
 
     :type prompt: str
     :param prompt: Disable password promp, disable encryption,
@@ -241,19 +621,84 @@ def backup(filename, destination=None, prompt="yes", **kwargs):
     :type conf: dict
     :keyword conf: Override/set AWS configuration.
 
+    :type exclude: list
+    :keyword exclude: gitignore-style exclude patterns (! to re-include).
+
+    :type exclude_from: str
+    :keyword exclude_from: Path of a file containing exclude patterns.
+
+    :type one_file_system: bool
+    :keyword one_file_system: Don't cross filesystem boundaries.
+
+    :type volume_size: int
+    :keyword volume_size: Split the archive in volumes of N MB (stored as <stored_filename>.partNNNN),
+        volumes are uploaded concurrently as they are produced.
+
+    :type shards: int
+    :keyword shards: Split a directory in N archives balanced by size (plus one for the
+        directories), each one built, compressed and uploaded by its own worker process
+        (stored as <stored_filename>.shardNNNNofNNNN).
+
+    :type workers: int
+    :keyword workers: Maximum number of shards built at once (the number of CPUs by default),
+        the other shards are queued.
+
+    :type cancel: threading.Event
+    :keyword cancel: Once set, the backup is stopped and the uploads aborted (see bakthat.tasks).
+
+    :type fileobj: file
+    :keyword fileobj: Backup the data read from this stream instead of filename.
+
+    :type stdin: bool
+    :keyword stdin: Backup the data read from stdin.
+
+    :type command: str
+    :keyword command: Backup the output of this shell command, the backup fails
+        if the command exit code is not 0.
+
+    :type name: str
+    :keyword name: Backup set name, required for streams, they are stored
+        gzipped (not tarred) as <name>.<date>.gz[.enc].
+
+    :type compression_level: str
+    :keyword compression_level: auto to tune the level of each block from the measured
+        compression and upload times, or a level (0-9), incompressible blocks are always stored.
+
+    :type delta: bool
+    :keyword delta: Only upload a binary delta against the previous backup of the file
+        (stored as <filename>.<date>.delta[.enc]), the first backup is a full one.
+
+    :type max_chain: int
+    :keyword max_chain: Number of deltas after which a new full backup is made.
+
     :rtype: dict
-    :return: A dict containing the following keys: stored_filename, size, metadata and filename.
+    :return: A dict containing the following keys: stored_filename, size, metadata and filename
+        (and volumes/shards for a split/sharded backup). With several destinations, destinations holds
+        name => dict(size=...) or dict(error=...), the backup only fails if all destinations failed.
 
     """
+    import mimetypes
+
     conf = kwargs.get("conf", None)
-    storage_backend = _get_store_backend(conf, destination)
+    destinations = _get_destinations(destination, conf)
     backup_file_fmt = "{0}.{1}.tgz"
-
-    log.info("Backing up " + filename)
-    arcname = filename.strip('/').split('/')[-1]
+    stream_file_fmt = "{0}.{1}.gz"
+    delta_file_fmt = "{0}.{1}.delta"
+
+    # Stream mode: the data comes from a stream or a command, it's never written to disk.
+    stream_mode = kwargs.get("fileobj") is not None or kwargs.get("stdin") or kwargs.get("command")
+    if stream_mode:
+        if not kwargs.get("name"):
+            raise Exception("A backup set name is required to backup a stream (--name).")
+        arcname = kwargs["name"]
+        log.info("Backing up {0} as {1}".format(kwargs.get("command") or "stream", arcname))
+    else:
+        filename = filename or os.getcwd()
+        log.info("Backing up " + filename)
+        arcname = filename.strip('/').split('/')[-1]
     now = datetime.utcnow()
     date_component = now.strftime("%Y%m%d%H%M%S")
-    stored_filename = backup_file_fmt.format(arcname, date_component)
+    stored_filename = (stream_file_fmt if stream_mode else backup_file_fmt).format(arcname, date_component)
     
     backup_data = dict(filename=arcname, backup_date=int(now.strftime("%s")))
 
@@ -266,60 +711,322 @@ def backup(filename, destination=None, prompt="yes", **kwargs):
                 log.error("Password confirmation doesn't match")
                 return
 
+    # Delta mode: the previous version signature is kept in the local state,
+    # a full backup is made if it's missing, too old or if a backup of its chain was deleted.
+    delta = kwargs.get("delta")
+    delta_base = None
+    if delta:
+        if stream_mode or not os.path.isfile(filename):
+            raise Exception("Delta backups are only supported for a regular file.")
+        if len(destinations) > 1 or kwargs.get("volume_size"):
+            raise Exception("Delta backups can't be split in volumes or uploaded to several destinations.")
+        delta_backend = destinations[0][1]
+        delta_stat = os.stat(filename)
+        delta_state = load_delta_state(delta_backend.container, arcname)
+        max_chain = kwargs.get("max_chain")
+        if max_chain is None:
+            max_chain = DEFAULT_MAX_CHAIN
+        if delta_state is None:
+            log.info("No previous version, full backup")
+        elif len(delta_state["chain"]) > max_chain:
+            log.info("{0} deltas since the last full backup, full backup".format(len(delta_state["chain"]) - 1))
+        elif any(delta_backend.size(key) is None for key in delta_state["chain"]):
+            log.warning("A backup of the delta chain is missing, full backup")
+        else:
+            delta_base = delta_state
+            stored_filename = delta_file_fmt.format(arcname, date_component)
 
-    # Check if the file is not already compressed
-    if mimetypes.guess_type(arcname) == ('application/x-tar', 'gzip'):
-        log.info("File already compressed")
-        outname = filename
+    num_shards = kwargs.get("shards")
+    if num_shards:
+        if stream_mode or delta or not os.path.isdir(filename):
+            raise Exception("Sharded backups are only supported for a directory.")
+        if len(destinations) > 1 or kwargs.get("volume_size"):
+            raise Exception("Sharded backups can't be split in volumes or uploaded to several destinations.")
 
+    # Check if the file is not already compressed
+    already_compressed = not stream_mode and not delta and not num_shards and mimetypes.guess_type(arcname) == ('application/x-tar', 'gzip')
+    if already_compressed:
         new_arcname = re.sub(r'(\.t(ar\.)?gz)', '', arcname)
         stored_filename = backup_file_fmt.format(new_arcname, date_component)
-        
-        with open(outname) as outfile:
-            backup_data["size"] = os.fstat(outfile.fileno()).st_size
 
-        bakthat_compression = False
-    else:
-        # If not we compress it
-        log.info("Compressing...")
-        with tempfile.NamedTemporaryFile(delete=False) as out:
-            with closing(tarfile.open(fileobj=out, mode="w:gz")) as tar:
-                tar.add(filename, arcname=arcname)
-            outname = out.name
-            out.seek(0)
-            backup_data["size"] = os.fstat(out.fileno()).st_size
-        bakthat_compression = True
-
-    bakthat_encryption = False
-    if password:
-        bakthat_encryption = True
-        log.info("Encrypting...")
-        encrypted_out = tempfile.NamedTemporaryFile(delete=False)
-        encrypt_file(outname, encrypted_out.name, password)
+    bakthat_encryption = bool(password)
+    if bakthat_encryption:
         stored_filename += ".enc"
 
-        # We only remove the file if the archive is created by bakthat
-        if bakthat_compression:
-            os.remove(outname)  # remove non-encrypted tmp file
+    level = parse_level(kwargs.get("compression_level"))
+    process = None
+    # Signature of the uploaded version (delta mode), computed while the file is read.
+    new_signature = SignatureWriter(block_size_for(delta_stat.st_size)) if delta else None
+    if stream_mode:
+        size_hint = None
+        source = kwargs.get("fileobj")
+        if kwargs.get("command"):
+            process = subprocess.Popen(kwargs["command"], shell=True, stdout=subprocess.PIPE)
+            source = process.stdout
+        elif source is None:
+            source = sys.stdin
+    elif already_compressed or delta_base is not None:
+        size_hint = os.path.getsize(filename)
+    else:
+        # The tree is scanned first (in parallel), excluded paths are never read.
+        patterns = list(kwargs.get("exclude") or [])
+        if kwargs.get("exclude_from"):
+            with open(kwargs["exclude_from"]) as f:
+                patterns.extend(f.read().splitlines())
+        scanner = Scanner(ExcludeRules(patterns), one_file_system=kwargs.get("one_file_system", False))
+        entries = scanner.scan(filename, arcname)
+        size_hint = archive_size(entries)
+        log.info("{0} entries to backup ({1} bytes)".format(len(entries), total_size(entries)))
+
+    if num_shards:
+        backup_data["stored_filename"] = stored_filename
+        backup_data.update(_backup_shards(destination, conf, entries, num_shards, stored_filename,
+                                          password, kwargs.get("compression_level"), kwargs.get("cancel"),
+                                          kwargs.get("workers")))
+        log.debug(backup_data)
+        return backup_data
+
+    # The archive is compressed, encrypted and uploaded on the fly,
+    # nothing is written to disk.
+    volume_size = kwargs.get("volume_size")
+    if volume_size:
+        volume_size *= MEGABYTE
+    volume_key = lambda index: VOLUME_KEY_FMT.format(stored_filename, index)
+
+    def open_sink(storage_backend):
+        if volume_size:
+            return VolumeWriter(lambda index: storage_backend.writer(volume_key(index),
+                                                                     size_hint=min(volume_size, size_hint) or None),
+                                volume_size,
+                                delete_volume=lambda index: storage_backend.delete(volume_key(index)))
+        return storage_backend.writer(stored_filename, size_hint=size_hint)
+
+    if len(destinations) == 1:
+        sink = open_sink(destinations[0][1])
+    else:
+        # Single compression/encryption pass, the stream is teed to every destination.
+        log.info("Destinations: {0}".format(", ".join(name for name, backend in destinations)))
+        sink = TeeWriter([(name, open_sink(backend)) for name, backend in destinations])
+    # Recent backups are kept in the local cache for fast restores (from the first destination).
+    cache = get_cache()
+    if cache is not None and not volume_size:
+        entry = cache.entry(destinations[0][1].container, stored_filename, size_hint)
+        if entry is not None:
+            sink = CachingWriter(sink, entry)
+    # Block checksums of the stored stream, used by verify.
+    out = hasher = BlockHasher(sink)
+    if kwargs.get("cancel") is not None:
+        out = CancellableWriter(hasher, kwargs["cancel"])
+    try:
+        if bakthat_encryption:
+            log.info("Encrypting...")
+            out = EncryptWriter(out, password)
+
+        if already_compressed:
+            log.info("File already compressed")
+            with open(filename, "rb") as infile:
+                copy_stream(ThrottledReader(infile), out)
+        elif stream_mode:
+            log.info("Compressing...")
+            out = compressor = BlockCompressor(out, level=level)
+            copy_stream(source, out)
+            if process is not None and process.wait() != 0:
+                raise Exception("{0} failed with exit code {1}".format(kwargs["command"], process.returncode))
+        elif delta_base is not None:
+            log.info("Computing the delta against {0}...".format(delta_base["chain"][-1]))
+            out = compressor = BlockCompressor(out, level=level)
+            with open(filename, "rb") as infile:
+                delta_stats = write_delta(infile, delta_base["signature"], delta_base["chain"], out,
+                                          new_signature)
+        else:
+            # If not we compress it, each block is sniffed to skip incompressible data
+            log.info("Compressing...")
+            out = compressor = BlockCompressor(out, level=level)
+            with closing(tarfile.open(fileobj=out, mode="w|")) as tar:
+                add_to_tar(tar, entries, tee=new_signature)
+
+        log.info("Uploading...")
+        out.close()
+    except:
+        if process is not None and process.poll() is None:
+            process.kill()
+        sink.abort()
+        raise
+
+    backup_data["size"] = sink.size
+    backup_data["metadata"] = dict(is_enc=bakthat_encryption)
+    if not already_compressed:
+        backup_data["metadata"]["compression_levels"] = compressor.stats
+        backup_data["metadata"]["compression_time"] = round(compressor.compress_time, 3)
+        if getattr(level, "changes", None):
+            backup_data["metadata"]["compression_level_changes"] = level.changes
+        log.info("Compression levels (level: blocks): {0}, {1:.1f}s compressing".format(compressor.stats,
+                                                                                     compressor.compress_time))
+    backup_data["stored_filename"] = stored_filename
+    if volume_size:
+        num_volumes = max(1, (sink.size + volume_size - 1) // volume_size)
+        backup_data["volumes"] = [volume_key(index) for index in range(num_volumes)]
+        log.info("{0} volumes".format(num_volumes))
+    if len(destinations) > 1:
+        backup_data["destinations"] = sink.results
+        for name, result in sorted(sink.results.items()):
+            log.info("{0}: {1}".format(name, result.get("error") or "OK"))
+
+    if delta:
+        chain = (delta_base["chain"] if delta_base is not None else []) + [stored_filename]
+        backup_data["delta"] = dict(chain=chain[:-1])
+        if delta_base is not None:
+            backup_data["delta"].update(delta_stats)
+        signature = new_signature.close()
+        st = os.stat(filename)
+        if (st.st_size, st.st_mtime) != (delta_stat.st_size, delta_stat.st_mtime):
+            # The signature may not match the stored version, don't chain on it.
+            log.warning("{0} changed during the backup, the next backup will be a full one".format(filename))
+            delete_delta_state(delta_backend.container, arcname)
+        else:
+            save_delta_state(delta_backend.container, arcname, chain, signature)
+
+    checksums = hasher.checksums
+    if volume_size:
+        checksums["volume_size"] = volume_size
+        checksums["num_volumes"] = num_volumes
+    for name, storage_backend in destinations:
+        if len(destinations) == 1 or "error" not in sink.results[name]:
+            try:
+                save_checksums(storage_backend.container, stored_filename, checksums)
+            except Exception, exc:
+                log.warning("Can't record checksums: {0}".format(exc))
 
-        outname = encrypted_out.name
+    log.debug(backup_data)
+    return backup_data
 
-        encrypted_out.seek(0)
-        backup_data["size"] = os.fstat(encrypted_out.fileno()).st_size
 
+@with_priority(BACKUP)
+def _backup_shard(task):
+    """Archive, compress, encrypt and upload a shard (in a worker process, see bakthat.shard)."""
+    destination, conf, entries, keyname, password, compression_level = task
+    # Connections of the parent process can't be shared.
+    clear_backend_cache()
+    storage_backend = _get_destinations(destination, conf)[0][1]
+    level = parse_level(compression_level)
+    sink = storage_backend.writer(keyname, size_hint=archive_size(entries))
+    out = hasher = BlockHasher(sink)
+    try:
+        out = CancellableWriter(hasher, worker_cancel())
+        if password:
+            out = EncryptWriter(out, password)
+        out = compressor = BlockCompressor(out, level=level)
+        with closing(tarfile.open(fileobj=out, mode="w|")) as tar:
+            add_to_tar(tar, entries)
+        out.close()
+    except Exception, exc:
+        sink.abort()
+        # Exceptions are pickled to the parent process, some of them can't be.
+        raise Exception("{0}: {1}".format(keyname, exc))
+    return dict(size=sink.size, checksums=hasher.checksums, compression_levels=compressor.stats,
+                compression_time=compressor.compress_time, compression_level_changes=getattr(level, "changes", None))
+
+
+def _backup_shards(destination, conf, entries, num_shards, stored_filename, password=None,
+                   compression_level=None, cancel=None, workers=None):
+    """Backup scanned entries as shards, return the size, metadata and shards of the backup."""
+    shards = plan_shards(entries, num_shards)
+    keys = shard_keys(stored_filename, len(shards))
+    log.info("{0} shards, built and uploaded in parallel...".format(len(shards)))
+    tasks = [(destination, conf, shard_entries, keyname, password, compression_level)
+             for shard_entries, keyname in zip(shards, keys)]
+    results = run_workers(_backup_shard, tasks, cancel, workers)
+
+    storage_backend = _get_destinations(destination, conf)[0][1]
+    failed = [result for result in results if not result.successful()]
+    if failed:
+        uploaded = [keyname for keyname, result in zip(keys, results) if result.successful()]
+        if uploaded:
+            log.info("Deleting the uploaded shards")
+            storage_backend.delete_many(uploaded)
+        # Raises the worker exception.
+        failed[0].get()
+
+    results = [result.get() for result in results]
+    levels = {}
+    for result in results:
+        for level, blocks in result["compression_levels"].items():
+            levels[level] = levels.get(level, 0) + blocks
+    metadata = dict(is_enc=bool(password), compression_levels=levels,
+                    compression_time=round(sum(result["compression_time"] for result in results), 3))
+    level_changes = dict((keyname, result["compression_level_changes"])
+                         for keyname, result in zip(keys, results) if result["compression_level_changes"])
+    if level_changes:
+        metadata["compression_level_changes"] = level_changes
+    log.info("Compression levels (level: blocks): {0}, {1:.1f}s compressing".format(levels,
+                                                                                 metadata["compression_time"]))
+
+    for keyname, result in zip(keys, results):
+        try:
+            save_checksums(storage_backend.container, keyname, result["checksums"])
+        except Exception, exc:
+            log.warning("Can't record checksums: {0}".format(exc))
+    return dict(size=sum(result["size"] for result in results), metadata=metadata, shards=keys)
+
+
+@app.cmd(help="Watch directories and backup them when they change (paths from [watch] config if no -f).")
+@app.cmd_arg('-f', '--filename', action="append", default=None, help="Directory to watch (can be repeated)")
+@app.cmd_arg('-d', '--destination', type=str, help="s3|glacier|<name>, comma separated for several destinations")
+@app.cmd_arg('-p', '--prompt', type=str, help="yes|no", default="yes")
+@app.cmd_arg('--delay', type=int, default=None, help="Backup once a directory has been quiet for N seconds")
+@app.cmd_arg('--max-delay', type=int, default=None, help="Backup at most N seconds after the first change")
+@app.cmd_arg('-x', '--exclude', action="append", default=None, help="gitignore-style pattern (can be repeated)")
+@app.cmd_arg('--volume-size', type=int, default=None, help="Split the archives in volumes of N MB")
+def watch(filename=None, destination=None, prompt="yes", delay=None, max_delay=None, **kwargs):
+    """Watch directories and backup them (each directory is a backup set) when they change.
 
-    backup_data["metadata"] = dict(is_enc=bakthat_encryption)
-    backup_data["stored_filename"] = stored_filename
+    Without filename, paths, delay and max_delay are read from the [watch] config section
+    (paths is a comma/newline separated list).
 
-    log.info("Uploading...")
-    storage_backend.upload(stored_filename, outname)
+    :type filename: list
+    :param filename: Directories to watch.
 
-    # We only remove the file if the archive is created by bakthat
-    if bakthat_encryption:
-        os.remove(outname)
+    :type destination: str
+    :param destination: s3|glacier|<name> (see backup).
 
-    log.debug(backup_data)
-    return backup_data
+    :type delay: int
+    :param delay: Backup a directory once it has been quiet for N seconds.
+
+    :type max_delay: int
+    :param max_delay: Backup a directory at most N seconds after its first change.
+
+    :type stop: threading.Event
+    :keyword stop: Stop watching once set (the command runs until interrupted otherwise).
+
+    """
+    from bakthat.watch import Watcher, DEFAULT_DELAY, DEFAULT_MAX_DELAY, DEFAULT_POLL_INTERVAL
+
+    def watch_option(name, default):
+        if config.has_section("watch") and config.has_option("watch", name):
+            return config.get("watch", name)
+        return default
+
+    paths = filename or [path.strip() for path in re.split(r"[,\n]", watch_option("paths", ""))
+                         if path.strip()]
+    if not paths:
+        log.error("No directory to watch, use -f or set paths in the [watch] config section.")
+        return
+
+    password = kwargs.pop("password", None)
+    if password is None and prompt.lower() != "no":
+        password = getpass("Password (blank to disable encryption): ")
+        if password and password != getpass("Password confirmation: "):
+            log.error("Password confirmation doesn't match")
+            return
+
+    backup_kwargs = dict(kwargs, password=password or "", prompt="no")
+    backup_kwargs.pop("stop", None)
+    watcher = Watcher(paths, lambda path: backup(path, destination, **backup_kwargs),
+                      excludes=ExcludeRules(kwargs.get("exclude") or []),
+                      delay=int(delay or watch_option("delay", DEFAULT_DELAY)),
+                      max_delay=int(max_delay or watch_option("max_delay", DEFAULT_MAX_DELAY)),
+                      poll_interval=int(watch_option("poll_interval", DEFAULT_POLL_INTERVAL)))
+    watcher.run(kwargs.get("stop"))
 
 
 @app.cmd(help="Give informations about stored filename, current directory if no arg is provided.")
@@ -338,6 +1045,8 @@ def info(filename, destination=None, description=None, **kwargs):
         key = keys[0]
         log.info("Last backup date: {0} ({1} versions)".format(key["backup_date"].isoformat(),
                                                     str(len(keys))))
+        if key.get("shards"):
+            log.info("{0} shards".format(len(key["shards"])))
     return key
 
 
@@ -368,6 +1077,7 @@ def configure():
         region_name = DEFAULT_LOCATION
     config.set("aws", "region_name", region_name)
     config.write(open(os.path.expanduser("~/.bakthat.conf"), "w"))
+    clear_backend_cache()
 
     log.info("Config written in %s" % os.path.expanduser("~/.bakthat.conf"))
     log.info("Run bakthat configure_backups_rotation if needed.")
@@ -395,14 +1105,188 @@ def configure_backups_rotation():
     config.write(open(os.path.expanduser("~/.bakthat.conf"), "w"))
     log.info("Config written in %s" % os.path.expanduser("~/.bakthat.conf"))
 
+def _download(storage_backend, key_name, download_kwargs=None):
+    """Download a stored key, read it from the local cache if it's there and
+    matches its recorded checksums, cache the download otherwise."""
+    cache = get_cache()
+    if cache is None:
+        return storage_backend.download(key_name, **(download_kwargs or {}))
+
+    checksums = load_checksums(storage_backend.container, key_name)
+    cached = cache.open(storage_backend.container, key_name, checksums)
+    if cached is not None:
+        log.info("Reading {0} from the local cache".format(key_name))
+        return cached
+
+    out = storage_backend.download(key_name, **(download_kwargs or {}))
+    if hasattr(out, "read") and checksums:
+        out = cache.reader(out, storage_backend.container, key_name, checksums["size"])
+    return out
+
+
+def _backup_reader(out, key_name, password=None, cancel=None):
+    """Wrap a downloaded backup stream: cancellation, decryption and decompression."""
+    if cancel is not None:
+        out = CancellableReader(out, cancel)
+    if key_name.endswith(".enc"):
+        out = DecryptReader(out, password)
+    return GzipStreamReader(out)
+
+
+def _restore_delta(storage_backend, backup, out, password=None, download_kwargs=None, cancel=None, target=None):
+    """Restore a delta backup in the target directory: the full backup of its chain
+    is extracted, then every delta of the chain is applied in order.
+
+    :type out: file
+    :param out: The delta backup (decrypted and uncompressed).
+
+    :rtype: bool
+    :return: True if successful, False if a backup of the chain isn't available yet.
+
+    """
+    import shutil
+    import tempfile
+
+    target = target or os.getcwd()
+    # The delta is spooled, its header lists the backups needed to rebuild the file
+    # and every one of them is requested first (Glacier jobs are initiated for all of them).
+    spool = tempfile.TemporaryFile()
+    try:
+        copy_stream(out, spool)
+        spool.seek(0)
+        header = read_header(spool)
+        chain = header[2]
+        streams = [_download(storage_backend, key, download_kwargs) for key in chain]
+        try:
+            pending = [key for key, stream in zip(chain, streams) if not hasattr(stream, "read")]
+            if pending:
+                log.info("{0}/{1} backups of the delta chain not available yet".format(len(pending), len(chain)))
+                return False
+
+            workdir = tempfile.mkdtemp(prefix=".bakthat-", dir=target)
+            try:
+                log.info("Restoring the full backup " + chain[0])
+                reader = _backup_reader(streams[0], chain[0], password, cancel)
+                try:
+                    with closing(SparseTarFile.open(fileobj=reader, mode="r|")) as tar:
+                        tar.extractall(workdir)
+                finally:
+                    reader.close()
+
+                path = os.path.join(workdir, backup["filename"])
+                mode = os.stat(path).st_mode
+                deltas = [(key, _backup_reader(stream, key, password, cancel))
+                          for key, stream in zip(chain[1:], streams[1:])]
+                deltas.append((backup["key"], spool))
+                for index, (key, reader) in enumerate(deltas):
+                    log.info("Applying " + key)
+                    block_size, size, _ = header if reader is spool else read_header(reader)
+                    new_path = "{0}.{1}".format(path, index)
+                    with open(path, "rb") as base:
+                        with open(new_path, "wb") as f:
+                            apply_delta(base, reader, f, block_size, size)
+                    os.remove(path)
+                    path = new_path
+                os.chmod(path, mode)
+                os.rename(path, os.path.join(target, backup["filename"]))
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+        finally:
+            for stream in streams:
+                if hasattr(stream, "close"):
+                    stream.close()
+    finally:
+        spool.close()
+    return True
+
+
+@with_priority(RESTORE)
+def _restore_shard(task):
+    """Download and extract a shard in the target directory (in a worker process, see bakthat.shard)."""
+    destination, conf, keyname, backup_key, password, download_kwargs, target = task
+    # Connections of the parent process can't be shared.
+    clear_backend_cache()
+    storage_backend = _get_store_backend(conf, destination)
+    try:
+        out = _download(storage_backend, keyname, download_kwargs)
+        if not hasattr(out, "read"):
+            raise Exception("not available")
+        # Shards are encrypted if the backup key ends with .enc
+        reader = _backup_reader(out, backup_key, password, worker_cancel())
+        try:
+            with closing(SparseTarFile.open(fileobj=reader, mode="r|")) as tar:
+                ParallelExtractor(tar, target).extractall()
+        finally:
+            reader.close()
+    except Exception, exc:
+        # Exceptions are pickled to the parent process, some of them can't be.
+        raise Exception("{0}: {1}".format(keyname, exc))
+    return True
+
+
+def _restore_shards(storage_backend, backup, password=None, download_kwargs=None, destination=None, conf=None,
+                    cancel=None, target=None):
+    """Restore a sharded backup in the target directory: the directories (first shard) are
+    created, the other shards are extracted in parallel by worker processes, then the
+    directories attributes are set (like tarfile.extractall).
+
+    :rtype: bool
+    :return: True if successful, False if a shard isn't available yet.
+
+    """
+    target = target or os.getcwd()
+    shards = backup["shards"]
+    if len(shards) != backup["num_shards"]:
+        raise Exception("{0}/{1} shards of {2} are missing".format(backup["num_shards"] - len(shards),
+                                                                    backup["num_shards"], backup["key"]))
+
+    # Every shard is requested first (Glacier jobs are initiated for all of them),
+    # the workers download them again.
+    streams = [_download(storage_backend, shards[0], download_kwargs)]
+    streams.extend(storage_backend.download(keyname, **(download_kwargs or {})) for keyname in shards[1:])
+    try:
+        pending = [keyname for keyname, stream in zip(shards, streams) if not hasattr(stream, "read")]
+        if pending:
+            log.info("{0}/{1} shards not available yet".format(len(pending), len(shards)))
+            return False
+
+        reader = _backup_reader(streams[0], backup["key"], password, cancel)
+        try:
+            with closing(SparseTarFile.open(fileobj=reader, mode="r|")) as tar:
+                # Directories stay writable until the other shards are extracted.
+                extractor = ParallelExtractor(tar, target)
+                extractor.extract_members()
+        finally:
+            reader.close()
+    finally:
+        for stream in streams[1:]:
+            if hasattr(stream, "close"):
+                stream.close()
+
+    if len(shards) > 1:
+        log.info("Extracting {0} shards in parallel...".format(len(shards) - 1))
+        tasks = [(destination, conf, keyname, backup["key"], password, download_kwargs, target)
+                 for keyname in shards[1:]]
+        for result in run_workers(_restore_shard, tasks, cancel):
+            # Raises the worker exception.
+            result.get()
+
+    extractor.fix_metadata()
+    return True
+
+
 @app.cmd(help="Restore backup in the current directory.")
 @app.cmd_arg('-f', '--filename', type=str, default="")
 @app.cmd_arg('-d', '--destination', type=str, help="s3|glacier")
+@app.cmd_arg('-t', '--target', type=str, default=None, help="Directory to restore into, the current directory by default")
+@app.cmd_arg('--slice-size', type=int, default=None, help="Glacier only, retrieve in ranged jobs of N MB")
+@app.cmd_arg('--stdout', action="store_true", default=False, help="Write a stream backup (--stdin/--exec) to stdout")
+@with_priority(RESTORE)
 def restore(filename, destination=None, **kwargs):
-    """Restore backup in the current working directory.
+    """Restore backup in the current working directory (or in the target directory).
 
     :type filename: str
-    :param filename: File/directory to backup.
+    :param filename: File/directory to backup, the current directory by default.
             
     :type destination: str
     :param destination: s3|glacier
@@ -410,6 +1294,21 @@ def restore(filename, destination=None, **kwargs):
     :type conf: dict
     :keyword conf: Override/set AWS configuration.
 
+    :type slice_size: int
+    :keyword slice_size: Glacier only, retrieve the archive with ranged jobs of N MB.
+
+    :type prompt: str
+    :keyword prompt: no to fail instead of prompting for a missing password.
+
+    :type stdout: bool
+    :keyword stdout: Write a stream backup to stdout instead of a <name> file.
+
+    :type target: str
+    :keyword target: Directory to restore into (created if needed), the current directory by default.
+
+    :type cancel: threading.Event
+    :keyword cancel: Once set, the download/extraction is stopped (see bakthat.tasks).
+
     :rtype: bool
     :return: True if successful.
 
@@ -421,46 +1320,88 @@ def restore(filename, destination=None, **kwargs):
         log.error("No file to restore, use -f to specify one.")
         return
 
-    keys = _match_filename(filename, destination if destination else DEFAULT_DESTINATION)
+    keys = match_filename(filename, destination if destination else DEFAULT_DESTINATION, conf)
     if not keys:
         log.error("No file matched.")
         return
 
-    key_name = sorted(keys, reverse=True)[0]
+    key_name = keys[0]["key"]
     log.info("Restoring " + key_name)
 
     # Asking password before actually download to avoid waiting
+    password = None
     if key_name and key_name.endswith(".enc"):
         password = kwargs.get("password")
         if not password:
+            if kwargs.get("prompt", "yes").lower() == "no":
+                raise Exception("A password is required to restore {0}".format(key_name))
             password = getpass()
 
+    target = kwargs.get("target") or os.getcwd()
+    if not os.path.isdir(target):
+        os.makedirs(target)
+
     log.info("Downloading...")
     
     download_kwargs = {}
     if kwargs.get("job_check"):
         download_kwargs["job_check"] = True
         log.info("Job Check: " + repr(download_kwargs))
-
-    out = storage_backend.download(key_name, **download_kwargs)
+    if kwargs.get("slice_size"):
+        download_kwargs["slice_size"] = kwargs["slice_size"] * MEGABYTE
+
+    if keys[0].get("shards"):
+        if kwargs.get("job_check"):
+            return [storage_backend.download(keyname, **download_kwargs) for keyname in keys[0]["shards"]]
+        return _restore_shards(storage_backend, keys[0], password, download_kwargs, destination, conf,
+                               kwargs.get("cancel"), target)
+    elif keys[0].get("volumes"):
+        missing = missing_volumes(keys[0], load_checksums(storage_backend.container, key_name))
+        if missing:
+            raise Exception(missing)
+        # Every volume is requested first (Glacier jobs are initiated for all of them),
+        # then volumes are downloaded in parallel and read in order.
+        volumes = [storage_backend.download(volume, **download_kwargs) for volume in keys[0]["volumes"]]
+        pending = [volume for volume in volumes if not hasattr(volume, "read")]
+        if pending:
+            log.info("{0}/{1} volumes not available yet".format(len(pending), len(volumes)))
+            out = pending[0]
+        else:
+            out = ChainReader(volumes, prefetch=VOLUME_PREFETCH)
+    else:
+        out = _download(storage_backend, key_name, download_kwargs)
 
     if kwargs.get("job_check"):
         log.info("Job Check Request")
         # If it's a job_check call, we return Glacier job data
         return out
 
-    if out and key_name.endswith(".enc"):
-        log.info("Decrypting...")
-        decrypted_out = tempfile.TemporaryFile()
-        decrypt(out, decrypted_out, password)
-        out = decrypted_out
-
     if out:
+        if key_name.endswith(".enc"):
+            log.info("Decrypting...")
         log.info("Uncompressing...")
-        out.seek(0)
-        tar = tarfile.open(fileobj=out)
-        tar.extractall()
-        tar.close()
+        # Streaming mode, the archive is extracted while it's downloaded.
+        out = _backup_reader(out, key_name, password, kwargs.get("cancel"))
+        try:
+            if keys[0]["ext"] == "delta":
+                return _restore_delta(storage_backend, keys[0], out, password, download_kwargs,
+                                      kwargs.get("cancel"), target)
+            elif keys[0]["ext"] == "tgz":
+                with closing(SparseTarFile.open(fileobj=out, mode="r|")) as tar:
+                    ParallelExtractor(tar, target).extractall()
+                # The gzip trailer is only checked at the end of the stream.
+                while out.read(MEGABYTE):
+                    pass
+            elif kwargs.get("stdout"):
+                copy_stream(out, sys.stdout)
+                sys.stdout.flush()
+            else:
+                log.info("Writing " + keys[0]["filename"])
+                with open(os.path.join(target, keys[0]["filename"]), "wb") as f:
+                    copy_stream(out, f)
+        finally:
+            # Stop the download threads, even on error/cancellation.
+            out.close()
 
         return True
 
@@ -472,7 +1413,7 @@ def delete(filename, destination=None, **kwargs):
     """Delete a backup.
 
     :type filename: str
-    :param filename: File/directory to backup.
+    :param filename: File/directory to backup, the current directory by default.
 
     :type destination: str
     :param destination: glacier|s3
@@ -494,21 +1435,99 @@ def delete(filename, destination=None, **kwargs):
         log.error("No file to delete, use -f to specify one.")
         return
 
-    keys = _match_filename(filename, destination, conf)
+    keys = match_filename(filename, destination, conf)
     if not keys:
         log.error("No file matched.")
         return
 
-    # Get first matching keys => the most recent
-    key_name = keys[0]
+    # Get first matching keys => the most recent, all the volumes of a split backup are deleted
+    key_names = _backup_keys(keys[0])
 
-    log.info("Deleting " + key_name)
+    log.info("Deleting " + keys[0]["key"])
 
-    storage_backend.delete(key_name)
+    if len(key_names) > 1:
+        storage_backend.delete_many(key_names)
+    else:
+        storage_backend.delete(key_names[0])
+    _forget_checksums(storage_backend, keys[:1])
 
     return True
 
 
+@app.cmd(help="Verify stored backups without restoring them (all the backup sets if no filename is given).")
+@app.cmd_arg('-f', '--filename', type=str, default="")
+@app.cmd_arg('-d', '--destination', type=str, help="s3|glacier|<name>")
+@app.cmd_arg('-m', '--mode', type=str, default="quick", help="quick (sizes)|spot (random blocks)|full (every block)")
+@app.cmd_arg('--latest', action="store_true", default=False, help="Only verify the latest backup of each set")
+@app.cmd_arg('-w', '--workers', type=int, default=4, help="Number of backups verified concurrently")
+@with_priority(VERIFY)
+def verify(filename="", destination=None, mode="quick", latest=False, workers=4, **kwargs):
+    """Verify the integrity of stored backups against the checksums recorded at backup time.
+
+    :type filename: str
+    :param filename: Backup set (all sets if empty).
+
+    :type destination: str
+    :param destination: s3|glacier|<name>
+
+    :type mode: str
+    :param mode: quick (stored keys and sizes), spot (random blocks checked with ranged requests)
+        or full (every block is downloaded and checked, nothing is written to disk).
+
+    :type latest: bool
+    :param latest: Only verify the latest backup of each set.
+
+    :type workers: int
+    :param workers: Number of backups verified concurrently.
+
+    :type password: str
+    :keyword password: Used in full mode to decode backups without recorded checksums.
+
+    :type conf: dict
+    :keyword conf: Override/set AWS configuration.
+
+    :rtype: dict
+    :return: A dict with backups (list of dict with key, status and detail)
+        and summary (status => count).
+
+    """
+    conf = kwargs.get("conf", None)
+    if mode not in VERIFY_MODES:
+        raise Exception("Invalid mode {0}, should be one of {1}".format(mode, ", ".join(VERIFY_MODES)))
+    storage_backend = _get_store_backend(conf, destination)
+
+    if filename:
+        backup_sets = _group_backups([key for backup in match_filename(filename, destination, conf)
+                                      for key in _backup_keys(backup)])
+    else:
+        backup_sets = _group_backups(storage_backend.ls())
+
+    backups = []
+    for backup_name in sorted(backup_sets):
+        backups.extend(backup_sets[backup_name][:1] if latest else backup_sets[backup_name])
+
+    pool = TaskPool(workers)
+    try:
+        # Worker threads don't inherit the priority of the command.
+        verify_task = with_priority(VERIFY)(verify_backup)
+        tasks = [pool.submit(verify_task, storage_backend, backup, mode, kwargs.get("password"))
+                 for backup in backups]
+        report = [task.result() for task in wait(tasks)]
+    finally:
+        pool.shutdown(cancel=True)
+
+    summary = {}
+    for result in report:
+        summary[result["status"]] = summary.get(result["status"], 0) + 1
+        if result["status"] == "ok":
+            log.info("{key}: {status} ({detail})".format(**result))
+        else:
+            log.error("{key}: {status} ({detail})".format(**result))
+    log.info("{0} backup(s) verified: {1}".format(len(report), ", ".join("{0} {1}".format(count, status)
+                                                                          for status, count in sorted(summary.items()))))
+    return dict(backups=report, summary=summary)
+
+
 @app.cmd(help="List stored backups.")
 @app.cmd_arg('-d', '--destination', type=str, help="s3|glacier")
 def ls(destination=None, **kwargs):
@@ -519,16 +1538,127 @@ def ls(destination=None, **kwargs):
 
     ls_result = storage_backend.ls()
 
+    shard_sets = set()
     for filename in ls_result:
-        log.info(filename)
+        # The shards of a sharded backup are shown as a single backup.
+        backup = _parse_key(filename) if ".shard" in filename else None
+        if backup and "shard" in backup:
+            key = filename.rsplit(".shard", 1)[0]
+            if key not in shard_sets:
+                shard_sets.add(key)
+                log.info("{0} ({1} shards)".format(key, backup["shard"][1]))
+            continue
+        # Keys moved to Glacier by a S3 lifecycle rule must be restored before being downloaded.
+        storage_class = getattr(storage_backend, "storage_class", lambda keyname: None)(filename)
+        if storage_class == "GLACIER":
+            log.info("{0} ({1})".format(filename, storage_class))
+        else:
+            log.info(filename)
 
     return ls_result
 
+
+@app.cmd(help="Copy backups to another S3 bucket/prefix with server-side copy (nothing is downloaded).")
+@app.cmd_arg('-f', '--filename', type=str, default="")
+@app.cmd_arg('-t', '--to', type=str, help="Target destination (a [destination:<name>] section)")
+@app.cmd_arg('-d', '--destination', type=str, help="Source destination")
+@app.cmd_arg('--all', dest="all_versions", action="store_true", default=False, help="Copy every version, not only the latest")
+@app.cmd_arg('--move', action="store_true", default=False, help="Delete the source keys once copied")
+@app.cmd_arg('--storage-class', type=str, default="STANDARD", help="STANDARD|STANDARD_IA|REDUCED_REDUNDANCY")
+def replicate(filename, to, destination=None, all_versions=False, move=False, storage_class="STANDARD", **kwargs):
+    """Copy (or move) backups between S3 buckets/prefixes using server-side copy.
+
+    :type filename: str
+    :param filename: File/directory name.
+
+    :type to: str
+    :param to: Target destination, must be a S3 destination.
+
+    :type destination: str
+    :param destination: Source destination, must be a S3 destination.
+
+    :type all_versions: bool
+    :param all_versions: Copy every version, not only the latest.
+
+    :type move: bool
+    :param move: Delete the source keys once copied (promote).
+
+    :type storage_class: str
+    :param storage_class: Storage class of the copies.
+
+    :type conf: dict
+    :keyword conf: Override/set AWS configuration.
+
+    :rtype: list
+    :return: The copied keys.
+
+    """
+    conf = kwargs.get("conf", None)
+    source = _get_store_backend(conf, destination)
+    target = _get_store_backend(conf, to)
+    if not isinstance(source, S3Backend) or not isinstance(target, S3Backend):
+        raise Exception("Server-side copy is only available between S3 destinations.")
+
+    if not filename:
+        log.error("No file to copy, use -f to specify one.")
+        return
+
+    backups = match_filename(filename, destination, conf)
+    if not all_versions:
+        backups = backups[:1]
+
+    copied = []
+    for backup in backups:
+        for key in _backup_keys(backup):
+            log.info("Copying {0} to {1}".format(key, target.container))
+            source.copy(key, target, storage_class=storage_class)
+            copied.append(key)
+
+    if move and copied:
+        log.info("Deleting {0} source keys".format(len(copied)))
+        source.delete_many(copied)
+
+    return copied
+
+
+@app.cmd(help="Configure the S3 lifecycle rule moving backups to Glacier (and deleting them) after N days.")
+@app.cmd_arg('-d', '--destination', type=str, help="s3|<name>")
+@app.cmd_arg('--glacier-days', type=int, default=None, help="Transition to the GLACIER storage class after N days")
+@app.cmd_arg('--expire-days', type=int, default=None, help="Delete after N days")
+def configure_lifecycle(destination=None, glacier_days=None, expire_days=None, **kwargs):
+    """Configure the bakthat lifecycle rule of a S3 destination (without days, the rule is removed).
+
+    Transitioned keys are still listed and restored by bakthat (the restore is initiated
+    by the first restore call, like Glacier jobs). The destination needs a s3_prefix,
+    the rule only applies to the keys under it.
+
+    :type destination: str
+    :param destination: S3 destination.
+
+    :type glacier_days: int
+    :param glacier_days: Transition to the GLACIER storage class after N days.
+
+    :type expire_days: int
+    :param expire_days: Delete after N days.
+
+    :type conf: dict
+    :keyword conf: Override/set AWS configuration.
+
+    """
+    conf = kwargs.get("conf", None)
+    storage_backend = _get_store_backend(conf, destination or "s3")
+    if not isinstance(storage_backend, S3Backend):
+        raise Exception("Lifecycle rules are only available for S3 destinations.")
+
+    lifecycle = storage_backend.configure_lifecycle(glacier_days, expire_days)
+    log.info("Lifecycle configuration: {0} rule(s)".format(len(lifecycle)))
+    return lifecycle
+
 @app.cmd(help="Show Glacier inventory from S3")
 def show_glacier_inventory(**kwargs):
     if config.get("aws", "s3_bucket"):
         conf = kwargs.get("conf", None)
-        glacier_backend = GlacierBackend(conf)
+        glacier_backend = get_backend(GlacierBackend, conf)
         loaded_archives = glacier_backend.load_archives_from_s3()
         log.info(json.dumps(loaded_archives, sort_keys=True, indent=4, separators=(',', ': ')))
     else:
@@ -536,15 +1666,44 @@ def show_glacier_inventory(**kwargs):
     return loaded_archives
 
 
-@app.cmd(help="Show local Glacier inventory (from shelve file)")
+@app.cmd(help="Show local Glacier inventory (from the local state)")
 def show_local_glacier_inventory(**kwargs):
     conf = kwargs.get("conf", None)
-    glacier_backend = GlacierBackend(conf)
+    glacier_backend = get_backend(GlacierBackend, conf)
     archives = glacier_backend.load_archives()
     log.info(json.dumps(archives, sort_keys=True, indent=4, separators=(',', ': ')))
     return archives
 
 
+@app.cmd(help="Reconcile the local Glacier inventory with the vault inventory (initiate the job the first time)")
+@app.cmd_arg('-j', '--job_id', type=str, default=None, help="Inventory job id")
+@app.cmd_arg('--dry-run', action="store_true", default=False, help="Only report the differences")
+def reconcile_glacier_inventory(job_id=None, dry_run=False, **kwargs):
+    """Reconcile the local Glacier inventory with the official vault inventory.
+
+    :type job_id: str
+    :param job_id: Inventory job id (default to the last job initiated by bakthat).
+
+    :type dry_run: bool
+    :param dry_run: Only report the differences, don't update the local inventory.
+
+    :type conf: dict
+    :keyword conf: Override/set AWS configuration.
+
+    :rtype: dict
+    :return: A dict with total, missing_locally (count) and missing_in_vault (list),
+        None if the inventory job is not completed yet.
+
+    """
+    conf = kwargs.get("conf", None)
+    glacier_backend = get_backend(GlacierBackend, conf)
+    report = glacier_backend.reconcile_inventory(job_id, dry_run=dry_run)
+    if report:
+        log.info("{total} archives in vault, {missing_locally} missing in local inventory, "
+                 "{0} missing in vault".format(len(report["missing_in_vault"]), **report))
+    return report
+
+
 @app.cmd(help="Backup Glacier inventory to S3")
 def backup_glacier_inventory(**kwargs):
     """Backup Glacier inventory to S3.
@@ -554,7 +1713,7 @@ def backup_glacier_inventory(**kwargs):
 
     """
     conf = kwargs.get("conf", None)
-    glacier_backend = GlacierBackend(conf)
+    glacier_backend = get_backend(GlacierBackend, conf)
     glacier_backend.backup_inventory()
 
 
@@ -567,7 +1726,7 @@ def restore_glacier_inventory(**kwargs):
 
     """
     conf = kwargs.get("conf", None)
-    glacier_backend = GlacierBackend(conf)
+    glacier_backend = get_backend(GlacierBackend, conf)
     glacier_backend.restore_inventory()
 
 
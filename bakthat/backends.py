@@ -1,36 +1,86 @@
 # -*- encoding: utf-8 -*-
-import tempfile
 import os
 import logging
-import shelve
 import json
 import re
-import socket
-import httplib
 import ConfigParser
-import boto
-from boto.s3.key import Key
-from boto.glacier.exceptions import UnexpectedHTTPResponseError
-from boto.exception import S3ResponseError
+import threading
+import Queue
 
 from bakthat.conf import config, DEFAULT_DESTINATION, DEFAULT_LOCATION
+from bakthat.inventory import iter_inventory, reconcile
+from bakthat.state import ARCHIVES, JOBS, META, SIZES, get_state
+from bakthat.stream import ChainReader, copy_stream
+from bakthat.transfer import ChunkedDownloader, GlacierUploadWriter, S3MultipartWriter, TransferController, \
+                             DEFAULT_CHUNK_SIZE, DEFAULT_MEMORY_LIMIT, DEFAULT_NUM_THREADS, MAX_NUM_THREADS, \
+                             MEGABYTE, with_retries
 
 log = logging.getLogger(__name__)
 
-class glacier_shelve(object):
-    """Context manager for shelve."""
+_connections = {}
+_connections_lock = threading.Lock()
 
-    def __enter__(self):
-        self.shelve = shelve.open(os.path.expanduser("~/.bakthat.db"))
 
-        return self.shelve
+def get_connection(service, access_key, secret_key, region_name=None):
+    """Return a boto connection shared by every backend using the same credentials.
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.shelve.close()
+    boto connections keep their own thread-safe pool of HTTP(S) connections,
+    so sharing them avoids a new handshake for each backend/command call.
 
+    :type service: str
+    :param service: s3|glacier
 
-class BakthatBackend:
+    :rtype: boto.s3.connection.S3Connection or boto.glacier.layer2.Layer2
+
+    """
+    key = (service, access_key, secret_key, region_name)
+    with _connections_lock:
+        if key not in _connections:
+            import boto
+            if service == "s3":
+                _connections[key] = boto.connect_s3(access_key, secret_key)
+            else:
+                _connections[key] = boto.connect_glacier(aws_access_key_id=access_key,
+                                                         aws_secret_access_key=secret_key,
+                                                         region_name=region_name)
+        return _connections[key]
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(backend_class, conf=None):
+    """Return a cached backend instance for the given class and configuration.
+
+    :type backend_class: class
+    :param backend_class: S3Backend|GlacierBackend
+
+    :type conf: dict
+    :param conf: Override/set AWS configuration (None to use the config file).
+
+    """
+    conf_key = tuple(sorted(conf.items())) if conf else None
+    key = (backend_class, conf_key)
+    with _backends_lock:
+        if key not in _backends:
+            _backends[key] = backend_class(conf)
+        return _backends[key]
+
+
+def clear_backend_cache():
+    """Forget cached backends and connections (e.g. after a configuration change)."""
+    with _backends_lock:
+        _backends.clear()
+    with _connections_lock:
+        _connections.clear()
+
+
+class BakthatBackend(object):
     """Handle Configuration for Backends."""
+    download_threads = DEFAULT_NUM_THREADS
+    max_download_chunk_size = 64 * MEGABYTE
+
     def __init__(self, conf=None, extra_conf=[], section="aws"):
         self.custom_conf = None
         self.conf = {}
@@ -65,6 +115,31 @@ class BakthatBackend:
             for key in extra_conf:
                 self.conf[key] = conf.get(key)
 
+    def _optional_conf(self, conf, key, section="aws"):
+        """Return an optional configuration value (None if it's not set)."""
+        if conf:
+            return conf.get(key)
+        if config.has_section(section) and config.has_option(section, key):
+            return config.get(section, key)
+
+    def _transfer_controllers(self, conf, upload_part_size, max_upload_part_size=None):
+        """Create the controllers shared by the uploads/downloads of the backend.
+
+        The max number of parts in flight (max_threads) and of bytes in flight
+        (memory_limit, in MB) can be set in the configuration.
+
+        """
+        max_threads = int(self._optional_conf(conf, "max_threads") or MAX_NUM_THREADS)
+        memory_limit = self._optional_conf(conf, "memory_limit")
+        memory_limit = int(memory_limit) * MEGABYTE if memory_limit else DEFAULT_MEMORY_LIMIT
+
+        self.upload_controller = TransferController(DEFAULT_NUM_THREADS, upload_part_size,
+                                                    max_part_size=max_upload_part_size,
+                                                    max_concurrency=max_threads, memory_limit=memory_limit)
+        self.download_controller = TransferController(self.download_threads, DEFAULT_CHUNK_SIZE,
+                                                      MEGABYTE, self.max_download_chunk_size,
+                                                      max_concurrency=max_threads, memory_limit=memory_limit)
+
 
 class RotationConfig(BakthatBackend):
     """Hold backups rotation configuration."""
@@ -74,35 +149,115 @@ class RotationConfig(BakthatBackend):
                                 section="rotation")
 
 class S3Backend(BakthatBackend):
-    """Backend to handle S3 upload/download."""
+    """Backend to handle S3 upload/download.
+
+    Keys are stored under the optional s3_prefix, bakthat only sees the keys under it.
+
+    """
+    copy_threads = DEFAULT_NUM_THREADS
+    # Objects bigger than that are copied with a multipart copy (5GB is the single copy limit).
+    max_single_copy_size = 5 * 1024 * MEGABYTE
+    copy_part_size = 512 * MEGABYTE
+    # Lifetime of the temporary copy of an object restored from the GLACIER storage class.
+    restore_days = 7
+
     def __init__(self, conf=None):
         BakthatBackend.__init__(self, conf, extra_conf=["s3_bucket"])
 
-        con = boto.connect_s3(self.conf["access_key"], self.conf["secret_key"])
+        if conf:
+            self.prefix = conf.get("s3_prefix") or ""
+        elif config.has_section("aws") and config.has_option("aws", "s3_prefix"):
+            self.prefix = config.get("aws", "s3_prefix")
+        else:
+            self.prefix = ""
+
+        self._bucket = None
+        self._lock = threading.Lock()
+        self._storage_classes = {}
+        self._transfer_controllers(conf, S3MultipartWriter.MIN_PART_SIZE, S3MultipartWriter.MAX_PART_SIZE)
+        self.container = "S3 Bucket: {0}".format(self.conf["s3_bucket"])
+        if self.prefix:
+            self.container += "/" + self.prefix
+
+    @property
+    def connection(self):
+        return get_connection("s3", self.conf["access_key"], self.conf["secret_key"])
+
+    @property
+    def bucket(self):
+        """The bucket is only checked (and created if needed) on first use."""
+        if self._bucket is None:
+            with self._lock:
+                if self._bucket is None:
+                    self._bucket = self._get_or_create_bucket()
+        return self._bucket
+
+    def _get_or_create_bucket(self):
+        from boto.exception import S3ResponseError
+
+        con = self.connection
 
         region_name = self.conf["region_name"]
         if region_name == DEFAULT_LOCATION:
             region_name = ""
 
         try:
-            self.bucket = con.get_bucket(self.conf["s3_bucket"])
+            return con.get_bucket(self.conf["s3_bucket"])
         except S3ResponseError, e:
             if e.code == "NoSuchBucket":
-                self.bucket = con.create_bucket(self.conf["s3_bucket"], location=region_name)
+                return con.create_bucket(self.conf["s3_bucket"], location=region_name)
             else:
                 raise e
 
-        self.container = "S3 Bucket: {0}".format(self.conf["s3_bucket"])
+    def _key_name(self, keyname):
+        return self.prefix + keyname
 
-    def download(self, keyname):
-        k = Key(self.bucket)
-        k.key = keyname
+    def download(self, keyname, job_check=False, **kwargs):
+        """Return a file-like object streaming the key, downloaded with concurrent ranged GETs.
+
+        Keys transitioned to the GLACIER storage class (see configure_lifecycle) are
+        restored first: the first call initiates the restore, the key can be downloaded
+        once it's completed (3-5 hours).
 
-        encrypted_out = tempfile.TemporaryFile()
-        k.get_contents_to_file(encrypted_out)
-        encrypted_out.seek(0)
-        
-        return encrypted_out
+        :type keyname: str
+        :param keyname: Stored filename.
+
+        :type job_check: bool
+        :param job_check: Return the restore status (a dict) instead of None if the restore is pending.
+
+        :rtype: file
+        :return: The stream, or None if the key doesn't exist or isn't restored yet.
+
+        """
+        k = self.bucket.get_key(self._key_name(keyname))
+        if k is None:
+            return
+
+        # ongoing_restore is None if no restore was requested, False once it's completed.
+        if k.storage_class == "GLACIER" and k.ongoing_restore is not False:
+            if k.ongoing_restore is None:
+                log.info("Restoring {0} from the GLACIER storage class".format(keyname))
+                k.restore(self.restore_days)
+            log.info("Not completed yet")
+            if job_check:
+                return dict(key=keyname, storage_class=k.storage_class, ongoing_restore=True)
+            return
+
+        fetch = lambda start, end: self.read_range(keyname, start, end)
+        return ChunkedDownloader(fetch, k.size, controller=self.download_controller)
+
+    def size(self, keyname):
+        """Size of a key (None if it doesn't exist)."""
+        k = self.bucket.get_key(self._key_name(keyname))
+        return k.size if k is not None else None
+
+    def read_range(self, keyname, start, end):
+        """Return the bytes start-end (inclusive) of a key with a ranged GET."""
+        from boto.s3.key import Key
+
+        # A new Key per request, boto keys hold the HTTP response.
+        k = Key(self.bucket, self._key_name(keyname))
+        return k.get_contents_as_string(headers={"Range": "bytes={0}-{1}".format(start, end)})
 
     def cb(self, complete, total):
         """Upload callback to log upload percentage."""
@@ -110,43 +265,210 @@ class S3Backend(BakthatBackend):
         log.info("Upload completion: {0}%".format(percent))
 
     def upload(self, keyname, filename, cb=True):
-        k = Key(self.bucket)
-        k.key = keyname
-        upload_kwargs = {}
+        """Upload a file with a concurrent multipart upload (see writer),
+        the upload completion is logged every 10% if cb is True."""
+        total = os.path.getsize(filename)
+        writer = self.writer(keyname, size_hint=total)
+        logged = 0
+        try:
+            with open(filename, "rb") as f:
+                for data in iter(lambda: f.read(MEGABYTE), ""):
+                    writer.write(data)
+                    if cb and writer.uploaded * 10 // total > logged:
+                        logged = writer.uploaded * 10 // total
+                        self.cb(writer.uploaded, total)
+        except:
+            writer.abort()
+            raise
+        writer.close()
         if cb:
-            upload_kwargs = dict(cb=self.cb, num_cb=10)
-        k.set_contents_from_filename(filename, **upload_kwargs)
-        k.set_acl("private")
-
-    def ls(self):
-        return [key.name for key in self.bucket.get_all_keys()]
+            self.cb(total or 1, total or 1)
+
+    def writer(self, keyname, size_hint=None):
+        """Return a writable file-like object streaming the key with a concurrent multipart upload,
+        the upload is completed when it's closed."""
+        return S3MultipartWriter(self.bucket, self._key_name(keyname), size_hint,
+                                 controller=self.upload_controller)
+
+    def ls(self, prefix=""):
+        """List the stored keys (starting with prefix)."""
+        # bucket.list() handles the pagination (get_all_keys stops at 1000 keys).
+        keynames = []
+        storage_classes = {}
+        for key in self.bucket.list(prefix=self.prefix + prefix):
+            keyname = key.name[len(self.prefix):]
+            keynames.append(keyname)
+            storage_classes[keyname] = key.storage_class
+        self._storage_classes = storage_classes
+        return keynames
+
+    def storage_class(self, keyname):
+        """Return the storage class of a key (from the last listing if possible)."""
+        if keyname in self._storage_classes:
+            return self._storage_classes[keyname]
+        k = self.bucket.get_key(self._key_name(keyname))
+        return k.storage_class if k is not None else None
 
     def delete(self, keyname):
+        from boto.s3.key import Key
+
         k = Key(self.bucket)
-        k.key = keyname
+        k.key = self._key_name(keyname)
         self.bucket.delete_key(k)
 
+    def delete_many(self, keynames):
+        """Delete keys with multi-object delete requests (up to 1000 keys per request).
+
+        Raise an exception listing the keys that couldn't be deleted (the other ones are).
+
+        """
+        result = self.bucket.delete_keys([self._key_name(keyname) for keyname in keynames], quiet=True)
+        for error in result.errors:
+            log.error("Failed to delete {0}: {1}".format(error.key, error.message))
+        if result.errors:
+            failed = [error.key[len(self.prefix):] for error in result.errors]
+            raise Exception("Failed to delete {0} key(s): {1}".format(len(failed), ", ".join(failed)))
+
+    def copy(self, keyname, target, storage_class="STANDARD"):
+        """Copy a key to another S3 backend (bucket and/or prefix) with a server-side copy.
+
+        Nothing goes through the host, objects bigger than max_single_copy_size are
+        copied with a multipart copy (parts are copied concurrently).
+
+        :type keyname: str
+        :param keyname: Stored filename.
+
+        :type target: S3Backend
+        :param target: Destination backend.
+
+        :type storage_class: str
+        :param storage_class: Storage class of the copy.
+
+        """
+        src = self.bucket.get_key(self._key_name(keyname))
+        if src is None:
+            raise Exception("{0} not found in {1}".format(keyname, self.container))
+        if src.storage_class == "GLACIER" and src.ongoing_restore is not False:
+            raise Exception("{0} is in the GLACIER storage class, restore it first".format(keyname))
+
+        target_name = target._key_name(keyname)
+        if src.size <= self.max_single_copy_size:
+            target.bucket.copy_key(target_name, self.bucket.name, src.name, storage_class=storage_class)
+        else:
+            self._multipart_copy(src, target.bucket, target_name, storage_class)
+
+    def _multipart_copy(self, src, bucket, keyname, storage_class):
+        part_size = max(self.copy_part_size, (src.size + 9999) // 10000)
+        headers = {"x-amz-storage-class": storage_class}
+        mp = bucket.initiate_multipart_upload(keyname, headers=headers)
+
+        work = Queue.Queue()
+        for part_num, start in enumerate(range(0, src.size, part_size), 1):
+            work.put((part_num, start, min(start + part_size, src.size) - 1))
+
+        errors = []
+
+        def worker():
+            while not errors:
+                try:
+                    part_num, start, end = work.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    with_retries(mp.copy_part_from_key, self.bucket.name, src.name, part_num, start, end)
+                except Exception, exc:
+                    log.exception(exc)
+                    errors.append(exc)
+
+        threads = [threading.Thread(target=worker) for i in range(self.copy_threads)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+
+        if errors:
+            mp.cancel_upload()
+            raise errors[0]
+        mp.complete_upload()
+
+    def configure_lifecycle(self, glacier_days=None, expire_days=None):
+        """Add (or replace) the bakthat lifecycle rule of the bucket, applied to the keys under s3_prefix.
+
+        A rule needs a s3_prefix: the rule would otherwise apply to the whole bucket,
+        including the Glacier inventory backup (see GlacierBackend.backup_inventory).
+
+        :type glacier_days: int
+        :param glacier_days: Transition keys to the GLACIER storage class after N days.
+
+        :type expire_days: int
+        :param expire_days: Delete keys after N days.
+
+        :rtype: boto.s3.lifecycle.Lifecycle
+        :return: The bucket lifecycle configuration.
+
+        """
+        from boto.exception import S3ResponseError
+        from boto.s3.lifecycle import Expiration, Lifecycle, Transition
+
+        if (glacier_days or expire_days) and not self.prefix:
+            raise Exception("Lifecycle rules need a s3_prefix, they would apply to the whole bucket.")
+
+        rule_id = "bakthat-{0}".format(self.prefix) if self.prefix else "bakthat"
+
+        lifecycle = Lifecycle()
+        try:
+            # Other rules of the bucket are kept.
+            for rule in self.bucket.get_lifecycle_config():
+                if rule.id != rule_id:
+                    lifecycle.append(rule)
+        except S3ResponseError, exc:
+            if exc.code != "NoSuchLifecycleConfiguration":
+                raise
+
+        if glacier_days or expire_days:
+            transition = Transition(days=glacier_days, storage_class="GLACIER") if glacier_days else None
+            expiration = Expiration(days=expire_days) if expire_days else None
+            lifecycle.add_rule(rule_id, prefix=self.prefix, status="Enabled",
+                               expiration=expiration, transition=transition)
+
+        if len(lifecycle):
+            self.bucket.configure_lifecycle(lifecycle)
+        else:
+            self.bucket.delete_lifecycle_configuration()
+        return lifecycle
+
 
 class GlacierBackend(BakthatBackend):
     """Backend to handle Glacier upload/download."""
     def __init__(self, conf=None):
         BakthatBackend.__init__(self, conf, extra_conf=["glacier_vault", "s3_bucket"])
 
-        con = boto.connect_glacier(aws_access_key_id=self.conf["access_key"],
-                                    aws_secret_access_key=self.conf["secret_key"],
-                                    region_name=self.conf["region_name"])
-
-        self.vault = con.create_vault(self.conf["glacier_vault"])
+        self._vault = None
+        self._lock = threading.Lock()
+        self._transfer_controllers(conf, GlacierUploadWriter.DEFAULT_PART_SIZE)
         self.backup_key = "bakthat_glacier_inventory"
         self.container = "Glacier vault: {0}".format(self.conf["glacier_vault"])
 
+    @property
+    def vault(self):
+        """The vault is only created/checked on first use."""
+        if self._vault is None:
+            with self._lock:
+                if self._vault is None:
+                    con = get_connection("glacier", self.conf["access_key"],
+                                         self.conf["secret_key"], self.conf["region_name"])
+                    self._vault = con.create_vault(self.conf["glacier_vault"])
+        return self._vault
 
     def backup_inventory(self):
-        """Backup the local inventory from shelve as a json string to S3."""
+        """Backup the local inventory as a json string to S3."""
+        from boto.s3.key import Key
+
         if config.get("aws", "s3_bucket"):
             archives = self.load_archives()
 
-            s3_bucket = S3Backend(self.conf).bucket
+            s3_bucket = get_backend(S3Backend, self.conf).bucket
             k = Key(s3_bucket)
             k.key = self.backup_key
 
@@ -155,114 +477,192 @@ class GlacierBackend(BakthatBackend):
             k.set_acl("private")
 
     def load_archives(self):
-        """Fetch local inventory (stored in shelve)."""
-        with glacier_shelve() as d:
-            if not d.has_key("archives"):
-                d["archives"] = dict()
-
-            return d["archives"]
+        """Fetch local inventory (see bakthat.state)."""
+        return get_state().all(ARCHIVES)
 
     def load_archives_from_s3(self):
-        """Fetch latest inventory backup from S3."""
-        s3_bucket = S3Backend(self.conf).bucket
-        try:
-            k = Key(s3_bucket)
-            k.key = self.backup_key
+        """Fetch latest inventory backup from S3.
+
+        Raise an exception if the backup can't be read (missing, transitioned to
+        the GLACIER storage class...), rather than returning an empty inventory.
+
+        """
+        from boto.exception import S3ResponseError
 
+        s3_bucket = get_backend(S3Backend, self.conf).bucket
+        try:
+            k = s3_bucket.get_key(self.backup_key)
+            if k is None:
+                raise Exception("No inventory backup ({0}) in the S3 bucket.".format(self.backup_key))
             return json.loads(k.get_contents_as_string())
         except S3ResponseError, exc:
-            return {}
+            raise Exception("Can't read the inventory backup ({0}): {1}".format(self.backup_key, exc))
 
     def restore_inventory(self):
-        """Restore inventory from S3 to local shelve."""
+        """Restore inventory from S3 to the local state (left untouched if the backup can't be read)."""
         if config.get("aws", "s3_bucket"):
             loaded_archives = self.load_archives_from_s3()
-
-            with glacier_shelve() as d:
-                if not d.has_key("archives"):
-                    d["archives"] = dict()
-
-                archives = loaded_archives
-                d["archives"] = archives
+            get_state().replace(ARCHIVES, loaded_archives)
         else:
             raise Exception("You must set s3_bucket in order to backup/restore inventory to/from S3.")
 
 
-    def upload(self, keyname, filename):
-        archive_id = self.vault.concurrent_create_archive_from_file(filename, keyname)
+    def _register_archive(self, keyname, archive_id, size):
+        """Store the filename => archive_id mapping and backup the inventory."""
+        # Sizes are needed to retrieve large archives in slices.
+        get_state().set_many([(ARCHIVES, keyname, archive_id), (SIZES, keyname, size)])
 
-        # Storing the filename => archive_id data.
-        with glacier_shelve() as d:
-            if not d.has_key("archives"):
-                d["archives"] = dict()
+        self.backup_inventory()
 
-            archives = d["archives"]
-            archives[keyname] = archive_id
-            d["archives"] = archives
+    def writer(self, keyname, size_hint=None):
+        """Return a writable file-like object streaming the archive to Glacier.
 
-        self.backup_inventory()
+        Parts are uploaded concurrently while the data is produced, the archive
+        is registered in the inventory when the writer is closed.
+
+        :type keyname: str
+        :param keyname: Stored filename (used as archive description).
+
+        :type size_hint: int
+        :param size_hint: Expected size (upper bound), used to choose the part size.
+
+        """
+        return GlacierUploadWriter(self.vault, keyname, size_hint=size_hint, controller=self.upload_controller,
+                                   on_complete=lambda archive_id, size: self._register_archive(keyname,
+                                                                                               archive_id,
+                                                                                               size))
+
+    def upload(self, keyname, filename):
+        writer = self.writer(keyname, size_hint=os.path.getsize(filename))
+        try:
+            with open(filename, "rb") as f:
+                copy_stream(f, writer)
+        except:
+            writer.abort()
+            raise
+        writer.close()
 
     def get_archive_id(self, filename):
         """Get the archive_id corresponding to the filename."""
-        with glacier_shelve() as d:
-            if not d.has_key("archives"):
-                d["archives"] = dict()
+        return get_state().get(ARCHIVES, filename)
+
+    def get_archive_size(self, keyname):
+        """Get the archive size recorded at upload time (None if unknown)."""
+        return get_state().get(SIZES, keyname)
+
+    def size(self, keyname):
+        """Size of an archive from the local inventory (None if it's not in the inventory, 0 if unknown)."""
+        if self.get_archive_id(keyname) is None:
+            return None
+        return self.get_archive_size(keyname) or 0
+
+    def _initiate_retrieval(self, archive_id, keyname, slice_size=None):
+        """Initiate the retrieval job(s) for an archive.
+
+        :rtype: list
+        :return: A list of (job, byte_range) tuples, byte_range is None for a full retrieval.
+
+        """
+        archive_size = self.get_archive_size(keyname)
+        if not slice_size or not archive_size or archive_size <= slice_size:
+            if slice_size and not archive_size:
+                log.warning("Archive size unknown, retrieving {0} in a single job.".format(keyname))
+            return [(self.vault.retrieve_archive(archive_id, description=keyname), None)]
+
+        if slice_size % MEGABYTE:
+            raise Exception("The slice size must be a multiple of 1MB.")
+
+        jobs = []
+        for start in range(0, archive_size, slice_size):
+            byte_range = (start, min(start + slice_size, archive_size) - 1)
+            job_data = {"Type": "archive-retrieval",
+                        "ArchiveId": archive_id,
+                        "Description": keyname,
+                        "RetrievalByteRange": "{0}-{1}".format(*byte_range)}
+            response = self.vault.layer1.initiate_job(self.vault.name, job_data)
+            jobs.append((self.vault.get_job(response["JobId"]), byte_range))
+        return jobs
+
+    def _job_reader(self, job, byte_range=None):
+        """Return a file-like object streaming the output of a completed job."""
+        from boto.glacier.exceptions import TreeHashDoesNotMatchError
+        from boto.glacier.utils import tree_hash_from_str
+
+        def fetch(start, end):
+            response = job.get_output(byte_range=(start, end))
+            data = response.read()
+            expected_tree_hash = response.get("TreeHash")
+            if expected_tree_hash and tree_hash_from_str(data) != expected_tree_hash:
+                raise TreeHashDoesNotMatchError("Tree hash mismatch for {0} "
+                                                "(bytes {1}-{2})".format(job.id, start, end))
+            return data
+
+        if byte_range:
+            size = byte_range[1] - byte_range[0] + 1
+        else:
+            size = job.archive_size
+        return ChunkedDownloader(fetch, size, controller=self.download_controller)
 
-            archives = d["archives"]
+    def download(self, keyname, job_check=False, slice_size=None):
+        """Initiate a Job, check its status, and download the archive if it's completed.
 
-            if filename in archives:
-                return archives[filename]
+        :type keyname: str
+        :param keyname: Stored filename.
 
-        return None
+        :type job_check: bool
+        :param job_check: Return the pending job instead of None.
+
+        :type slice_size: int
+        :param slice_size: Retrieve the archive with ranged jobs of slice_size bytes (multiple of 1MB).
+
+        :rtype: file
+        :return: A file-like object streaming the archive, downloaded with concurrent ranged requests.
+
+        """
+        from boto.glacier.exceptions import UnexpectedHTTPResponseError
 
-    def download(self, keyname, job_check=False):
-        """Initiate a Job, check its status, and download the archive if it's completed."""
         archive_id = self.get_archive_id(keyname)
         if not archive_id:
             return
-        
-        with glacier_shelve() as d:
-            if not d.has_key("jobs"):
-                d["jobs"] = dict()
-
-            jobs = d["jobs"]
-            job = None
 
-            if keyname in jobs:
-                # The job is already in shelve
-                job_id = jobs[keyname]
-                try:
-                    job = self.vault.get_job(job_id)
-                except UnexpectedHTTPResponseError: # Return a 404 if the job is no more available
-                    del jobs[keyname]
-
-            if not job:
-                # Job initialization
-                job = self.vault.retrieve_archive(archive_id)
-                jobs[keyname] = job.id
-                job_id = job.id
+        state = get_state()
+        retrieval = []
 
-            # Commiting changes in shelve
-            d["jobs"] = jobs
+        # The job(s) may already be stored, a single job is stored as a job id,
+        # ranged jobs as a list of [job_id, start, end].
+        stored = state.get(JOBS, keyname)
+        if stored is not None:
+            if isinstance(stored, basestring):
+                stored = [[stored, None, None]]
+            try:
+                for job_id, start, end in stored:
+                    byte_range = (start, end) if start is not None else None
+                    retrieval.append((self.vault.get_job(job_id), byte_range))
+            except UnexpectedHTTPResponseError: # Return a 404 if the job is no more available
+                retrieval = []
+
+        if not retrieval:
+            # Job initialization, no lock is held during the API calls.
+            retrieval = self._initiate_retrieval(archive_id, keyname, slice_size)
+            if len(retrieval) == 1 and retrieval[0][1] is None:
+                state.set(JOBS, keyname, retrieval[0][0].id)
+            else:
+                state.set(JOBS, keyname, [[job.id, r[0], r[1]] for job, r in retrieval])
 
-        log.info("Job {action}: {status_code} ({creation_date}/{completion_date})".format(**job.__dict__))
+        pending = None
+        for job, byte_range in retrieval:
+            log.info("Job {action}: {status_code} ({creation_date}/{completion_date})".format(**job.__dict__))
+            if not job.completed and pending is None:
+                pending = job
 
-        if job.completed:
+        if pending is None:
             log.info("Downloading...")
-            encrypted_out = tempfile.TemporaryFile()
-
-            # Boto related, download the file in chunk
-            chunk_size = 4 * 1024 * 1024
-            num_chunks = int(math.ceil(job.archive_size / float(chunk_size)))
-            job._download_to_fileob(encrypted_out, num_chunks, chunk_size,
-                                     True, (socket.error, httplib.IncompleteRead))
-
-            encrypted_out.seek(0)
-            return encrypted_out
+            return ChainReader([lambda job=job, byte_range=byte_range: self._job_reader(job, byte_range)
+                                for job, byte_range in retrieval])
         else:
             log.info("Not completed yet")
             if job_check:
-                return job
+                return pending
             return
 
     def retrieve_inventory(self, jobid):
@@ -272,6 +672,79 @@ class GlacierBackend(BakthatBackend):
         else:
             return self.vault.get_job(jobid)
 
+    def inventory_output(self, job_id):
+        """Return the output of a completed inventory job as a raw HTTP response.
+
+        Layer1.get_job_output would decode the whole JSON document in memory.
+
+        """
+        from boto.connection import AWSAuthConnection
+        from boto.glacier.exceptions import UnexpectedHTTPResponseError
+
+        layer1 = self.vault.layer1
+        uri = "/{0}/vaults/{1}/jobs/{2}/output".format(layer1.account_id, self.vault.name, job_id)
+        response = AWSAuthConnection.make_request(layer1, "GET", uri,
+                                                  headers={"x-amz-glacier-version": layer1.Version})
+        if response.status != 200:
+            raise UnexpectedHTTPResponseError((200,), response)
+        return response
+
+    def merge_archives(self, archives):
+        """Add filename => archive_id entries to the local inventory."""
+        get_state().update(ARCHIVES, archives)
+
+    def reconcile_inventory(self, job_id=None, dry_run=False, batch_size=1000):
+        """Reconcile the local inventory with the vault inventory.
+
+        The first call initiates an inventory job (it takes ~4 hours), once it's
+        completed, the output is streamed and archives missing in the local
+        inventory are merged in batches.
+
+        :type job_id: str
+        :param job_id: Inventory job id (default to the last job initiated by bakthat).
+
+        :type dry_run: bool
+        :param dry_run: Only report the differences.
+
+        :rtype: dict
+        :return: The report (see bakthat.inventory.reconcile), None if the job isn't completed yet.
+
+        """
+        from boto.glacier.exceptions import UnexpectedHTTPResponseError
+
+        job_id = job_id or get_state().get(META, "inventory_job")
+
+        job = None
+        if job_id:
+            try:
+                job = self.vault.get_job(job_id)
+            except UnexpectedHTTPResponseError:
+                log.info("Inventory job {0} is no more available.".format(job_id))
+
+        if job is None:
+            job = self.retrieve_inventory(None)
+            get_state().set(META, "inventory_job", job.id)
+
+        log.info("Job {action}: {status_code} ({creation_date}/{completion_date})".format(**job.__dict__))
+        if not job.completed:
+            log.info("Not completed yet")
+            return
+
+        merge = None if dry_run else self.merge_archives
+        response = self.inventory_output(job.id)
+        try:
+            report = reconcile(iter_inventory(response), self.load_archives(),
+                               batch_size=batch_size, merge=merge)
+        finally:
+            response.close()
+
+        if not dry_run:
+            get_state().delete(META, ["inventory_job"])
+            if report["missing_locally"]:
+                self.backup_inventory()
+
+        return report
+
     def retrieve_archive(self, archive_id, jobid):
         """Initiate a job to retrieve Galcier archive or download archive."""
         if jobid is None:
@@ -280,23 +753,30 @@ class GlacierBackend(BakthatBackend):
             return self.vault.get_job(jobid)
 
 
-    def ls(self):
-        with glacier_shelve() as d:
-            if not d.has_key("archives"):
-                d["archives"] = dict()
-
-            return d["archives"].keys()
+    def ls(self, prefix=""):
+        """List the archives of the local inventory (starting with prefix)."""
+        return [keyname for keyname in get_state().keys(ARCHIVES) if keyname.startswith(prefix)]
 
     def delete(self, keyname):
         archive_id = self.get_archive_id(keyname)
         if archive_id:
             self.vault.delete_archive(archive_id)
-            with glacier_shelve() as d:
-                archives = d["archives"]
-
-                if keyname in archives:
-                    del archives[keyname]
-
-                d["archives"] = archives
+            get_state().delete(ARCHIVES, [keyname])
 
             self.backup_inventory()
+
+    def delete_many(self, keynames):
+        """Delete several archives, the inventory is updated and backed up only once."""
+        archives = self.load_archives()
+        deleted = []
+        try:
+            for keyname in keynames:
+                archive_id = archives.get(keyname)
+                if archive_id:
+                    self.vault.delete_archive(archive_id)
+                    deleted.append(keyname)
+        finally:
+            # Even if a deletion failed, the archives already deleted leave the inventory.
+            if deleted:
+                get_state().delete(ARCHIVES, deleted)
+                self.backup_inventory()
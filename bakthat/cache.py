@@ -0,0 +1,324 @@
+# -*- encoding: utf-8 -*-
+"""Local cache of recent backups.
+
+The stored stream of recent backups (as uploaded: compressed and encrypted)
+is kept on disk when it's uploaded or downloaded, per destination
+(container). restore reads a cached backup instead of downloading it (or
+waiting for a Glacier job), it's checked against the checksums recorded
+at backup time (see bakthat.integrity) as it's read. The cache size is
+capped, the least recently used backups are evicted first.
+
+The cache is enabled by a cache section in ~/.bakthat.conf::
+
+    [cache]
+    max_size = 20480 (MB)
+    path = ~/.bakthat-cache
+
+"""
+import os
+import errno
+import hashlib
+import logging
+import tempfile
+
+from bakthat.conf import config
+from bakthat.integrity import BlockHasher
+from bakthat.scheduler import ThrottledReader
+from bakthat.stream import TeeReader
+from bakthat.transfer import MEGABYTE
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.expanduser("~/.bakthat-cache")
+# A download is cached even if it's not read entirely (tar/gzip trailers)
+# as long as the rest is smaller than this.
+MAX_DRAIN_SIZE = 4 * MEGABYTE
+
+
+class BackupCache(object):
+    """Directory of cached backups, one file per stored key, LRU by mtime.
+
+    :type path: str
+    :param path: Cache directory.
+
+    :type max_size: int
+    :param max_size: Max total size, in bytes.
+
+    """
+    def __init__(self, path=DEFAULT_CACHE_DIR, max_size=0):
+        self.path = path
+        self.max_size = max_size
+
+    def _path(self, container, keyname):
+        # The same backup name may be stored in several destinations.
+        return os.path.join(self.path, hashlib.sha1("{0}:{1}".format(container, keyname)).hexdigest())
+
+    def entries(self):
+        """Return the cached files as a list of (mtime, size, path), least recently used first."""
+        entries = []
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return entries
+        for name in names:
+            # Entries being written are hidden.
+            if name.startswith("."):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        return entries
+
+    def _evict(self, size):
+        """Delete the least recently used entries to make room for size bytes."""
+        entries = self.entries()
+        total = sum(entry_size for mtime, entry_size, path in entries)
+        for mtime, entry_size, path in entries:
+            if total + size <= self.max_size:
+                break
+            log.debug("Evicting {0} from the cache".format(path))
+            self._remove(path)
+            total -= entry_size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def entry(self, container, keyname, size_hint=None):
+        """Return a CacheEntry to write a backup of container in the cache, None if it's too big."""
+        if size_hint and size_hint > self.max_size:
+            return None
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            return CacheEntry(self, container, keyname)
+        except (IOError, OSError), exc:
+            log.warning("Can't write in the cache: {0}".format(exc))
+
+    def _commit(self, entry_path, path, size):
+        self._evict(size)
+        os.rename(entry_path, path)
+
+    def open(self, container, keyname, checksums):
+        """Return the cached backup opened for reading, None if it's not cached (a backup
+        without checksums is never read from the cache).
+
+        The backup is checked against the recorded checksums as it's read
+        (see VerifyingReader), a mismatch raises IOError.
+
+        :type checksums: dict
+        :param checksums: Recorded checksums (see bakthat.integrity.load_checksums).
+
+        """
+        path = self._path(container, keyname)
+        if not checksums or not os.path.exists(path):
+            return None
+        if os.path.getsize(path) != checksums["size"]:
+            log.warning("Cached {0} doesn't match its checksums, discarding it".format(keyname))
+            self._remove(path)
+            return None
+
+        try:
+            f = open(path, "rb")
+        except IOError, exc:
+            log.warning("Can't read {0} from the cache: {1}".format(keyname, exc))
+            return None
+        # Mark it as recently used.
+        os.utime(path, None)
+        return VerifyingReader(f, checksums, keyname, lambda: self._remove(path))
+
+    def discard(self, container, keyname):
+        self._remove(self._path(container, keyname))
+
+    def reader(self, fileobj, container, keyname, size):
+        """Wrap a download, the backup is cached once it has been read entirely."""
+        if size > self.max_size:
+            return fileobj
+        entry = self.entry(container, keyname)
+        if entry is None:
+            return fileobj
+        return CachingReader(fileobj, entry, size)
+
+
+class _NullWriter(object):
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+class VerifyingReader(object):
+    """Readable cached backup, hashed as it's read (see bakthat.integrity.BlockHasher).
+
+    Once the end of the file is reached, IOError is raised (and the entry
+    discarded) if it doesn't match the recorded checksums. Readers may stop
+    before the end (archive trailers), a short rest is read when closing it.
+    Reads are throttled like the other disk reads.
+
+    """
+    def __init__(self, fileobj, checksums, keyname, discard):
+        self.fileobj = fileobj
+        self.checksums = checksums
+        self.keyname = keyname
+        self.discard = discard
+        self.hasher = BlockHasher(_NullWriter(), checksums["block_size"])
+        self._reader = TeeReader(ThrottledReader(fileobj), self.hasher)
+        self._checked = False
+
+    def read(self, size=-1):
+        data = self._reader.read(size)
+        if (size < 0 or not data) and not self._checked:
+            self._check()
+        return data
+
+    def _check(self):
+        self._checked = True
+        self.hasher.close()
+        if self.hasher.size != self.checksums["size"] or self.hasher.blocks != self.checksums["blocks"]:
+            log.warning("Cached {0} doesn't match its checksums, discarding it".format(self.keyname))
+            self.fileobj.close()
+            self.discard()
+            raise IOError("Cached {0} doesn't match its checksums".format(self.keyname))
+
+    def close(self):
+        try:
+            if not self._checked and self.checksums["size"] - self.hasher.size <= MAX_DRAIN_SIZE:
+                while self.read(MEGABYTE):
+                    pass
+        finally:
+            self.fileobj.close()
+
+
+class CacheEntry(object):
+    """A backup being written to the cache (in a hidden temp file until committed).
+
+    Errors are logged, they never make the backup/restore fail.
+
+    """
+    def __init__(self, cache, container, keyname):
+        self.cache = cache
+        self.keyname = keyname
+        self.cache_path = cache._path(container, keyname)
+        self.size = 0
+        fd, self.path = tempfile.mkstemp(prefix=".tmp-", dir=cache.path)
+        self._file = os.fdopen(fd, "wb")
+
+    def write(self, data):
+        if self._file is None:
+            return
+        self.size += len(data)
+        if self.size > self.cache.max_size:
+            log.info("{0} is bigger than the cache, not caching it".format(self.keyname))
+            return self.abort()
+        try:
+            self._file.write(data)
+        except IOError, exc:
+            log.warning("Can't write {0} in the cache: {1}".format(self.keyname, exc))
+            self.abort()
+
+    def commit(self):
+        if self._file is None:
+            return
+        try:
+            self._file.close()
+            self._file = None
+            self.cache._commit(self.path, self.cache_path, self.size)
+            self.path = None
+        except (IOError, OSError), exc:
+            log.warning("Can't write {0} in the cache: {1}".format(self.keyname, exc))
+            self.abort()
+
+    def abort(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.path is not None:
+            try:
+                self.cache._remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+
+class CachingWriter(object):
+    """Writable file-like object copying the stream to a cache entry before passing it to fileobj.
+
+    The entry is committed once fileobj is closed successfully, other
+    attributes (size, results...) are read from fileobj.
+
+    """
+    def __init__(self, fileobj, entry):
+        self.fileobj = fileobj
+        self.entry = entry
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.entry.write(data)
+
+    def close(self):
+        result = self.fileobj.close()
+        self.entry.commit()
+        return result
+
+    def abort(self):
+        self.entry.abort()
+        self.fileobj.abort()
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+class CachingReader(object):
+    """Readable file-like object copying what is read from fileobj to a cache entry.
+
+    The entry is committed if the whole backup (size bytes) has been read
+    when it's closed.
+
+    """
+    def __init__(self, fileobj, entry, size):
+        self.fileobj = fileobj
+        self.entry = entry
+        self.size = size
+        self.position = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.entry.write(data)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        try:
+            # Readers may stop before the end of the stream (archive trailers).
+            if 0 < self.size - self.position <= MAX_DRAIN_SIZE:
+                while self.read(MEGABYTE):
+                    pass
+            if self.position == self.size:
+                self.entry.commit()
+        except Exception, exc:
+            log.warning("Can't cache {0}: {1}".format(self.entry.keyname, exc))
+        finally:
+            self.entry.abort()
+            if hasattr(self.fileobj, "close"):
+                self.fileobj.close()
+
+
+def get_cache():
+    """Return the BackupCache configured in the cache section, None if it's disabled."""
+    if not config.has_section("cache") or not config.has_option("cache", "max_size"):
+        return None
+    max_size = int(config.get("cache", "max_size")) * MEGABYTE
+    if max_size <= 0:
+        return None
+    path = DEFAULT_CACHE_DIR
+    if config.has_option("cache", "path"):
+        path = os.path.expanduser(config.get("cache", "path"))
+    return BackupCache(path, max_size)
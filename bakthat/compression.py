@@ -0,0 +1,252 @@
+# -*- encoding: utf-8 -*-
+"""Block compression for the backup pipeline.
+
+Archives are written as a sequence of independent gzip members (one per
+block), this is still a regular .tgz (gzip handles multi-member files), but
+each block can use its own compression level. Blocks that look incompressible
+(video, JPEG, encrypted dumps, already compressed files...) are stored with
+level 0, so they don't cost any CPU.
+
+With the auto level, the level of compressible blocks follows the pipeline
+bottleneck: it's raised while the uploads can't keep up and lowered when
+the pipeline waits for the compression.
+
+"""
+import logging
+import math
+import struct
+import time
+import zlib
+
+from bakthat.stream import BufferedReader
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+DEFAULT_LEVEL = 6
+MIN_AUTO_LEVEL = 1
+MAX_AUTO_LEVEL = 9
+GZIP_HEADER = "\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+
+def sample_entropy(data, num_samples=4, sample_size=4096):
+    """Estimate the Shannon entropy (bits per byte) of data from a few evenly spaced samples."""
+    if len(data) <= num_samples * sample_size:
+        samples = data
+    else:
+        step = (len(data) - sample_size) // (num_samples - 1)
+        samples = "".join(data[i * step:i * step + sample_size] for i in range(num_samples))
+
+    if not samples:
+        return 0.0
+
+    total = float(len(samples))
+    entropy = 0.0
+    for byte in range(256):
+        count = samples.count(chr(byte))
+        if count:
+            p = count / total
+            entropy -= p * math.log(p, 2)
+    return entropy
+
+
+class AdaptiveLevel(object):
+    """Choose the compression level of a block by sniffing its content.
+
+    Blocks with a high entropy are stored (level 0), blocks with a low entropy are
+    compressed at level, the ones in between get a trial compression of a sample.
+
+    """
+    def __init__(self, level=DEFAULT_LEVEL, store_entropy=7.9, compress_entropy=7.0, min_ratio=0.97):
+        self.level = level
+        self.store_entropy = store_entropy
+        self.compress_entropy = compress_entropy
+        self.min_ratio = min_ratio
+
+    def __call__(self, block):
+        entropy = sample_entropy(block)
+        if entropy >= self.store_entropy:
+            return 0
+        if entropy < self.compress_entropy:
+            return self.level
+
+        sample = block[:64 * 1024]
+        if len(zlib.compress(sample, 1)) > self.min_ratio * len(sample):
+            return 0
+        return self.level
+
+
+class AutoLevel(AdaptiveLevel):
+    """AdaptiveLevel whose level is tuned from the time spent compressing the blocks
+    and writing them downstream (encryption and upload queue).
+
+    Every window blocks, if compressing took more than cpu_bound of the elapsed
+    time, the pipeline is CPU bound and the level is lowered; if writing took more
+    than network_bound of it, the uploads are the bottleneck (the writes block
+    until a part is uploaded) and the level is raised.
+
+    """
+    def __init__(self, level=DEFAULT_LEVEL, window=8, cpu_bound=0.6, network_bound=0.5, clock=time.time,
+                 **kwargs):
+        AdaptiveLevel.__init__(self, level, **kwargs)
+        self.window = window
+        self.cpu_bound = cpu_bound
+        self.network_bound = network_bound
+        self.clock = clock
+        self.changes = []
+        self._blocks = 0
+        self._compress_time = 0.0
+        self._write_time = 0.0
+        self._window_start = clock()
+
+    def feedback(self, compress_time, write_time):
+        """Called by BlockCompressor after each block."""
+        self._blocks += 1
+        self._compress_time += compress_time
+        self._write_time += write_time
+        if self._blocks % self.window:
+            return
+
+        now = self.clock()
+        elapsed = max(now - self._window_start, 1e-6)
+        level = self.level
+        if self._compress_time > self.cpu_bound * elapsed:
+            level = max(level - 1, MIN_AUTO_LEVEL)
+        elif self._write_time > self.network_bound * elapsed:
+            level = min(level + 1, MAX_AUTO_LEVEL)
+        if level != self.level:
+            log.info("Compression level {0} => {1} (compression {2:.0%}, upload {3:.0%})".format(
+                     self.level, level, self._compress_time / elapsed, self._write_time / elapsed))
+            self.changes.append((self._blocks, level))
+            self.level = level
+
+        self._compress_time = self._write_time = 0.0
+        self._window_start = now
+
+
+def parse_level(level):
+    """Return the level argument of BlockCompressor for a level option (None, "auto" or 0-9)."""
+    if level is None:
+        return None
+    if str(level).lower() == "auto":
+        return AutoLevel()
+    if not str(level).isdigit() or not 0 <= int(level) <= 9:
+        raise Exception("Invalid compression level {0}, should be auto or 0-9".format(level))
+    level = int(level)
+    return AdaptiveLevel(level) if level else 0
+
+
+class BlockCompressor(object):
+    """Writable file-like object compressing each block as an independent gzip member.
+
+    Closing it closes fileobj.
+
+    :type fileobj: file
+    :param fileobj: Writable file-like object.
+
+    :type level: callable or int
+    :param level: A fixed compression level, or a callable returning the level for a block.
+
+    :type block_size: int
+    :param block_size: Uncompressed block size.
+
+    """
+    def __init__(self, fileobj, level=None, block_size=DEFAULT_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = AdaptiveLevel() if level is None else level
+        self.block_size = block_size
+        self.levels = {}
+        self.compress_time = 0.0
+        self._chunks = []
+        self._buffered = 0
+
+    def _write_block(self, block):
+        level = self.level(block) if callable(self.level) else self.level
+        self.levels[level] = self.levels.get(level, 0) + 1
+
+        start = time.time()
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = compressor.compress(block) + compressor.flush()
+        trailer = struct.pack("<II", zlib.crc32(block) & 0xffffffff, len(block) & 0xffffffff)
+        compress_time = time.time() - start
+        self.compress_time += compress_time
+
+        start = time.time()
+        self.fileobj.write(GZIP_HEADER + data + trailer)
+        if hasattr(self.level, "feedback"):
+            self.level.feedback(compress_time, time.time() - start)
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            data = "".join(self._chunks)
+            offset = 0
+            while len(data) - offset >= self.block_size:
+                self._write_block(data[offset:offset + self.block_size])
+                offset += self.block_size
+            data = data[offset:]
+            self._chunks, self._buffered = [data], len(data)
+
+    def close(self):
+        if self._buffered or not self.levels:
+            self._write_block("".join(self._chunks))
+            self._chunks, self._buffered = [], 0
+        return self.fileobj.close()
+
+    def abort(self):
+        self.fileobj.abort()
+
+    @property
+    def stats(self):
+        """Number of blocks per compression level."""
+        return dict(self.levels)
+
+
+class GzipStreamReader(BufferedReader):
+    """Decompress a (multi-member) gzip stream on the fly, without seeking."""
+    def __init__(self, fileobj, chunk_size=64 * 1024):
+        BufferedReader.__init__(self)
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self._decompressor = self._new_decompressor()
+
+    def _new_decompressor(self):
+        # 16 + MAX_WBITS: zlib parses the gzip header and trailer.
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def _fill(self):
+        while True:
+            data = self.fileobj.read(self.chunk_size)
+            if not data:
+                self._check_end()
+                return ""
+
+            out = [self._decompressor.decompress(data)]
+            # Data after the end of a member belongs to the next one.
+            while self._decompressor.unused_data:
+                rest = self._decompressor.unused_data
+                self._decompressor = self._new_decompressor()
+                out.append(self._decompressor.decompress(rest))
+
+            out = "".join(out)
+            if out:
+                return out
+
+    def _check_end(self):
+        """Raise IOError unless the last member reached its trailer.
+
+        zlib on python 2 doesn't tell whether a stream ended: a byte fed
+        after the end of a member is left in unused_data, it's consumed
+        (or rejected) otherwise.
+
+        """
+        try:
+            self._decompressor.decompress("\x00")
+        except zlib.error, exc:
+            raise IOError("Truncated gzip stream: {0}".format(exc))
+        if self._decompressor.unused_data != "\x00":
+            raise IOError("Truncated gzip stream")
+
+    def close(self):
+        self.fileobj.close()
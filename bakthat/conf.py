@@ -5,5 +5,36 @@ import os
 DEFAULT_LOCATION = "us-east-1"
 DEFAULT_DESTINATION = "s3"
 
-config = ConfigParser.SafeConfigParser()
-config.read(os.path.expanduser("~/.bakthat.conf"))
+CONFIG_FILE = os.path.expanduser("~/.bakthat.conf")
+
+
+class LazyConfig(object):
+    """Proxy to a SafeConfigParser, the config file is only parsed on first access.
+
+    Most commands never touch the configuration before doing network I/O,
+    so there is no need to pay for it at import time (bakthat --help).
+
+    """
+    def __init__(self, filename=CONFIG_FILE):
+        self.filename = filename
+        self._config = None
+
+    @property
+    def loaded(self):
+        return self._config is not None
+
+    def load(self):
+        if self._config is None:
+            self._config = ConfigParser.SafeConfigParser()
+            self._config.read(self.filename)
+        return self._config
+
+    def reload(self):
+        """Drop the parsed config, it will be read again on next access."""
+        self._config = None
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+
+config = LazyConfig()
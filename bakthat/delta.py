@@ -0,0 +1,363 @@
+# -*- encoding: utf-8 -*-
+"""Binary delta backups of single files (rsync/rdiff-style).
+
+A full backup of the file is a regular tgz backup, the block signature of
+the uploaded version (adler32 + md5 of each block) is kept in the local
+state. The next backups only upload a delta against the previous version:
+blocks found in the signature (at any offset, with a rolling checksum)
+are stored as references, the rest as literal data. Restoring a delta
+restores the full backup and applies the deltas of the chain in order, so
+the chain length is limited: once it's reached, a new full backup is made.
+
+Delta format (compressed/encrypted like any other backup)::
+
+    "BKDELTA1" block_size(I) size(Q) chain_length(H) [key_length(H) key]...
+    ops: "C" block_index(Q) count(I) | "L" length(I) data | "E"
+
+The chain lists the stored keys needed to restore the delta (the full
+backup first), so every job/download can be requested at once.
+
+"""
+import os
+import hashlib
+import logging
+import mmap
+import struct
+import zlib
+from array import array
+
+from bakthat.scheduler import DISK, MEGABYTE, get_scheduler
+from bakthat.state import get_state, DELTAS
+
+log = logging.getLogger(__name__)
+
+MAGIC = "BKDELTA1"
+MIN_BLOCK_SIZE = 64 * 1024
+MAX_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_MAX_CHAIN = 7
+MAX_LITERAL = 1024 * 1024
+# Rolling (in python) through data that doesn't match is slow, after that
+# many blocks without match, only block boundaries are checked (with a new
+# rolling search every ROLL_INTERVAL blocks).
+GIVE_UP_BLOCKS = 16
+ROLL_INTERVAL = 64
+
+ADLER_MOD = 65521
+
+
+def block_size_for(size):
+    """Block size for a file of size bytes: ~sqrt(size) like rsync, a power of 2."""
+    block_size = MIN_BLOCK_SIZE
+    while block_size < MAX_BLOCK_SIZE and block_size * block_size < size:
+        block_size *= 2
+    return block_size
+
+
+def _weak(data):
+    return zlib.adler32(data) & 0xffffffff
+
+
+class Signature(object):
+    """Block signature of a file version.
+
+    :type block_size: int
+    :param block_size: Block size.
+
+    :type weak: array
+    :param weak: adler32 of each block.
+
+    :type strong: list
+    :param strong: md5 digest of each block.
+
+    """
+    def __init__(self, block_size, weak=None, strong=None):
+        self.block_size = block_size
+        self.weak = weak if weak is not None else array("I")
+        self.strong = strong if strong is not None else []
+
+    @classmethod
+    def compute(cls, f, block_size):
+        """Compute the signature of a file (read from its current position)."""
+        signature = cls(block_size)
+        for block in iter(lambda: f.read(block_size), ""):
+            signature.add(block)
+        return signature
+
+    def add(self, block):
+        self.weak.append(_weak(block))
+        self.strong.append(hashlib.md5(block).digest())
+
+    def index(self):
+        """Return a dict weak checksum => list of block indexes."""
+        index = {}
+        for i, weak in enumerate(self.weak):
+            index.setdefault(weak, []).append(i)
+        return index
+
+    def dumps(self):
+        return struct.pack(">IQ", self.block_size, len(self.weak)) + self.weak.tostring() + "".join(self.strong)
+
+    @classmethod
+    def loads(cls, data):
+        block_size, count = struct.unpack(">IQ", data[:12])
+        weak = array("I")
+        weak.fromstring(data[12:12 + count * 4])
+        start = 12 + count * 4
+        strong = [data[start + i * 16:start + (i + 1) * 16] for i in xrange(count)]
+        return cls(block_size, weak, strong)
+
+
+class SignatureWriter(object):
+    """Writable file-like object computing the Signature of the data written to it,
+    whatever the size of the writes (see write_delta and bakthat.scan.add_to_tar)."""
+    def __init__(self, block_size):
+        self.signature = Signature(block_size)
+        self._chunks = []
+        self._buffered = 0
+
+    def write(self, data):
+        block_size = self.signature.block_size
+        if not self._buffered and len(data) == block_size:
+            self.signature.add(data)
+            return
+        self._chunks.append(data)
+        self._buffered += len(data)
+        if self._buffered >= block_size:
+            data = "".join(self._chunks)
+            for start in xrange(0, len(data) - block_size + 1, block_size):
+                self.signature.add(data[start:start + block_size])
+            data = data[start + block_size:]
+            self._chunks, self._buffered = [data], len(data)
+
+    def close(self):
+        """Add the last (partial) block, return the signature."""
+        if self._buffered:
+            self.signature.add("".join(self._chunks))
+            self._chunks, self._buffered = [], 0
+        return self.signature
+
+
+class _DeltaEncoder(object):
+    """Write the ops of a delta, literals are coalesced and consecutive copies merged."""
+    def __init__(self, out):
+        self.out = out
+        self._copy = None
+        self.copied = 0
+        self.literal = 0
+
+    def copy(self, index, length):
+        if self._copy is not None and self._copy[0] + self._copy[1] == index:
+            self._copy[1] += 1
+        else:
+            self._flush_copy()
+            self._copy = [index, 1]
+        self.copied += length
+
+    def data(self, data):
+        if not data:
+            return
+        self._flush_copy()
+        for start in xrange(0, len(data), MAX_LITERAL):
+            chunk = data[start:start + MAX_LITERAL]
+            self.out.write("L" + struct.pack(">I", len(chunk)))
+            self.out.write(chunk)
+        self.literal += len(data)
+
+    def _flush_copy(self):
+        if self._copy is not None:
+            self.out.write("C" + struct.pack(">QI", *self._copy))
+            self._copy = None
+
+    def end(self):
+        self._flush_copy()
+        self.out.write("E")
+
+
+def write_delta(f, signature, chain, out, new_signature=None):
+    """Write the delta of a file against the version described by signature.
+
+    :type f: file
+    :param f: File opened for reading (it must not change during the backup).
+
+    :type signature: Signature
+    :param signature: Signature of the previous version.
+
+    :type chain: list
+    :param chain: Stored keys needed to restore the previous version, full backup first.
+
+    :type out: file
+    :param out: Writable file-like object.
+
+    :type new_signature: SignatureWriter
+    :param new_signature: Receives the file data as it's scanned, to compute the
+        signature of this version without reading the file again.
+
+    :rtype: dict
+    :return: size, copied and literal bytes.
+
+    """
+    size = os.fstat(f.fileno()).st_size
+    block_size = signature.block_size
+    out.write(MAGIC + struct.pack(">IQH", block_size, size, len(chain)))
+    for key in chain:
+        out.write(struct.pack(">H", len(key)) + key)
+
+    encoder = _DeltaEncoder(out)
+    if not size:
+        encoder.end()
+        if new_signature is not None:
+            new_signature.close()
+        return dict(size=0, copied=0, literal=0)
+
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        index = signature.index()
+        strong = signature.strong
+
+        def lookup(pos, weak):
+            candidates = index.get(weak)
+            if candidates:
+                digest = hashlib.md5(data[pos:pos + block_size]).digest()
+                for i in candidates:
+                    if strong[i] == digest:
+                        return i
+
+        scheduler = get_scheduler()
+        pos = literal_start = signed = throttled = 0
+        misses = 0
+        while pos < size:
+            if pos - throttled >= MEGABYTE:
+                # The file is read through the mmap, throttled like ThrottledReader reads.
+                scheduler.throttle(DISK, pos - throttled)
+                throttled = pos
+            if new_signature is not None and pos > signed:
+                # The pages behind pos were just read.
+                new_signature.write(data[signed:pos])
+                signed = pos
+            length = min(block_size, size - pos)
+            match = lookup(pos, _weak(data[pos:pos + length]))
+            if match is None and length == block_size and pos + block_size < size and \
+                    (misses < GIVE_UP_BLOCKS or not misses % ROLL_INTERVAL):
+                # Rolling search of a block starting in the next block_size bytes.
+                window = bytearray(data[pos:pos + 2 * block_size])
+                weak = _weak(data[pos:pos + block_size])
+                a, b = weak & 0xffff, weak >> 16
+                for k in xrange(1, len(window) - block_size + 1):
+                    x_out, x_in = window[k - 1], window[k - 1 + block_size]
+                    a = (a - x_out + x_in) % ADLER_MOD
+                    b = (b - block_size * x_out + a - 1) % ADLER_MOD
+                    if (b << 16 | a) in index:
+                        match = lookup(pos + k, b << 16 | a)
+                        if match is not None:
+                            pos += k
+                            break
+                else:
+                    match = None
+
+            if match is None:
+                pos += length
+                misses += 1
+                continue
+
+            encoder.data(data[literal_start:pos])
+            encoder.copy(match, min(block_size, size - pos))
+            pos += block_size
+            literal_start = pos
+            misses = 0
+
+        scheduler.throttle(DISK, size - throttled)
+        encoder.data(data[literal_start:size])
+        encoder.end()
+        if new_signature is not None:
+            new_signature.write(data[signed:size])
+            new_signature.close()
+    finally:
+        data.close()
+
+    log.info("Delta: {0} bytes copied from the previous version, {1} new bytes".format(encoder.copied,
+                                                                                       encoder.literal))
+    return dict(size=size, copied=encoder.copied, literal=encoder.literal)
+
+
+def _read_exact(stream, size):
+    data = stream.read(size)
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise IOError("Truncated delta")
+        data += chunk
+    return data
+
+
+def read_header(stream):
+    """Read the header of a delta, return (block_size, size, chain)."""
+    if _read_exact(stream, len(MAGIC)) != MAGIC:
+        raise IOError("Not a bakthat delta")
+    block_size, size, chain_length = struct.unpack(">IQH", _read_exact(stream, 14))
+    chain = []
+    for i in range(chain_length):
+        length, = struct.unpack(">H", _read_exact(stream, 2))
+        chain.append(_read_exact(stream, length))
+    return block_size, size, chain
+
+
+def apply_delta(base, stream, out, block_size, size):
+    """Rebuild a file version from the previous one and a delta (read after its header).
+
+    :type base: file
+    :param base: Previous version, opened for reading.
+
+    :type out: file
+    :param out: The new version is written to it.
+
+    """
+    written = 0
+    while True:
+        op = _read_exact(stream, 1)
+        if op == "E":
+            break
+        elif op == "C":
+            index, count = struct.unpack(">QI", _read_exact(stream, 12))
+            base.seek(index * block_size)
+            left = count * block_size
+            while left:
+                data = base.read(min(left, MAX_LITERAL))
+                if not data:
+                    break
+                out.write(data)
+                written += len(data)
+                left -= len(data)
+        elif op == "L":
+            length, = struct.unpack(">I", _read_exact(stream, 4))
+            out.write(_read_exact(stream, length))
+            written += length
+        else:
+            raise IOError("Corrupted delta (unknown op {0!r})".format(op))
+
+    if written != size:
+        raise IOError("Corrupted delta ({0} bytes rebuilt, {1} expected)".format(written, size))
+
+
+def _state_key(container, backup_name):
+    return "{0}:{1}".format(container, backup_name)
+
+
+def load_delta_state(container, backup_name):
+    """Return the delta state of a backup set: dict(chain, signature), None if unknown.
+
+    chain lists the stored keys of the last version, full backup first.
+
+    """
+    state = get_state().get(DELTAS, _state_key(container, backup_name))
+    if state is not None:
+        state = dict(state, signature=Signature.loads(state["signature"]))
+    return state
+
+
+def save_delta_state(container, backup_name, chain, signature):
+    get_state().set(DELTAS, _state_key(container, backup_name),
+                    dict(chain=chain, signature=signature.dumps()))
+
+
+def delete_delta_state(container, backup_name):
+    get_state().delete(DELTAS, [_state_key(container, backup_name)])
@@ -0,0 +1,198 @@
+# -*- encoding: utf-8 -*-
+"""Parallel extraction of tar streams.
+
+tarfile.extractall creates the members one at a time, with an
+open/write/close/chmod/utime sequence per file: restoring millions of
+small files takes much longer than downloading them. ParallelExtractor
+reads the stream in the calling thread (decryption and decompression stay
+sequential) and hands the small files to a pool of writer threads:
+
+- directories are created as soon as they are read (writable, 0700)
+- small files are read in memory and written by the writer threads
+  (at most MAX_PENDING of them are queued)
+- large files are preallocated and written by the calling thread
+- links, special files and sparse files go through tarfile, hardlinks
+  once every pending file has been written
+- owners, modes and times are set in a final pass, the directories last
+  and deepest first (like tarfile.extractall)
+
+"""
+import os
+import logging
+import tarfile
+import threading
+import Queue
+from operator import attrgetter
+
+log = logging.getLogger(__name__)
+
+DEFAULT_NUM_THREADS = 8
+# Files up to this size are written by the writer threads.
+SMALL_FILE_SIZE = 1024 * 1024
+MAX_PENDING = 64
+
+_fallocate = None
+
+
+def preallocate(fd, size):
+    """Reserve the blocks of a file about to be written (less fragmentation), best effort."""
+    global _fallocate
+    if _fallocate is None:
+        # Not exposed by the os module on python 2.
+        import ctypes
+        import ctypes.util
+        try:
+            _fallocate = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True).posix_fallocate
+            _fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        except (OSError, AttributeError):
+            _fallocate = False
+    if _fallocate and size:
+        # Failures (unsupported by the filesystem...) are ignored, the file is written anyway.
+        _fallocate(fd, 0, size)
+
+
+class ParallelExtractor(object):
+    """Extract a tar archive with a pool of writer threads.
+
+    :type tar: tarfile.TarFile
+    :param tar: Archive opened for reading (the stream mode r| is fine).
+
+    :type path: str
+    :param path: Target directory.
+
+    :type num_threads: int
+    :param num_threads: Number of writer threads.
+
+    """
+    def __init__(self, tar, path=".", num_threads=DEFAULT_NUM_THREADS):
+        self.tar = tar
+        self.path = path
+        self.num_threads = num_threads
+        self.directories = []
+        self.files = []
+        self._known_dirs = set()
+        self._error = None
+        self._work = None
+        self._threads = []
+
+    def extractall(self):
+        self.extract_members()
+        self.fix_metadata()
+
+    def extract_members(self):
+        """Extract the data of every member, file attributes are only set by fix_metadata."""
+        self._start()
+        try:
+            for tarinfo in self.tar:
+                self._extract(tarinfo)
+        except:
+            self._stop(raise_error=False)
+            raise
+        self._stop()
+
+    def fix_metadata(self):
+        """Set the owner, mode and times of the extracted files, then of the directories."""
+        self._start()
+        try:
+            for tarinfo, targetpath in self.files:
+                self._submit(self._set_attributes, tarinfo, targetpath)
+        except:
+            self._stop(raise_error=False)
+            raise
+        self._stop()
+        self.files = []
+
+        self.directories.sort(key=attrgetter("name"), reverse=True)
+        for tarinfo in self.directories:
+            self._set_attributes(tarinfo, os.path.join(self.path, tarinfo.name))
+        self.directories = []
+
+    def _extract(self, tarinfo):
+        targetpath = os.path.join(self.path, tarinfo.name)
+        if tarinfo.isdir():
+            if not os.path.isdir(targetpath):
+                os.makedirs(targetpath, 0700)
+            self._known_dirs.add(targetpath)
+            self.directories.append(tarinfo)
+            return
+
+        self._make_parent(targetpath)
+        if tarinfo.isreg() and getattr(tarinfo, "sparse", None) is None:
+            source = self.tar.extractfile(tarinfo)
+            if tarinfo.size <= SMALL_FILE_SIZE:
+                self._submit(self._write_file, targetpath, source.read())
+            else:
+                with open(targetpath, "wb") as f:
+                    preallocate(f.fileno(), tarinfo.size)
+                    tarfile.copyfileobj(source, f, tarinfo.size)
+            self.files.append((tarinfo, targetpath))
+        else:
+            if tarinfo.islnk():
+                # The link target may still be queued.
+                self._wait()
+            # Permissions of the links and special files are set right away.
+            self.tar.extract(tarinfo, self.path)
+
+    def _make_parent(self, targetpath):
+        parent = os.path.dirname(targetpath)
+        if parent and parent not in self._known_dirs:
+            # Only the calling thread creates directories.
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            self._known_dirs.add(parent)
+
+    def _write_file(self, targetpath, data):
+        with open(targetpath, "wb") as f:
+            f.write(data)
+
+    def _set_attributes(self, tarinfo, targetpath):
+        try:
+            self.tar.chown(tarinfo, targetpath)
+            self.tar.chmod(tarinfo, targetpath)
+            self.tar.utime(tarinfo, targetpath)
+        except tarfile.ExtractError, exc:
+            log.debug("{0}: {1}".format(tarinfo.name, exc))
+
+    def _start(self):
+        self._error = None
+        self._work = Queue.Queue(maxsize=MAX_PENDING)
+        self._threads = []
+        for i in range(self.num_threads):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _worker(self):
+        while True:
+            work = self._work.get()
+            try:
+                if work is None:
+                    return
+                if self._error is None:
+                    func, args = work
+                    func(*args)
+            except Exception, exc:
+                self._error = exc
+            finally:
+                self._work.task_done()
+
+    def _submit(self, func, *args):
+        if self._error is not None:
+            raise self._error
+        self._work.put((func, args))
+
+    def _wait(self):
+        """Wait for the queued work."""
+        self._work.join()
+        if self._error is not None:
+            raise self._error
+
+    def _stop(self, raise_error=True):
+        for t in self._threads:
+            self._work.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        if raise_error and self._error is not None:
+            raise self._error
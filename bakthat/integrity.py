@@ -0,0 +1,298 @@
+# -*- encoding: utf-8 -*-
+"""Integrity verification of stored backups.
+
+At backup time, the SHA-256 of every block (1MB) of the stored stream (i.e.
+compressed and encrypted) is recorded in the local catalog (see bakthat.state),
+for each destination. A backup can then be verified without restoring it:
+
+- quick: every stored key exists with the recorded size (metadata only)
+- spot: a few random blocks of each key are fetched with ranged requests
+  and compared with the recorded hashes
+- full: every key is streamed and every block is checked, nothing is
+  written to disk; backups without recorded hashes are decrypted,
+  decompressed and their tar stream is read instead
+
+"""
+import hashlib
+import logging
+import random
+import tarfile
+from contextlib import closing
+
+from bakthat.scheduler import NETWORK, get_scheduler
+from bakthat.state import CHECKSUMS, get_state
+from bakthat.compression import GzipStreamReader
+from bakthat.stream import ChainReader, DecryptReader
+from bakthat.transfer import MEGABYTE
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_SIZE = MEGABYTE
+DEFAULT_SPOT_CHECKS = 3
+VERIFY_MODES = ("quick", "spot", "full")
+
+OK = "ok"
+CORRUPTED = "corrupted"
+MISSING = "missing"
+PENDING = "pending"
+UNVERIFIED = "unverified"
+
+
+class BlockHasher(object):
+    """Writable file-like object hashing each block of the stream before passing it to fileobj.
+
+    Closing it closes fileobj.
+
+    """
+    def __init__(self, fileobj, block_size=DEFAULT_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self.blocks = []
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        self._block = hashlib.sha256()
+        self._block_len = 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self._sha256.update(data)
+        self.size += len(data)
+        offset = 0
+        while offset < len(data):
+            chunk = data[offset:offset + self.block_size - self._block_len]
+            self._block.update(chunk)
+            self._block_len += len(chunk)
+            offset += len(chunk)
+            if self._block_len == self.block_size:
+                self.blocks.append(self._block.digest())
+                self._block, self._block_len = hashlib.sha256(), 0
+
+    def close(self):
+        if self._block_len:
+            self.blocks.append(self._block.digest())
+            self._block, self._block_len = hashlib.sha256(), 0
+        return self.fileobj.close()
+
+    def abort(self):
+        self.fileobj.abort()
+
+    @property
+    def checksums(self):
+        """Checksums of the stream (once closed)."""
+        return dict(size=self.size, block_size=self.block_size,
+                    blocks=list(self.blocks), sha256=self._sha256.hexdigest())
+
+
+def _catalog_key(container, keyname):
+    return "{0}:{1}".format(container, keyname)
+
+
+def save_checksums(container, keyname, checksums):
+    """Record the checksums of a backup (keyname is the backup key, without volume suffix)."""
+    get_state().set(CHECKSUMS, _catalog_key(container, keyname), checksums)
+
+
+def load_checksums(container, keyname):
+    """Return the recorded checksums of a backup, None if unknown."""
+    return get_state().get(CHECKSUMS, _catalog_key(container, keyname))
+
+
+def delete_checksums(container, keynames):
+    """Forget the checksums of deleted backups."""
+    get_state().delete(CHECKSUMS, [_catalog_key(container, keyname) for keyname in keynames])
+
+
+def missing_volumes(backup, checksums=None):
+    """Return a message if volumes of a split backup are missing, None otherwise.
+
+    Gaps are found from the listed indexes, missing last volumes from the
+    recorded checksums (their number, or the size and volume size).
+
+    """
+    volumes = backup.get("volumes")
+    if not volumes:
+        return None
+    expected = backup.get("num_volumes", len(volumes))
+    if checksums and checksums.get("volume_size"):
+        recorded = checksums.get("num_volumes") or \
+            max(1, (checksums["size"] + checksums["volume_size"] - 1) // checksums["volume_size"])
+        expected = max(expected, recorded)
+    if len(volumes) != expected:
+        return "{0}/{1} volumes of {2} are missing".format(expected - len(volumes), expected, backup["key"])
+    return None
+
+
+def _stored_parts(backup, checksums):
+    """Return (keyname, offset, size) for each stored key of a backup (size is None if unknown)."""
+    volumes = backup.get("volumes")
+    if not volumes:
+        return [(backup["key"], 0, checksums["size"] if checksums else None)]
+
+    # Volumes are contiguous (see missing_volumes).
+
+    volume_size = checksums.get("volume_size") if checksums else None
+    parts = []
+    for index, keyname in enumerate(volumes):
+        if volume_size:
+            offset = index * volume_size
+            parts.append((keyname, offset, min(volume_size, checksums["size"] - offset)))
+        else:
+            parts.append((keyname, None, None))
+    return parts
+
+
+def _check_blocks(data, offset, checksums):
+    """Check data read at offset (block aligned) against the recorded block hashes."""
+    block_size = checksums["block_size"]
+    first = offset // block_size
+    for i in range(0, len(data), block_size):
+        index = first + i // block_size
+        if index >= len(checksums["blocks"]) or \
+                hashlib.sha256(data[i:i + block_size]).digest() != checksums["blocks"][index]:
+            return index
+    return None
+
+
+def _quick(backend, parts, checksums):
+    for keyname, offset, size in parts:
+        actual = backend.size(keyname)
+        if actual is None:
+            return MISSING, "{0} not found".format(keyname)
+        if size is not None and actual and actual != size:
+            return CORRUPTED, "{0}: size {1}, expected {2}".format(keyname, actual, size)
+    return OK, "{0} key(s) found".format(len(parts))
+
+
+def _spot(backend, parts, checksums, num_checks=DEFAULT_SPOT_CHECKS):
+    status, detail = _quick(backend, parts, checksums)
+    if status != OK:
+        return status, detail
+    if not checksums or not hasattr(backend, "read_range"):
+        return UNVERIFIED, "no recorded checksums or no ranged reads, only checked the sizes"
+
+    block_size = checksums["block_size"]
+    checked = 0
+    for keyname, offset, size in parts:
+        num_blocks = (size + block_size - 1) // block_size
+        for index in sorted(random.sample(range(num_blocks), min(num_checks, num_blocks))):
+            start = index * block_size
+            end = min(start + block_size, size) - 1
+            get_scheduler().throttle(NETWORK, end - start + 1)
+            bad_block = _check_blocks(backend.read_range(keyname, start, end), offset + start, checksums)
+            if bad_block is not None:
+                return CORRUPTED, "{0}: block {1} doesn't match".format(keyname, bad_block)
+            checked += 1
+    return OK, "{0} block(s) checked".format(checked)
+
+
+def _full(backend, parts, checksums, is_enc=False, password=None, cancel=None):
+    status, detail = _quick(backend, parts, checksums)
+    if status != OK:
+        return status, detail
+    if not checksums and is_enc and not password:
+        return UNVERIFIED, "no recorded checksums and no password to decrypt the archive"
+
+    readers = []
+    for keyname, offset, size in parts:
+        reader = backend.download(keyname)
+        if not hasattr(reader, "read"):
+            return PENDING, "{0} is not available yet (retrieval job initiated)".format(keyname)
+        readers.append(reader)
+
+    if not checksums:
+        # No hashes recorded (backup made with an older version), check that the archive can be decoded.
+        stream = ChainReader(readers)
+        if is_enc:
+            stream = DecryptReader(stream, password)
+        stream = GzipStreamReader(stream)
+        try:
+            with closing(tarfile.open(fileobj=stream, mode="r|")) as tar:
+                members = 0
+                for member in tar:
+                    if cancel is not None and cancel.is_set():
+                        return UNVERIFIED, "cancelled"
+                    if member.isfile():
+                        f = tar.extractfile(member)
+                        while f.read(MEGABYTE):
+                            pass
+                    members += 1
+            # The gzip trailer is only checked at the end of the stream.
+            while stream.read(MEGABYTE):
+                pass
+        except Exception, exc:
+            return CORRUPTED, "can't decode the archive: {0}".format(exc)
+        finally:
+            stream.close()
+        return OK, "archive decoded ({0} members)".format(members)
+
+    block_size = checksums["block_size"]
+    for (keyname, offset, size), reader in zip(parts, readers):
+        try:
+            position = offset
+            while True:
+                if cancel is not None and cancel.is_set():
+                    return UNVERIFIED, "cancelled"
+                data = reader.read(block_size)
+                if not data:
+                    break
+                bad_block = _check_blocks(data, position, checksums)
+                if bad_block is not None:
+                    return CORRUPTED, "{0}: block {1} doesn't match".format(keyname, bad_block)
+                position += len(data)
+        finally:
+            reader.close()
+        if position - offset != size:
+            return CORRUPTED, "{0}: read {1} bytes, expected {2}".format(keyname, position - offset, size)
+    return OK, "{0} block(s) checked".format(len(checksums["blocks"]))
+
+
+def verify_backup(backend, backup, mode="quick", password=None, cancel=None):
+    """Verify a backup.
+
+    :type backend: BakthatBackend
+    :param backend: Storage backend.
+
+    :type backup: dict
+    :param backup: Backup dict (see bakthat.match_filename).
+
+    :type mode: str
+    :param mode: quick|spot|full
+
+    :rtype: dict
+    :return: A dict with key, status (ok, corrupted, missing, pending or unverified) and detail.
+
+    """
+    if mode not in VERIFY_MODES:
+        raise Exception("Invalid verify mode {0}, should be one of {1}".format(mode, ", ".join(VERIFY_MODES)))
+
+    if backup.get("shards"):
+        # Each shard is a standalone stream with its own checksums, the worst status is reported.
+        results = [verify_backup(backend, dict(backup, key=keyname, shards=None), mode, password, cancel)
+                   for keyname in backup["shards"]]
+        if len(results) != backup["num_shards"]:
+            results.append(dict(status=MISSING, detail="{0}/{1} shards missing".format(
+                backup["num_shards"] - len(results), backup["num_shards"])))
+        failed = [result for result in results if result["status"] != OK]
+        if failed:
+            return dict(key=backup["key"], status=failed[0]["status"],
+                        detail="; ".join(result["detail"] for result in failed))
+        return dict(key=backup["key"], status=OK, detail="{0} shards, {1}".format(len(results),
+                                                                                  results[0]["detail"]))
+
+    checksums = load_checksums(backend.container, backup["key"])
+    missing = missing_volumes(backup, checksums)
+    if missing:
+        return dict(key=backup["key"], status=MISSING, detail=missing)
+    parts = _stored_parts(backup, checksums)
+    try:
+        if mode == "quick":
+            status, detail = _quick(backend, parts, checksums)
+        elif mode == "spot":
+            status, detail = _spot(backend, parts, checksums)
+        else:
+            status, detail = _full(backend, parts, checksums, backup["is_enc"], password, cancel)
+    except Exception, exc:
+        log.exception(exc)
+        status, detail = UNVERIFIED, "error: {0}".format(exc)
+
+    return dict(key=backup["key"], status=status, detail=detail)
@@ -0,0 +1,160 @@
+# -*- encoding: utf-8 -*-
+"""Streaming parser for Glacier vault inventories.
+
+An inventory job output looks like:
+
+    {"VaultARN": "...", "InventoryDate": "...",
+     "ArchiveList": [{"ArchiveId": "...", "ArchiveDescription": "...",
+                      "CreationDate": "...", "Size": 1, "SHA256TreeHash": "..."}, ...]}
+
+For large vaults it's gigabytes of JSON, so archives are decoded one by one
+from a bounded buffer instead of loading the whole document.
+
+"""
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_LIST_KEY = '"ArchiveList"'
+WHITESPACE = " \t\n\r"
+# An archive entry is a few hundred bytes (the description is at most 1KB).
+MAX_ARCHIVE_SIZE = 64 * 1024
+
+
+class InventoryParseError(Exception):
+    pass
+
+
+def _object_end(buf, pos):
+    """Return the index after the JSON object starting at pos, None if it doesn't end in buf."""
+    depth = 0
+    in_string = escaped = False
+    for index in xrange(pos, len(buf)):
+        c = buf[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in "{[":
+            depth += 1
+        elif c in "}]":
+            depth -= 1
+            if not depth:
+                return index + 1
+    return None
+
+
+def iter_inventory(fileobj, chunk_size=64 * 1024):
+    """Yield the archives (dicts) of a Glacier inventory JSON stream.
+
+    :type fileobj: file
+    :param fileobj: Readable file-like object (e.g. the job output HTTP response).
+
+    :type chunk_size: int
+    :param chunk_size: Size of each read.
+
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+
+    def read_more():
+        data = fileobj.read(chunk_size)
+        if not data:
+            raise InventoryParseError("Unexpected end of inventory.")
+        return data
+
+    # Skip the header until the beginning of the archive list.
+    while True:
+        index = buf.find(ARCHIVE_LIST_KEY)
+        if index != -1:
+            start = buf.find("[", index)
+            if start != -1:
+                buf = buf[start + 1:]
+                break
+        else:
+            # Keep the tail in case the key is split across two reads.
+            buf = buf[-len(ARCHIVE_LIST_KEY):]
+        buf += read_more()
+
+    pos = 0
+    while True:
+        while pos < len(buf) and buf[pos] in WHITESPACE + ",":
+            pos += 1
+        if pos >= len(buf):
+            buf, pos = read_more(), 0
+            continue
+        if buf[pos] == "]":
+            return
+        try:
+            archive, end = decoder.raw_decode(buf, pos)
+        except ValueError, exc:
+            # Only an incomplete object is worth reading more, a malformed one would
+            # buffer the rest of the inventory.
+            if buf[pos] != "{" or _object_end(buf, pos) is not None:
+                raise InventoryParseError("Invalid archive entry: {0}".format(exc))
+            if len(buf) - pos > MAX_ARCHIVE_SIZE:
+                raise InventoryParseError("Archive entry larger than {0} bytes.".format(MAX_ARCHIVE_SIZE))
+            buf, pos = buf[pos:] + read_more(), 0
+            continue
+        pos = end
+        yield archive
+
+
+def reconcile(remote_archives, local_archives, batch_size=1000, merge=None):
+    """Compare a Glacier inventory with the local (filename => archive_id) inventory.
+
+    Remote archives are consumed one by one, memory usage only depends on the
+    size of the local inventory.
+
+    :type remote_archives: iterable
+    :param remote_archives: Archives dicts (see iter_inventory).
+
+    :type local_archives: dict
+    :param local_archives: Local inventory, filename => archive_id.
+
+    :type batch_size: int
+    :param batch_size: Number of archives missing locally passed to merge at once.
+
+    :type merge: callable
+    :param merge: Called with a dict filename => archive_id of archives missing in
+        the local inventory (the archive description is used as filename).
+
+    :rtype: dict
+    :return: A dict with the number of archives in the vault (total), the number of archives
+        missing locally (missing_locally) and the list of filenames missing in the vault (missing_in_vault).
+
+    """
+    local_ids = dict((archive_id, keyname) for keyname, archive_id in local_archives.items())
+    total = 0
+    missing_locally = 0
+    batch = {}
+
+    for archive in remote_archives:
+        total += 1
+        archive_id = archive["ArchiveId"]
+        if local_ids.pop(archive_id, None) is not None:
+            continue
+
+        missing_locally += 1
+        keyname = archive.get("ArchiveDescription")
+        log.info("Missing in local inventory: {0} ({1})".format(keyname, archive_id))
+        if merge and keyname and keyname not in local_archives:
+            batch[keyname] = archive_id
+            if len(batch) >= batch_size and merge:
+                merge(batch)
+                batch = {}
+
+    if batch:
+        merge(batch)
+
+    missing_in_vault = sorted(local_ids.values())
+    for keyname in missing_in_vault:
+        log.info("Missing in vault: {0}".format(keyname))
+
+    return dict(total=total, missing_locally=missing_locally, missing_in_vault=missing_in_vault)
@@ -0,0 +1,326 @@
+# -*- encoding: utf-8 -*-
+"""Parallel directory scanner feeding the tar writer.
+
+Directories are listed and their entries lstat'ed by a pool of threads (the
+syscalls release the GIL, that's where the time goes on network filesystems),
+excluded paths are never descended into nor read. The result is an ordered
+list (depth-first, sorted by name, like tarfile.add) of ScanEntry.
+
+"""
+import os
+import re
+import stat
+import logging
+import tarfile
+import threading
+import Queue
+from collections import namedtuple
+
+from bakthat.scheduler import ThrottledReader
+from bakthat.sparse import SegmentReader, SparseTarInfo, data_segments, has_holes
+from bakthat.stream import TeeReader
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SCAN_THREADS = 8
+
+ScanEntry = namedtuple("ScanEntry", ["path", "arcname", "stat"])
+
+
+def _translate(pattern):
+    """Translate a gitignore-style glob to a regex (without anchors)."""
+    regex = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == n:
+            regex.append("(?:/.*)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            regex.append(".*")
+            i += 2
+        elif c == "*":
+            regex.append("[^/]*")
+            i += 1
+        elif c == "?":
+            regex.append("[^/]")
+            i += 1
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                regex.append(re.escape(c))
+                i += 1
+            else:
+                chars = pattern[i + 1:end]
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                regex.append("[{0}]".format(chars))
+                i = end + 1
+        else:
+            regex.append(re.escape(c))
+            i += 1
+    return "".join(regex)
+
+
+class ExcludeRules(object):
+    """gitignore-style exclude/include rules.
+
+    - blank lines and lines starting with # are ignored
+    - a leading ! re-includes a path excluded by a previous pattern
+    - a trailing / only matches directories
+    - a pattern containing a / (other than a trailing one) is relative to the backup root,
+      otherwise it matches at any depth
+    - * and ? don't match /, ** matches any number of directories
+    - the last matching pattern wins
+
+    :type patterns: list
+    :param patterns: List of patterns.
+
+    """
+    def __init__(self, patterns=None):
+        self.rules = []
+        for pattern in patterns or []:
+            self.add(pattern)
+
+    def add(self, pattern):
+        pattern = pattern.strip()
+        if not pattern or pattern.startswith("#"):
+            return
+
+        include = pattern.startswith("!")
+        if include:
+            pattern = pattern[1:]
+        dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+
+        if "/" in pattern:
+            regex = "^" + _translate(pattern.lstrip("/")) + "$"
+        else:
+            regex = "^(?:.*/)?" + _translate(pattern) + "$"
+        self.rules.append((re.compile(regex), include, dir_only))
+
+    def __nonzero__(self):
+        return bool(self.rules)
+
+    def excluded(self, relpath, is_dir=False):
+        """Return True if the path (relative to the backup root, with / separators) is excluded."""
+        excluded = False
+        for regex, include, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relpath):
+                excluded = not include
+        return excluded
+
+
+class Scanner(object):
+    """List a directory tree with a pool of threads.
+
+    :type excludes: ExcludeRules
+    :param excludes: Exclude rules.
+
+    :type one_file_system: bool
+    :param one_file_system: Don't cross filesystem boundaries.
+
+    :type num_threads: int
+    :param num_threads: Number of threads listing/stat'ing directories.
+
+    """
+    def __init__(self, excludes=None, one_file_system=False, num_threads=DEFAULT_SCAN_THREADS):
+        self.excludes = excludes or ExcludeRules()
+        self.one_file_system = one_file_system
+        self.num_threads = num_threads
+
+    def _list_dir(self, path, relpath, root_dev):
+        """List a directory, return its sorted entries as (name, stat, relpath, descend)."""
+        try:
+            names = sorted(os.listdir(path))
+        except OSError, exc:
+            log.warning("Can't list {0}: {1}".format(path, exc))
+            return []
+
+        entries = []
+        for name in names:
+            child_relpath = relpath + "/" + name if relpath else name
+            try:
+                st = os.lstat(os.path.join(path, name))
+            except OSError, exc:
+                # Removed since the listing
+                log.warning("Can't stat {0}: {1}".format(os.path.join(path, name), exc))
+                continue
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if self.excludes and self.excludes.excluded(child_relpath, is_dir):
+                continue
+            descend = is_dir and not (self.one_file_system and st.st_dev != root_dev)
+            entries.append((name, st, child_relpath, descend))
+        return entries
+
+    def scan(self, root, arcname=None):
+        """Return the ordered list of ScanEntry for root (included) and everything below."""
+        root = root.rstrip("/") or "/"
+        if arcname is None:
+            arcname = os.path.basename(root)
+        root_stat = os.lstat(root)
+        if not stat.S_ISDIR(root_stat.st_mode):
+            return [ScanEntry(root, arcname, root_stat)]
+
+        listings = {}
+        work = Queue.Queue()
+        cond = threading.Condition()
+        state = dict(pending=1, error=None)
+
+        def worker():
+            while True:
+                item = work.get()
+                if item is None:
+                    return
+                path, relpath = item
+                try:
+                    entries = self._list_dir(path, relpath, root_stat.st_dev)
+                    listings[relpath] = entries
+                    children = [(os.path.join(path, name), child_relpath)
+                                for name, st, child_relpath, descend in entries if descend]
+                except Exception, exc:
+                    children = []
+                    state["error"] = exc
+                with cond:
+                    state["pending"] += len(children) - 1
+                    for child in children:
+                        work.put(child)
+                    cond.notify_all()
+
+        threads = [threading.Thread(target=worker) for i in range(self.num_threads)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        work.put((root, ""))
+        with cond:
+            while state["pending"]:
+                cond.wait(1)
+        for t in threads:
+            work.put(None)
+
+        if state["error"] is not None:
+            raise state["error"]
+
+        # Depth-first, pre-order, like tarfile.add.
+        result = [ScanEntry(root, arcname, root_stat)]
+        stack = [iter(listings[""])]
+        while stack:
+            try:
+                name, st, relpath, descend = next(stack[-1])
+            except StopIteration:
+                stack.pop()
+                continue
+            result.append(ScanEntry(os.path.join(root, relpath), arcname + "/" + relpath, st))
+            if descend:
+                stack.append(iter(listings[relpath]))
+        return result
+
+
+def total_size(entries):
+    """Size of the regular files of a scan, hardlinked files are counted once,
+    only the allocated blocks of sparse files are counted."""
+    size = 0
+    inodes = set()
+    for entry in entries:
+        if stat.S_ISREG(entry.stat.st_mode):
+            if entry.stat.st_nlink > 1:
+                inode = (entry.stat.st_dev, entry.stat.st_ino)
+                if inode in inodes:
+                    continue
+                inodes.add(inode)
+            if has_holes(entry.stat):
+                size += entry.stat.st_blocks * 512
+            else:
+                size += entry.stat.st_size
+    return size
+
+
+def _padded(size):
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+def archive_size(entries):
+    """Upper bound of the size of the tar archive of a scan, once compressed and encrypted
+    (used to choose the upload part sizes, Glacier uploads are limited to 10000 parts).
+
+    Each entry adds a header, GNU long name/link headers if needed and the padding of its
+    data; 1% is added for the sparse maps, the gzip framing of incompressible blocks and
+    the encryption.
+
+    """
+    size = total_size(entries)
+    longest = max([len(entry.arcname) for entry in entries] or [0])
+    for entry in entries:
+        size += tarfile.BLOCKSIZE
+        if len(entry.arcname) >= tarfile.LENGTH_NAME:
+            size += tarfile.BLOCKSIZE + _padded(len(entry.arcname) + 1)
+        linkname = 0
+        if stat.S_ISLNK(entry.stat.st_mode):
+            # st_size of a symlink is the length of its target.
+            linkname = entry.stat.st_size
+        elif stat.S_ISREG(entry.stat.st_mode):
+            size += tarfile.BLOCKSIZE - 1
+            if entry.stat.st_nlink > 1:
+                # Hardlinks are stored with the name of their target.
+                linkname = longest
+        if linkname >= tarfile.LENGTH_LINK:
+            size += tarfile.BLOCKSIZE + _padded(linkname + 1)
+    size += tarfile.RECORDSIZE
+    return size + size // 100
+
+
+def add_to_tar(tar, entries, tee=None):
+    """Add scanned entries to an open TarFile, in order, without recursion.
+
+    A file hardlinked to an already added file is stored as a link without
+    being opened, only the data segments of sparse files are read.
+
+    :type tee: file
+    :param tee: Writable object receiving the data of the regular files as it's
+        read (sparse files are then read whole, holes included).
+
+    """
+    for entry in entries:
+        if stat.S_ISREG(entry.stat.st_mode):
+            if entry.stat.st_nlink > 1 and (entry.stat.st_ino, entry.stat.st_dev) in tar.inodes:
+                try:
+                    tarinfo = tar.gettarinfo(entry.path, entry.arcname)
+                except OSError, exc:
+                    log.warning("Skipping {0}: {1}".format(entry.path, exc))
+                    continue
+                if tarinfo.islnk():
+                    tar.addfile(tarinfo)
+                    continue
+            try:
+                f = open(entry.path, "rb")
+            except IOError, exc:
+                log.warning("Skipping {0}: {1}".format(entry.path, exc))
+                continue
+            with f:
+                tarinfo = tar.gettarinfo(arcname=entry.arcname, fileobj=f)
+                segments = None
+                if tarinfo.isreg() and has_holes(entry.stat) and tee is None:
+                    segments = data_segments(f, tarinfo.size)
+                if segments is not None:
+                    log.debug("{0} is sparse ({1} data segments)".format(entry.path, len(segments)))
+                    tarinfo = SparseTarInfo.from_tarinfo(tarinfo, segments)
+                    tar.addfile(tarinfo, ThrottledReader(SegmentReader(f, segments)))
+                elif tee is not None:
+                    tar.addfile(tarinfo, TeeReader(ThrottledReader(f), tee))
+                else:
+                    tar.addfile(tarinfo, ThrottledReader(f))
+        else:
+            try:
+                tarinfo = tar.gettarinfo(entry.path, entry.arcname)
+            except OSError, exc:
+                log.warning("Skipping {0}: {1}".format(entry.path, exc))
+                continue
+            # Sockets and other unsupported types.
+            if tarinfo is not None:
+                tar.addfile(tarinfo)
@@ -0,0 +1,238 @@
+# -*- encoding: utf-8 -*-
+"""Process-wide bandwidth and I/O scheduler.
+
+Network transfers (uploaded parts, downloaded chunks, ranged reads) and
+disk reads (files being archived or scanned for a delta, cached backups)
+go through token buckets, so every backup, restore and verification of
+the process shares the configured rates. Each request has the priority of
+the command it belongs to (restore, then backup, then verify): while a
+command of higher priority is transferring, lower priority requests wait,
+they're served again once it has been idle for PREEMPT_IDLE seconds. A restore isn't slowed down by a
+nightly backup running in the same process.
+
+Requests are only delayed between parts/chunks/reads, never in the middle
+of an HTTP request. Rates are in MB/s (0 or missing for unlimited), set
+in a scheduler section in ~/.bakthat.conf or with BakHelper::
+
+    [scheduler]
+    network_rate = 10
+    disk_rate = 50
+    preempt = yes
+
+"""
+import time
+import logging
+import threading
+from functools import wraps
+
+from bakthat.conf import config
+
+log = logging.getLogger(__name__)
+
+MEGABYTE = 1024 * 1024
+
+NETWORK = "network"
+DISK = "disk"
+
+RESTORE = 0
+BACKUP = 1
+VERIFY = 2
+
+# Seconds a higher priority command keeps preempting the others after its last request.
+PREEMPT_IDLE = 2.0
+# Longest single wait, waiting requests re-check the bucket state at least that often.
+MAX_WAIT = 1.0
+
+
+class TokenBucket(object):
+    """Rate limit shared by several threads, requests are served by priority.
+
+    A request is served as soon as the bucket isn't empty, it may leave the
+    bucket in debt (parts are bigger than the burst with low rates): the
+    next requests wait until the debt is paid back.
+
+    :type rate: float
+    :param rate: Bytes per second, 0 for unlimited.
+
+    :type burst: int
+    :param burst: Bytes that can be consumed at once after an idle period (default: one second).
+
+    :type preempt: bool
+    :param preempt: Lower priority requests wait while a higher priority is active.
+
+    :type idle: float
+    :param idle: Seconds after which a priority is no longer active.
+
+    """
+    def __init__(self, rate=0, burst=None, preempt=True, idle=PREEMPT_IDLE, clock=time.time):
+        self.rate = rate
+        self.burst = burst or rate
+        self.preempt = preempt
+        self.idle = idle
+        self.clock = clock
+        self.tokens = self.burst
+        self._last_refill = clock()
+        self._waiting = {}
+        self._last_request = {}
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def _preempted_for(self, priority, now):
+        """Seconds to wait for higher priorities, 0 if the request can be served."""
+        if not self.preempt:
+            return 0
+        if any(count for other, count in self._waiting.items() if other < priority):
+            return MAX_WAIT
+        last = max([t for other, t in self._last_request.items() if other < priority] or [None])
+        if last is not None and now - last < self.idle:
+            return last + self.idle - now
+        return 0
+
+    def consume(self, nbytes, priority=BACKUP):
+        """Wait until nbytes can be transferred.
+
+        :type priority: int
+        :param priority: RESTORE|BACKUP|VERIFY (lower is served first).
+
+        """
+        if not self.rate and not self.preempt:
+            return
+        with self._cond:
+            self._waiting[priority] = self._waiting.get(priority, 0) + 1
+            try:
+                while True:
+                    now = self.clock()
+                    self._refill(now)
+                    wait = self._preempted_for(priority, now)
+                    if not wait:
+                        if not self.rate or self.tokens > 0:
+                            break
+                        wait = max(-self.tokens / self.rate, 0.001)
+                    self._cond.wait(min(wait, MAX_WAIT))
+                self.tokens -= nbytes
+                self._last_request[priority] = now
+            finally:
+                self._waiting[priority] -= 1
+                self._cond.notify_all()
+
+    def configure(self, rate=None, preempt=None):
+        with self._cond:
+            if rate is not None:
+                self.rate = self.burst = rate
+                self.tokens = min(self.tokens, self.burst)
+            if preempt is not None:
+                self.preempt = preempt
+            self._cond.notify_all()
+
+
+class Scheduler(object):
+    """Token buckets of the process (network and disk read).
+
+    :type network_rate: float
+    :param network_rate: Network bytes per second, 0 for unlimited.
+
+    :type disk_rate: float
+    :param disk_rate: Disk read bytes per second, 0 for unlimited.
+
+    :type preempt: bool
+    :param preempt: Higher priority commands preempt the others.
+
+    """
+    def __init__(self, network_rate=0, disk_rate=0, preempt=True):
+        self.buckets = {NETWORK: TokenBucket(network_rate, preempt=preempt),
+                        DISK: TokenBucket(disk_rate, preempt=preempt)}
+
+    def throttle(self, resource, nbytes, priority=None):
+        """Wait until nbytes of resource (NETWORK|DISK) can be used, with the priority
+        of the current thread by default (see with_priority)."""
+        if priority is None:
+            priority = current_priority()
+        self.buckets[resource].consume(nbytes, priority)
+
+    def configure(self, network_rate=None, disk_rate=None, preempt=None):
+        """Change the limits (running transfers are affected too), None to keep a limit."""
+        self.buckets[NETWORK].configure(network_rate, preempt)
+        self.buckets[DISK].configure(disk_rate, preempt)
+
+    def divide(self, count):
+        """Split the rates between count processes (sharded backup workers), each one keeps 1/count."""
+        for bucket in self.buckets.values():
+            if bucket.rate:
+                bucket.configure(bucket.rate / float(count))
+
+
+class ThrottledReader(object):
+    """Readable file-like object waiting for the scheduler after each read."""
+    def __init__(self, fileobj, resource=DISK, priority=None):
+        self.fileobj = fileobj
+        self.resource = resource
+        self.priority = priority if priority is not None else current_priority()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        get_scheduler().throttle(self.resource, len(data), self.priority)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+_local = threading.local()
+
+
+def current_priority():
+    """Priority of the command running in the current thread (BACKUP by default)."""
+    return getattr(_local, "priority", BACKUP)
+
+
+def with_priority(priority):
+    """Decorator running a command with the given priority in the current thread.
+
+    Transfers capture the priority when they are created, so the threads
+    they start inherit it.
+
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            previous = current_priority()
+            _local.priority = priority
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _local.priority = previous
+        return wrapper
+    return decorator
+
+
+def _config_rate(name):
+    if config.has_section("scheduler") and config.has_option("scheduler", name):
+        return float(config.get("scheduler", name)) * MEGABYTE
+    return 0
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Return the Scheduler of the process, configured from the scheduler section."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            preempt = True
+            if config.has_section("scheduler") and config.has_option("scheduler", "preempt"):
+                preempt = config.getboolean("scheduler", "preempt")
+            _scheduler = Scheduler(_config_rate("network_rate"), _config_rate("disk_rate"), preempt)
+        return _scheduler
+
+
+def configure(network_rate=None, disk_rate=None, preempt=None):
+    """Change the limits of the process scheduler (rates in MB/s, 0 for unlimited, None to keep a limit)."""
+    get_scheduler().configure(network_rate * MEGABYTE if network_rate is not None else None,
+                              disk_rate * MEGABYTE if disk_rate is not None else None,
+                              preempt)
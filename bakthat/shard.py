@@ -0,0 +1,143 @@
+# -*- encoding: utf-8 -*-
+"""Sharded archives of large directory trees.
+
+The scanned entries are split in independent tar archives: shard 0 holds
+the directories, symlinks and special files (it's tiny), the regular files
+are spread over the other shards, balanced by size. Each shard is built,
+compressed, encrypted and uploaded by its own worker process, so a backup
+uses several CPUs and connections at once. Restoring extracts shard 0
+first (every directory exists before the files are written), then the
+other shards in parallel, and finally sets the directories attributes.
+
+Shards are stored as <stored_filename>.shardNNNNofNNNN, and presented as a
+single backup (see bakthat.match_filename).
+
+"""
+import stat
+import heapq
+import logging
+import multiprocessing
+
+from bakthat.scheduler import get_scheduler
+from bakthat.sparse import has_holes
+
+log = logging.getLogger(__name__)
+
+SHARD_KEY_FMT = "{0}.shard{1:04d}of{2:04d}"
+# Seconds between checks of the workers (cancellation/errors).
+POLL_INTERVAL = 0.5
+
+# Set in the worker processes (see run_workers).
+_cancel = None
+
+
+def _entry_size(entry):
+    if has_holes(entry.stat):
+        return entry.stat.st_blocks * 512
+    return entry.stat.st_size
+
+
+def plan_shards(entries, num_shards):
+    """Split scanned entries in shards.
+
+    Files hardlinked together are kept in the same shard (a link is only
+    stored as such after its target), entries keep the scan order in each
+    shard. Empty shards are dropped.
+
+    :type entries: list
+    :param entries: ScanEntry list (see bakthat.scan.Scanner.scan).
+
+    :type num_shards: int
+    :param num_shards: Number of shards for the regular files.
+
+    :rtype: list
+    :return: Lists of entries, the first one holds every entry that isn't a regular file.
+
+    """
+    tree = []
+    groups = {}
+    for index, entry in enumerate(entries):
+        if not stat.S_ISREG(entry.stat.st_mode):
+            tree.append(entry)
+            continue
+        group_key = index
+        if entry.stat.st_nlink > 1:
+            group_key = (entry.stat.st_dev, entry.stat.st_ino)
+        if group_key in groups:
+            groups[group_key][1].append((index, entry))
+        else:
+            groups[group_key] = [_entry_size(entry), [(index, entry)]]
+
+    # Largest groups first, each one goes to the least loaded shard.
+    heap = [(0, i, []) for i in range(max(1, num_shards))]
+    for size, members in sorted(groups.values(), key=lambda group: group[0], reverse=True):
+        load, i, shard = heapq.heappop(heap)
+        shard.extend(members)
+        heapq.heappush(heap, (load + size, i, shard))
+
+    shards = [tree]
+    for load, i, shard in sorted(heap, key=lambda item: item[1]):
+        if shard:
+            shard.sort(key=lambda member: member[0])
+            shards.append([entry for index, entry in shard])
+    return shards
+
+
+def shard_keys(stored_filename, num_shards):
+    return [SHARD_KEY_FMT.format(stored_filename, index, num_shards) for index in range(num_shards)]
+
+
+def _init_worker(cancel, num_workers):
+    global _cancel
+    from Crypto import Random
+
+    # The RNG state is inherited from the parent, it must be reseeded (see EncryptWriter).
+    Random.atfork()
+    _cancel = cancel
+    # The rate limits are shared by the workers.
+    get_scheduler().divide(num_workers)
+
+
+def worker_cancel():
+    """Return the event set when a worker process should stop (see bakthat.stream.CancellableWriter)."""
+    return _cancel
+
+
+def run_workers(func, tasks, cancel=None, workers=None):
+    """Run func(task) for each task in a pool of worker processes.
+
+    Each task runs in its own process, up to workers at once (the
+    number of CPUs by default), the other tasks are queued. Once a task has failed or cancel is set, the other workers are asked
+    to stop (they should check worker_cancel()), every worker is waited for.
+
+    :type func: function
+    :param func: Module-level function (it's pickled).
+
+    :type cancel: threading.Event
+    :param cancel: Cancel the tasks once set.
+
+    :type workers: int
+    :param workers: Maximum number of worker processes.
+
+    :rtype: list
+    :return: multiprocessing AsyncResult of each task, all ready.
+
+    """
+    num_workers = max(1, min(len(tasks), workers or multiprocessing.cpu_count()))
+    workers_cancel = multiprocessing.Event()
+    pool = multiprocessing.Pool(num_workers, _init_worker, (workers_cancel, num_workers))
+    try:
+        results = [pool.apply_async(func, (task,)) for task in tasks]
+        pool.close()
+        pending = results
+        while pending:
+            if (cancel is not None and cancel.is_set()) or \
+                    any(result.ready() and not result.successful() for result in results):
+                workers_cancel.set()
+            pending[0].wait(POLL_INTERVAL)
+            pending = [result for result in pending if not result.ready()]
+        pool.join()
+    except:
+        pool.terminate()
+        raise
+    return results
@@ -0,0 +1,166 @@
+# -*- encoding: utf-8 -*-
+"""Sparse files support.
+
+The holes of a sparse file (VM images, database files...) are found with
+lseek(SEEK_DATA/SEEK_HOLE), only the data segments are read and stored.
+Sparse files are stored in the old GNU sparse format (supported by GNU tar
+and tarfile, which can't write it), SparseTarFile recreates the holes when
+extracting instead of writing zeros.
+
+"""
+import os
+import errno
+import tarfile
+
+# Not exposed by the os module on python 2.
+SEEK_DATA = getattr(os, "SEEK_DATA", 3)
+SEEK_HOLE = getattr(os, "SEEK_HOLE", 4)
+
+# Sparse map entries in the main header / in each extended header.
+HEADER_ENTRIES = 4
+EXTENDED_ENTRIES = 21
+
+
+def has_holes(st):
+    """Return True if the stat result looks like a sparse file (fewer blocks allocated than its size)."""
+    return st.st_size > 0 and st.st_blocks * 512 < st.st_size
+
+
+def data_segments(f, size):
+    """Return the data segments of a file as a list of (offset, size).
+
+    Returns None if the file has no holes or if the filesystem doesn't
+    support SEEK_DATA/SEEK_HOLE. A file ending with a hole gets a last
+    (size, 0) segment, like GNU tar.
+
+    :type f: file
+    :param f: File opened for reading.
+
+    :type size: int
+    :param size: File size.
+
+    """
+    fd = f.fileno()
+    segments = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError, exc:
+                # No data after offset
+                if exc.errno == errno.ENXIO:
+                    break
+                raise
+            if start >= size:
+                break
+            end = min(os.lseek(fd, start, SEEK_HOLE), size)
+            segments.append((start, end - start))
+            offset = end
+    except OSError:
+        return None
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+
+    if segments == [(0, size)]:
+        return None
+    if not segments or sum(segments[-1]) < size:
+        segments.append((size, 0))
+    return segments
+
+
+class SegmentReader(object):
+    """Read the data segments of a file back to back.
+
+    Exactly the sum of the segments sizes is returned, if the file shrank
+    since it was scanned, the missing data is replaced by zeros.
+
+    """
+    def __init__(self, f, segments):
+        self.f = f
+        self.segments = list(segments)
+        self._index = 0
+        self._left = self.segments[0][1] if self.segments else 0
+        if self.segments:
+            f.seek(self.segments[0][0])
+
+    def read(self, size):
+        chunks = []
+        while size > 0:
+            if self._left == 0:
+                self._index += 1
+                if self._index >= len(self.segments):
+                    break
+                offset, self._left = self.segments[self._index]
+                self.f.seek(offset)
+                continue
+
+            length = min(size, self._left)
+            data = self.f.read(length)
+            if len(data) < length:
+                data += "\0" * (length - len(data))
+            chunks.append(data)
+            self._left -= length
+            size -= length
+        return "".join(chunks)
+
+
+class SparseTarInfo(tarfile.TarInfo):
+    """TarInfo of a sparse file, size is the size of the stored data, realsize the file size."""
+    segments = None
+    realsize = 0
+
+    @classmethod
+    def from_tarinfo(cls, tarinfo, segments):
+        sparse = cls()
+        sparse.__dict__.update(tarinfo.__dict__)
+        sparse.type = tarfile.GNUTYPE_SPARSE
+        sparse.segments = segments
+        sparse.realsize = tarinfo.size
+        sparse.size = sum(size for offset, size in segments)
+        return sparse
+
+    @staticmethod
+    def _entries(segments):
+        return "".join(tarfile.itn(offset, 12, tarfile.GNU_FORMAT) + tarfile.itn(size, 12, tarfile.GNU_FORMAT)
+                       for offset, size in segments)
+
+    def tobuf(self, format=tarfile.DEFAULT_FORMAT, encoding=tarfile.ENCODING, errors="strict"):
+        if format != tarfile.GNU_FORMAT:
+            raise ValueError("sparse files can only be stored in the GNU format")
+        buf = tarfile.TarInfo.tobuf(self, format, encoding, errors)
+
+        # The main header is the last block (GNU long names blocks come first).
+        header = buf[-tarfile.BLOCKSIZE:]
+        extended = self.segments[HEADER_ENTRIES:]
+        header = (header[:386] + self._entries(self.segments[:HEADER_ENTRIES]).ljust(96, "\0") +
+                  ("\1" if extended else "\0") + tarfile.itn(self.realsize, 12, tarfile.GNU_FORMAT) +
+                  header[495:])
+        chksum = tarfile.calc_chksums(header)[0]
+        header = header[:148] + "%06o\0" % chksum + header[155:]
+
+        blocks = []
+        while extended:
+            entries, extended = extended[:EXTENDED_ENTRIES], extended[EXTENDED_ENTRIES:]
+            blocks.append(self._entries(entries).ljust(504, "\0") + ("\1" if extended else "\0") + "\0" * 7)
+        return buf[:-tarfile.BLOCKSIZE] + header + "".join(blocks)
+
+
+class SparseTarFile(tarfile.TarFile):
+    """TarFile recreating the holes of sparse members instead of writing zeros."""
+
+    def makefile(self, tarinfo, targetpath):
+        if getattr(tarinfo, "sparse", None) is None:
+            return tarfile.TarFile.makefile(self, tarinfo, targetpath)
+
+        source = self.extractfile(tarinfo)
+        try:
+            with open(targetpath, "wb") as target:
+                for section in tarinfo.sparse:
+                    if isinstance(section, tarfile._data) and section.size:
+                        source.seek(section.offset)
+                        target.seek(section.offset)
+                        tarfile.copyfileobj(source, target, section.size)
+                target.truncate(tarinfo.size)
+        finally:
+            source.close()
@@ -0,0 +1,178 @@
+# -*- encoding: utf-8 -*-
+"""Local state: Glacier inventory (archive ids and sizes), retrieval jobs,
+checksums catalog and delta signatures.
+
+The state is stored in a SQLite database shared by every bakthat process of
+the host. It's opened in WAL mode (readers never block the writer), every
+entry is its own row and writes are short IMMEDIATE transactions touching
+only the rows they change, so concurrent backups never lose each other's
+archive ids or job ids (shelve rewrote whole dicts without any locking).
+
+The legacy shelve file (~/.bakthat.db) is imported the first time.
+
+"""
+import os
+import logging
+import sqlite3
+import shelve
+import threading
+import cPickle as pickle
+from whichdb import whichdb
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+STATE_FILE = os.path.expanduser("~/.bakthat.sqlite")
+LEGACY_SHELVE_FILE = os.path.expanduser("~/.bakthat.db")
+
+# Seconds to wait for another process holding the write lock.
+DEFAULT_TIMEOUT = 60
+
+ARCHIVES = "archives"
+SIZES = "sizes"
+JOBS = "jobs"
+CHECKSUMS = "checksums"
+DELTAS = "deltas"
+META = "meta"
+
+
+class LocalState(object):
+    """Namespaced key/value store (values are pickled) backed by SQLite.
+
+    Each thread gets its own connection.
+
+    :type path: str
+    :param path: Database file.
+
+    :type timeout: int
+    :param timeout: Seconds to wait for the write lock before failing.
+
+    """
+    def __init__(self, path=STATE_FILE, timeout=DEFAULT_TIMEOUT, legacy_path=LEGACY_SHELVE_FILE):
+        self.path = path
+        self.timeout = timeout
+        self.legacy_path = legacy_path
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        con = getattr(self._local, "connection", None)
+        # A forked process (sharded backup worker) never uses its parent's connection.
+        if con is not None and self._local.pid != os.getpid():
+            con = None
+        if con is None:
+            # Transactions are handled explicitly (see transaction).
+            con = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            con.text_factory = str
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            con.execute("CREATE TABLE IF NOT EXISTS state (namespace TEXT NOT NULL, key TEXT NOT NULL, "
+                        "value BLOB NOT NULL, PRIMARY KEY (namespace, key))")
+            self._local.connection = con
+            self._local.pid = os.getpid()
+            self._migrate()
+        return con
+
+    @contextmanager
+    def transaction(self):
+        """Write transaction, the write lock is held until the block exits."""
+        con = self.connection
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            yield con
+        except:
+            con.execute("ROLLBACK")
+            raise
+        con.execute("COMMIT")
+
+    def close(self):
+        con = getattr(self._local, "connection", None)
+        if con is not None:
+            con.close()
+            self._local.connection = None
+
+    def get(self, namespace, key, default=None):
+        row = self.connection.execute("SELECT value FROM state WHERE namespace = ? AND key = ?",
+                                      (namespace, key)).fetchone()
+        if row is None:
+            return default
+        return pickle.loads(str(row[0]))
+
+    def all(self, namespace):
+        """Return the whole namespace as a dict."""
+        rows = self.connection.execute("SELECT key, value FROM state WHERE namespace = ?", (namespace,))
+        return dict((key, pickle.loads(str(value))) for key, value in rows)
+
+    def keys(self, namespace):
+        return [key for key, in self.connection.execute("SELECT key FROM state WHERE namespace = ?",
+                                                        (namespace,))]
+
+    def _set(self, con, entries):
+        con.executemany("INSERT OR REPLACE INTO state (namespace, key, value) VALUES (?, ?, ?)",
+                        [(namespace, key, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+                         for namespace, key, value in entries])
+
+    def set(self, namespace, key, value):
+        self.set_many([(namespace, key, value)])
+
+    def set_many(self, entries):
+        """Set several (namespace, key, value) entries in a single transaction."""
+        with self.transaction() as con:
+            self._set(con, entries)
+
+    def update(self, namespace, items):
+        """Set several entries of a namespace in a single transaction."""
+        self.set_many((namespace, key, value) for key, value in items.iteritems())
+
+    def replace(self, namespace, items):
+        """Replace the whole namespace."""
+        with self.transaction() as con:
+            con.execute("DELETE FROM state WHERE namespace = ?", (namespace,))
+            self._set(con, ((namespace, key, value) for key, value in items.iteritems()))
+
+    def delete(self, namespace, keys):
+        with self.transaction() as con:
+            con.executemany("DELETE FROM state WHERE namespace = ? AND key = ?",
+                            [(namespace, key) for key in keys])
+
+    def _migrate(self):
+        """Import the legacy shelve file, once."""
+        if self.get(META, "migrated"):
+            return
+        with self.transaction() as con:
+            # Another process may have done it while we were waiting for the lock.
+            if con.execute("SELECT 1 FROM state WHERE namespace = ? AND key = ?",
+                           (META, "migrated")).fetchone():
+                return
+            # Depending on the dbm module, shelve files may get a .db/.dir/.dat suffix.
+            if self.legacy_path and whichdb(self.legacy_path):
+                log.info("Importing {0} in {1}".format(self.legacy_path, self.path))
+                try:
+                    legacy = shelve.open(self.legacy_path, "r")
+                except Exception, exc:
+                    log.warning("Can't import {0}: {1}".format(self.legacy_path, exc))
+                else:
+                    try:
+                        for key in legacy.keys():
+                            if key in (ARCHIVES, SIZES, JOBS):
+                                self._set(con, ((key, k, v) for k, v in legacy[key].iteritems()))
+                            elif key.startswith(CHECKSUMS + ":"):
+                                self._set(con, [(CHECKSUMS, key[len(CHECKSUMS) + 1:], legacy[key])])
+                            else:
+                                self._set(con, [(META, key, legacy[key])])
+                    finally:
+                        legacy.close()
+            self._set(con, [(META, "migrated", True)])
+
+
+_state = None
+_state_lock = threading.Lock()
+
+
+def get_state():
+    """Return the default (shared) LocalState."""
+    global _state
+    with _state_lock:
+        if _state is None:
+            _state = LocalState()
+        return _state
@@ -0,0 +1,291 @@
+# -*- encoding: utf-8 -*-
+"""File-like building blocks for the backup/restore pipeline.
+
+Every stage wraps another file-like object, so data can flow from the
+storage backend to tarfile (and the other way around) without being
+written to a temporary file first.
+
+"""
+import logging
+import random
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+BLOWFISH_BLOCK_SIZE = 8
+
+
+class BufferedReader(object):
+    """Base class for read-only streams, subclasses implement _fill.
+
+    _fill must return the next chunk of data, or an empty string once
+    the stream is exhausted.
+
+    """
+    def __init__(self):
+        self._chunks = deque()
+        # Bytes of the first chunk already read.
+        self._offset = 0
+        self._buffered = 0
+        self._eof = False
+
+    def _fill(self):
+        raise NotImplementedError
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or self._buffered < size):
+            data = self._fill()
+            if data:
+                self._chunks.append(data)
+                self._buffered += len(data)
+            else:
+                self._eof = True
+
+        if size < 0 or size > self._buffered:
+            size = self._buffered
+        # Small reads from big chunks only copy what's returned.
+        parts = []
+        needed = size
+        while needed:
+            chunk = self._chunks[0]
+            available = len(chunk) - self._offset
+            if available <= needed:
+                parts.append(chunk[self._offset:] if self._offset else chunk)
+                self._chunks.popleft()
+                self._offset = 0
+                needed -= available
+            else:
+                parts.append(chunk[self._offset:self._offset + needed])
+                self._offset += needed
+                needed = 0
+        self._buffered -= size
+        return parts[0] if len(parts) == 1 else "".join(parts)
+
+    def close(self):
+        pass
+
+
+class ChainReader(BufferedReader):
+    """Read several file-like objects one after the other.
+
+    :type readers: iterable
+    :param readers: File-like objects, or callables returning one,
+        callables are only called when the reader is needed.
+
+    :type prefetch: int
+    :param prefetch: Number of upcoming readers started in advance (readers
+        with a start method, like ChunkedDownloader, begin fetching data).
+
+    """
+    def __init__(self, readers, prefetch=0):
+        BufferedReader.__init__(self)
+        self.readers = iter(readers)
+        self.prefetch = prefetch
+        self.upcoming = []
+        self.current = None
+
+    def _next_reader(self):
+        reader = next(self.readers)
+        return reader() if callable(reader) else reader
+
+    def start(self):
+        """Open and start the current reader and the prefetched ones."""
+        try:
+            while len(self.upcoming) < self.prefetch + 1:
+                self.upcoming.append(self._next_reader())
+        except StopIteration:
+            pass
+        for reader in self.upcoming:
+            if hasattr(reader, "start"):
+                reader.start()
+
+    def _fill(self):
+        while True:
+            if self.current is None:
+                self.start()
+                if not self.upcoming:
+                    return ""
+                self.current = self.upcoming.pop(0)
+
+            data = self.current.read(1024 * 1024)
+            if data:
+                return data
+
+            self.current.close()
+            self.current = None
+
+    def close(self):
+        for reader in [self.current] + self.upcoming:
+            if reader is not None:
+                reader.close()
+
+
+class DecryptReader(BufferedReader):
+    """Decrypt on the fly a stream encrypted with beefish (Blowfish CBC).
+
+    The last block is held back until the end of the stream to strip the padding.
+
+    :type fileobj: file
+    :param fileobj: Encrypted stream.
+
+    :type password: str
+    :param password: Password used for encryption.
+
+    """
+    def __init__(self, fileobj, password, chunk_size=64 * 1024):
+        BufferedReader.__init__(self)
+        from Crypto.Cipher import Blowfish
+
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        iv = fileobj.read(BLOWFISH_BLOCK_SIZE)
+        self.cipher = Blowfish.new(password, Blowfish.MODE_CBC, iv)
+        self._pending = ""
+        self._held = ""
+
+    def _fill(self):
+        while True:
+            data = self.fileobj.read(self.chunk_size)
+            if not data:
+                if self._pending:
+                    raise IOError("Truncated encrypted stream.")
+                held, self._held = self._held, ""
+                if not held:
+                    return ""
+                padding = (ord(held[-1]) % BLOWFISH_BLOCK_SIZE) or BLOWFISH_BLOCK_SIZE
+                return held[:-padding]
+
+            data = self._pending + data
+            usable = len(data) - len(data) % BLOWFISH_BLOCK_SIZE
+            self._pending = data[usable:]
+            if not usable:
+                continue
+
+            plain = self._held + self.cipher.decrypt(data[:usable])
+            self._held = plain[-BLOWFISH_BLOCK_SIZE:]
+            if len(plain) > BLOWFISH_BLOCK_SIZE:
+                return plain[:-BLOWFISH_BLOCK_SIZE]
+
+    def close(self):
+        self.fileobj.close()
+
+
+class EncryptWriter(object):
+    """Encrypt on the fly with beefish format (Blowfish CBC), closing it closes fileobj.
+
+    :type fileobj: file
+    :param fileobj: Writable file-like object receiving the encrypted data.
+
+    :type password: str
+    :param password: Password used for encryption.
+
+    """
+    def __init__(self, fileobj, password):
+        from Crypto.Cipher import Blowfish
+        from Crypto import Random
+
+        self.fileobj = fileobj
+        self._get_random_bytes = Random.get_random_bytes
+        iv = Random.get_random_bytes(BLOWFISH_BLOCK_SIZE)
+        self.cipher = Blowfish.new(password, Blowfish.MODE_CBC, iv)
+        self.fileobj.write(iv)
+        self._pending = ""
+
+    def write(self, data):
+        data = self._pending + data
+        usable = len(data) - len(data) % BLOWFISH_BLOCK_SIZE
+        if usable:
+            self.fileobj.write(self.cipher.encrypt(data[:usable]))
+        self._pending = data[usable:]
+
+    def _padding(self):
+        # Same padding scheme as beefish, the last byte gives the padding length.
+        pad_bytes = BLOWFISH_BLOCK_SIZE - len(self._pending)
+        flag = random.randrange(BLOWFISH_BLOCK_SIZE - 2, 256 - BLOWFISH_BLOCK_SIZE)
+        flag -= flag % BLOWFISH_BLOCK_SIZE - pad_bytes
+        return self._get_random_bytes(pad_bytes - 1) + chr(flag)
+
+    def close(self):
+        self.fileobj.write(self.cipher.encrypt(self._pending + self._padding()))
+        self._pending = ""
+        return self.fileobj.close()
+
+    def abort(self):
+        self.fileobj.abort()
+
+
+class Cancelled(Exception):
+    """Raised when a backup/restore is cancelled (see bakthat.tasks)."""
+
+
+class CancellableWriter(object):
+    """Raise Cancelled on the next write once cancel is set, aborting is left to the caller.
+
+    :type fileobj: file
+    :param fileobj: Writable file-like object.
+
+    :type cancel: threading.Event
+    :param cancel: Cancellation event.
+
+    """
+    def __init__(self, fileobj, cancel):
+        self.fileobj = fileobj
+        self.cancel = cancel
+
+    def _check(self):
+        if self.cancel.is_set():
+            raise Cancelled("Cancelled")
+
+    def write(self, data):
+        self._check()
+        self.fileobj.write(data)
+
+    def close(self):
+        self._check()
+        return self.fileobj.close()
+
+    def abort(self):
+        self.fileobj.abort()
+
+
+class TeeReader(object):
+    """Readable file-like object writing the data read to out (e.g. to hash it in the same pass)."""
+    def __init__(self, fileobj, out):
+        self.fileobj = fileobj
+        self.out = out
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.out.write(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+class CancellableReader(BufferedReader):
+    """Raise Cancelled on the next read once cancel is set."""
+    def __init__(self, fileobj, cancel, chunk_size=1024 * 1024):
+        BufferedReader.__init__(self)
+        self.fileobj = fileobj
+        self.cancel = cancel
+        self.chunk_size = chunk_size
+
+    def _fill(self):
+        if self.cancel.is_set():
+            raise Cancelled("Cancelled")
+        return self.fileobj.read(self.chunk_size)
+
+    def close(self):
+        self.fileobj.close()
+
+
+def copy_stream(src, dst, chunk_size=1024 * 1024):
+    """Copy src file-like object to dst, return the number of bytes copied."""
+    copied = 0
+    while True:
+        data = src.read(chunk_size)
+        if not data:
+            return copied
+        dst.write(data)
+        copied += len(data)
@@ -0,0 +1,223 @@
+# -*- encoding: utf-8 -*-
+"""Asynchronous API: backups, restores and listings running in the background.
+
+The a* variants (abackup, arestore, als) return immediately with a Task,
+a minimal future executed by a pool of worker threads. Transfers and
+compression/encryption release the GIL, so one process can drive dozens of
+backups at the same time.
+
+A Task can be cancelled even once started: the pipeline checks the cancel
+event between chunks, then aborts the uploads (multipart uploads are
+cancelled, uploaded volumes deleted) or stops the download threads.
+
+    >>> from bakthat.tasks import abackup, wait
+    >>> tasks = [abackup(path, destination="s3", password="") for path in paths]
+    >>> results = [task.result() for task in wait(tasks)]
+
+"""
+import logging
+import threading
+import Queue
+
+import bakthat
+from bakthat.stream import Cancelled
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 16
+
+
+class Task(object):
+    """Result of a background call.
+
+    :type func: callable
+    :param func: Function to call, it receives the cancel event as the cancel keyword
+        argument if cancellable is True.
+
+    """
+    def __init__(self, func, args=(), kwargs=None, cancellable=True):
+        self.func = func
+        self.args = args
+        self.kwargs = dict(kwargs or {})
+        self.cancel_event = threading.Event()
+        if cancellable:
+            self.kwargs["cancel"] = self.cancel_event
+
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def run(self):
+        """Run the task in the current thread (called by TaskPool workers)."""
+        if self.cancel_event.is_set():
+            return self._set_result(exception=Cancelled("Cancelled before start"))
+        try:
+            result = self.func(*self.args, **self.kwargs)
+        except Exception, exc:
+            if not isinstance(exc, Cancelled):
+                log.exception(exc)
+            return self._set_result(exception=exc)
+        self._set_result(result)
+
+    def _set_result(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception, exc:
+            log.exception(exc)
+
+    def cancel(self):
+        """Request cancellation, return False if the task is already done."""
+        self.cancel_event.set()
+        return not self.done()
+
+    def cancelled(self):
+        return self.done() and isinstance(self._exception, Cancelled)
+
+    def done(self):
+        return self._done.is_set()
+
+    def add_done_callback(self, callback):
+        """Call callback(task) once the task is done (from the worker thread)."""
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def exception(self, timeout=None):
+        """Wait for the task, return its exception (None if it succeeded)."""
+        # Event.wait without timeout can't be interrupted by KeyboardInterrupt.
+        while not self._done.wait(timeout if timeout is not None else 1):
+            if timeout is not None:
+                raise RuntimeError("Task not completed after {0}s".format(timeout))
+        return self._exception
+
+    def result(self, timeout=None):
+        """Wait for the task and return its result, or raise its exception."""
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+
+class TaskPool(object):
+    """Pool of worker threads running Tasks, threads are started on demand.
+
+    :type max_workers: int
+    :param max_workers: Max number of tasks running at the same time, the others are queued.
+
+    """
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+        self._work = Queue.Queue()
+        self._threads = []
+        self._idle = 0
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def _worker(self):
+        while True:
+            task = self._work.get()
+            if task is None:
+                return
+            with self._lock:
+                self._idle -= 1
+            try:
+                task.run()
+            finally:
+                with self._lock:
+                    self._idle += 1
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule func(*args, cancel=<event>, **kwargs), return a Task."""
+        return self.submit_task(Task(func, args, kwargs))
+
+    def submit_task(self, task):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("TaskPool is shut down")
+            # Idle workers may not have picked the already queued tasks yet.
+            if self._idle <= self._work.qsize() and len(self._threads) < self.max_workers:
+                t = threading.Thread(target=self._worker)
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+                self._idle += 1
+        self._work.put(task)
+        return task
+
+    def shutdown(self, wait=True, cancel=False):
+        """Stop the workers once the queued tasks are done (cancel them first if cancel is True)."""
+        with self._lock:
+            self._shutdown = True
+        if cancel:
+            try:
+                while True:
+                    task = self._work.get_nowait()
+                    if task is not None:
+                        task.cancel()
+                        task.run()
+            except Queue.Empty:
+                pass
+        for t in self._threads:
+            self._work.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the default (shared) TaskPool."""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = TaskPool()
+        return _default_pool
+
+
+def wait(tasks, timeout=None):
+    """Wait for all the tasks, return them."""
+    for task in tasks:
+        task.exception(timeout)
+    return tasks
+
+
+def abackup(filename=None, destination=None, pool=None, **kwargs):
+    """Run bakthat.backup in the background, return a Task (see bakthat.backup for the arguments).
+
+    The password must be given (empty string to disable encryption), there's no prompt.
+
+    """
+    kwargs.setdefault("prompt", "no")
+    return (pool or get_pool()).submit(bakthat.backup, filename, destination, **kwargs)
+
+
+def arestore(filename, destination=None, pool=None, **kwargs):
+    """Run bakthat.restore in the background, return a Task (see bakthat.restore for the arguments).
+
+    The password must be given for encrypted backups, there's no prompt.
+
+    """
+    kwargs.setdefault("prompt", "no")
+    return (pool or get_pool()).submit(bakthat.restore, filename, destination, **kwargs)
+
+
+def als(destination=None, pool=None, **kwargs):
+    """Run bakthat.ls in the background, return a Task."""
+    task = Task(bakthat.ls, (destination,), kwargs, cancellable=False)
+    return (pool or get_pool()).submit_task(task)
@@ -0,0 +1,736 @@
+# -*- encoding: utf-8 -*-
+"""Concurrent transfer engines shared by the storage backends."""
+import logging
+import hashlib
+import socket
+import httplib
+import threading
+import time
+import Queue
+
+from bakthat.scheduler import NETWORK, current_priority, get_scheduler
+from bakthat.stream import BufferedReader
+
+log = logging.getLogger(__name__)
+
+MEGABYTE = 1024 * 1024
+DEFAULT_CHUNK_SIZE = 4 * MEGABYTE
+DEFAULT_NUM_THREADS = 4
+MAX_NUM_THREADS = 32
+DEFAULT_MEMORY_LIMIT = 256 * MEGABYTE
+RETRY_EXCEPTIONS = (socket.error, httplib.IncompleteRead, httplib.BadStatusLine)
+MAX_RETRIES = 5
+
+# Parts transferred faster than that are mostly request overhead,
+# slower ones are expensive to retry.
+FAST_PART_SECONDS = 1
+SLOW_PART_SECONDS = 30
+# Throughput gain required to keep adding parts in flight.
+RATE_GAIN = 0.05
+
+
+def with_retries(func, *args, **kwargs):
+    """Call func, retrying up to MAX_RETRIES times on network errors.
+
+    The on_error keyword argument (not passed to func) is called with each network error.
+
+    """
+    on_error = kwargs.pop("on_error", None)
+    for attempt in range(MAX_RETRIES):
+        try:
+            return func(*args, **kwargs)
+        except RETRY_EXCEPTIONS, exc:
+            log.warning("Transfer error ({0}), retrying ({1}/{2})".format(exc, attempt + 1, MAX_RETRIES))
+            if on_error is not None:
+                on_error(exc)
+    raise exc
+
+
+class TransferController(object):
+    """AIMD controller of the number of parts in flight and of the part size.
+
+    Completed parts are grouped in windows of limit parts. At the end of a
+    window, the limit grows by one if the throughput improved by RATE_GAIN
+    (additive increase), a network error halves it right away (multiplicative
+    decrease, once per window). The part size doubles while parts take less
+    than FAST_PART_SECONDS and halves when they take more than
+    SLOW_PART_SECONDS. limit * part_size never exceeds memory_limit.
+
+    A controller can be shared by several transfers (e.g. all the uploads of
+    a backend), the limit then applies to all of them. Writers also reserve
+    the bytes of their parts until they're uploaded (see reserve), so parts
+    bigger than part_size don't exceed memory_limit.
+
+    :type concurrency: int
+    :param concurrency: Initial number of parts in flight.
+
+    :type part_size: int
+    :param part_size: Initial part size.
+
+    :type min_part_size: int
+    :param min_part_size: Smallest part size (default to part_size).
+
+    :type max_part_size: int
+    :param max_part_size: Biggest part size (default to part_size).
+
+    :type memory_limit: int
+    :param memory_limit: Max bytes in flight.
+
+    """
+    def __init__(self, concurrency=DEFAULT_NUM_THREADS, part_size=DEFAULT_CHUNK_SIZE, min_part_size=None,
+                 max_part_size=None, max_concurrency=MAX_NUM_THREADS, memory_limit=DEFAULT_MEMORY_LIMIT,
+                 clock=time.time):
+        self.part_size = part_size
+        self.min_part_size = min_part_size or part_size
+        self.max_part_size = max_part_size or part_size
+        self.max_concurrency = max_concurrency
+        self.memory_limit = memory_limit
+        self.clock = clock
+        self.limit = min(max(1, concurrency), self._max_limit())
+        self.in_flight = 0
+        self.reserved = 0
+        self._cond = threading.Condition()
+        self._last_rate = None
+        self._reset_window()
+
+    def _max_limit(self):
+        return max(1, min(self.max_concurrency, self.memory_limit // self.part_size))
+
+    def _reset_window(self):
+        self._window_start = self.clock()
+        self._window_bytes = 0
+        self._window_parts = 0
+        self._window_seconds = 0.0
+        self._window_error = False
+
+    def acquire(self):
+        """Wait for a slot to transfer a part."""
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait(1)
+            self.in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def reserve(self, nbytes):
+        """Wait until nbytes more fit in memory_limit (a single part always fits),
+        for data held until unreserve."""
+        with self._cond:
+            while self.reserved and self.reserved + nbytes > self.memory_limit:
+                self._cond.wait(1)
+            self.reserved += nbytes
+
+    def unreserve(self, nbytes):
+        with self._cond:
+            self.reserved -= nbytes
+            self._cond.notify_all()
+
+    def success(self, nbytes, seconds):
+        """Record a transferred part."""
+        with self._cond:
+            self._window_bytes += nbytes
+            self._window_parts += 1
+            self._window_seconds += seconds
+            if self._window_parts >= self.limit:
+                self._adjust()
+            self._cond.notify_all()
+
+    def error(self, exc=None):
+        """Record a network error (the part is retried)."""
+        with self._cond:
+            if not self._window_error:
+                self._window_error = True
+                self.limit = max(1, self.limit // 2)
+                self._last_rate = None
+                log.debug("Transfer error, {0} parts in flight".format(self.limit))
+
+    def _adjust(self):
+        rate = self._window_bytes / max(self.clock() - self._window_start, 1e-6)
+        part_seconds = self._window_seconds / self._window_parts
+        if not self._window_error:
+            if (part_seconds < FAST_PART_SECONDS and self.part_size * 2 <= self.max_part_size and
+                    self.limit * self.part_size * 2 <= self.memory_limit):
+                self.part_size *= 2
+            elif part_seconds > SLOW_PART_SECONDS and self.part_size // 2 >= self.min_part_size:
+                self.part_size //= 2
+            if self._last_rate is None or rate > self._last_rate * (1 + RATE_GAIN):
+                self.limit += 1
+        self.limit = min(self.limit, self._max_limit())
+        self._last_rate = rate
+        self._reset_window()
+        log.debug("{0:.1f}MB/s, {1} parts of {2}MB in flight".format(rate / MEGABYTE, self.limit,
+                                                                     self.part_size // MEGABYTE))
+
+    def transfer(self, func, nbytes, *args):
+        """Call func(*args) in a slot, with retries, and record it (nbytes transferred)."""
+        self.acquire()
+        try:
+            start = self.clock()
+            result = with_retries(func, *args, on_error=self.error)
+            self.success(nbytes if nbytes is not None else len(result), self.clock() - start)
+            return result
+        finally:
+            self.release()
+
+
+class ChunkedDownloader(BufferedReader):
+    """File-like object fetching a remote object with concurrent ranged requests.
+
+    Chunks are fetched by a pool of threads but returned in order; at most
+    max_ahead chunks (twice the controller limit by default) are kept in
+    memory ahead of the reader. The number of requests in flight and the
+    chunk size are adjusted by the controller while downloading, chunks
+    stay aligned on their size.
+
+    :type fetch: callable
+    :param fetch: fetch(start, end) returns the data for the (inclusive) byte range.
+
+    :type size: int
+    :param size: Total size of the object.
+
+    :type chunk_size: int
+    :param chunk_size: Size of each ranged request (if no controller is given).
+
+    :type num_threads: int
+    :param num_threads: Initial number of concurrent requests (if no controller is given).
+
+    :type controller: TransferController
+    :param controller: Controller shared with other transfers.
+
+    """
+    def __init__(self, fetch, size, chunk_size=DEFAULT_CHUNK_SIZE,
+                 num_threads=DEFAULT_NUM_THREADS, max_ahead=None, controller=None):
+        BufferedReader.__init__(self)
+        self.fetch = fetch
+        self.size = size
+        self.controller = controller or TransferController(num_threads, chunk_size)
+        self.chunk_size = self.controller.part_size
+        self.max_ahead = max_ahead
+        # Chunks are fetched by worker threads, with the priority of the command.
+        self.priority = current_priority()
+
+        self._results = {}
+        self._error = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._next_index = 0
+        self._queued = 0
+        self._queued_offset = 0
+        self._work = Queue.Queue()
+        self._threads = []
+        self._started = False
+
+    def start(self):
+        """Start fetching chunks, called on first read if not called before."""
+        if self._started or self._closed:
+            return
+        self._started = True
+        self._queue_chunks()
+
+    def _queue_chunks(self):
+        max_ahead = self.max_ahead or self.controller.limit * 2
+        while self._queued_offset < self.size and self._queued < self._next_index + max_ahead:
+            chunk_size = self.controller.part_size
+            # A bigger chunk size is only used once aligned (Glacier tree hashes).
+            if self._queued_offset % chunk_size:
+                chunk_size = self.chunk_size
+            self.chunk_size = chunk_size
+            start = self._queued_offset
+            end = min(start + chunk_size, self.size) - 1
+            self._work.put((self._queued, start, end))
+            self._queued += 1
+            self._queued_offset = end + 1
+
+        pending = self._queued - self._next_index
+        while len(self._threads) < min(self.controller.limit, pending):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _worker(self):
+        while True:
+            item = self._work.get()
+            if item is None:
+                return
+            index, start, end = item
+            try:
+                get_scheduler().throttle(NETWORK, end - start + 1, self.priority)
+                data = self.controller.transfer(self.fetch, end - start + 1, start, end)
+                if len(data) != end - start + 1:
+                    raise IOError("Expected {0} bytes for range {1}-{2}, got {3}".format(end - start + 1,
+                                                                                        start, end, len(data)))
+            except Exception, exc:
+                with self._cond:
+                    self._error = exc
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self._results[index] = data
+                self._cond.notify_all()
+
+    def _fill(self):
+        if self._queued_offset >= self.size and self._next_index >= self._queued:
+            self.close()
+            return ""
+        self.start()
+
+        with self._cond:
+            while self._next_index not in self._results:
+                if self._error is not None:
+                    self.close()
+                    raise self._error
+                self._cond.wait(1)
+            data = self._results.pop(self._next_index)
+
+        self._next_index += 1
+        self._queue_chunks()
+        return data
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            try:
+                while True:
+                    self._work.get_nowait()
+            except Queue.Empty:
+                pass
+            for t in self._threads:
+                self._work.put(None)
+
+
+class ConcurrentPartWriter(object):
+    """Writable file-like object uploading parts from a pool of threads.
+
+    The number of parts in flight is adjusted by the controller, parts are
+    only queued once their bytes are reserved on the controller, so memory
+    usage stays under the controller memory limit plus the part being
+    buffered, whatever the size of the stream and of the parts. Subclasses
+    implement _upload_part (called from the workers), _complete and _abort.
+
+    :type on_complete: callable
+    :param on_complete: Called with the result of _complete and the total size.
+
+    :type controller: TransferController
+    :param controller: Controller shared with other transfers (default to a
+        controller for this upload only, with a fixed part size).
+
+    """
+    def __init__(self, part_size, num_threads=DEFAULT_NUM_THREADS, on_complete=None, controller=None):
+        self.part_size = part_size
+        self.num_threads = num_threads
+        self.on_complete = on_complete
+        self.controller = controller or TransferController(num_threads, part_size)
+        self.priority = current_priority()
+        self.size = 0
+        self.uploaded = 0
+        self._chunks = []
+        self._buffered = 0
+        self._next_index = 0
+        self._error = None
+        self._closed = False
+        self._work = Queue.Queue(maxsize=num_threads)
+        self._threads = []
+        self._start_workers()
+
+    def _start_workers(self):
+        while len(self._threads) < self.controller.limit:
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _upload_part(self, index, data):
+        raise NotImplementedError
+
+    def _complete(self):
+        raise NotImplementedError
+
+    def _abort(self):
+        pass
+
+    def _worker(self):
+        while True:
+            work = self._work.get()
+            try:
+                if work is None:
+                    return
+                index, data = work
+                try:
+                    if self._error is None:
+                        get_scheduler().throttle(NETWORK, len(data), self.priority)
+                        self.controller.transfer(self._upload_part, len(data), index, data)
+                        self.uploaded += len(data)
+                finally:
+                    self.controller.unreserve(len(data))
+                    # Not held while waiting for the next part.
+                    work = data = None
+            except Exception, exc:
+                log.exception(exc)
+                self._error = exc
+            finally:
+                self._work.task_done()
+
+    def _submit(self, data):
+        if self._error is not None:
+            raise self._error
+        if not self._closed:
+            self._start_workers()
+        self.controller.reserve(len(data))
+        self._work.put((self._next_index, data))
+        self._next_index += 1
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._buffered += len(data)
+        self.size += len(data)
+        if self._buffered >= self.part_size:
+            data = "".join(self._chunks)
+            while len(data) >= self.part_size:
+                self._submit(data[:self.part_size])
+                data = data[self.part_size:]
+            self._chunks, self._buffered = [data], len(data)
+
+    def _stop(self):
+        if not self._closed:
+            self._closed = True
+            for t in self._threads:
+                self._work.put(None)
+
+    def close(self):
+        """Upload the remaining data, wait for the workers and complete the upload."""
+        if self._buffered or not self._next_index:
+            self._submit("".join(self._chunks))
+            self._chunks, self._buffered = [], 0
+        self._work.join()
+        self._stop()
+        if self._error is not None:
+            self._abort()
+            raise self._error
+        result = self._complete()
+        if self.on_complete:
+            self.on_complete(result, self.size)
+        return result
+
+    def abort(self):
+        self._stop()
+        self._abort()
+
+
+class GlacierUploadWriter(ConcurrentPartWriter):
+    """Stream an archive to Glacier with a concurrent multipart upload.
+
+    The SHA-256 of each megabyte is computed inline by the workers, so the
+    archive tree hash is known as soon as the last part is uploaded.
+
+    :type vault: boto.glacier.vault.Vault
+    :param vault: Destination vault.
+
+    :type description: str
+    :param description: Archive description.
+
+    :type size_hint: int
+    :param size_hint: Expected archive size (upper bound), used to pick a part size
+        keeping the upload under the 10000 parts limit.
+
+    """
+    DEFAULT_PART_SIZE = 16 * MEGABYTE
+    # Glacier parts all have the same size, streams of unknown size (stdin...) can reach 640GB.
+    UNKNOWN_SIZE_PART_SIZE = 64 * MEGABYTE
+    MAX_PARTS = 10000
+
+    def __init__(self, vault, description, size_hint=None, num_threads=DEFAULT_NUM_THREADS,
+                 on_complete=None, controller=None):
+        from boto.glacier.utils import minimum_part_size
+
+        part_size = self.DEFAULT_PART_SIZE
+        if size_hint:
+            part_size = minimum_part_size(size_hint, part_size)
+        elif size_hint is None:
+            part_size = self.UNKNOWN_SIZE_PART_SIZE
+
+        self.vault = vault
+        response = vault.layer1.initiate_multipart_upload(vault.name, part_size, description)
+        self.upload_id = response["UploadId"]
+        self._hashes = {}
+        # Glacier parts all have the same size, only the concurrency is adjusted.
+        ConcurrentPartWriter.__init__(self, part_size, num_threads, on_complete, controller)
+
+    def _submit(self, data):
+        if self._next_index >= self.MAX_PARTS:
+            raise Exception("The archive exceeds {0} parts of {1} MB (more than the expected size)".format(
+                            self.MAX_PARTS, self.part_size // MEGABYTE))
+        ConcurrentPartWriter._submit(self, data)
+
+    def _upload_part(self, index, data):
+        from boto.glacier.utils import chunk_hashes, tree_hash, bytes_to_hex
+
+        hashes = chunk_hashes(data)
+        start = index * self.part_size
+        byte_range = (start, start + len(data) - 1)
+        self.vault.layer1.upload_part(self.vault.name, self.upload_id,
+                                      hashlib.sha256(data).hexdigest(),
+                                      bytes_to_hex(tree_hash(hashes)),
+                                      byte_range, data)
+        self._hashes[index] = hashes
+
+    def _complete(self):
+        from boto.glacier.utils import tree_hash, bytes_to_hex
+
+        hashes = []
+        for index in range(self._next_index):
+            hashes.extend(self._hashes[index])
+        response = self.vault.layer1.complete_multipart_upload(self.vault.name, self.upload_id,
+                                                               bytes_to_hex(tree_hash(hashes)),
+                                                               self.size)
+        return response["ArchiveId"]
+
+    def _abort(self):
+        self.vault.layer1.abort_multipart_upload(self.vault.name, self.upload_id)
+
+
+class S3MultipartWriter(ConcurrentPartWriter):
+    """Stream a key to S3 with a concurrent multipart upload, nothing is written to disk.
+
+    S3 parts can have different sizes: the part size follows the controller
+    but the minimum part size doubles every PARTS_PER_STEP parts, so streams
+    of unknown size stay under the 10000 parts limit.
+
+    :type bucket: boto.s3.bucket.Bucket
+    :param bucket: Destination bucket.
+
+    :type keyname: str
+    :param keyname: Destination key.
+
+    :type size_hint: int
+    :param size_hint: Expected size (upper bound), None if unknown.
+
+    :type controller: TransferController
+    :param controller: Controller shared with other transfers.
+
+    """
+    MIN_PART_SIZE = 8 * MEGABYTE
+    MAX_PART_SIZE = 5 * 1024 * MEGABYTE
+    PARTS_PER_STEP = 1000
+
+    def __init__(self, bucket, keyname, size_hint=None, num_threads=DEFAULT_NUM_THREADS, on_complete=None,
+                 controller=None):
+        self.min_part_size = self.MIN_PART_SIZE
+        if size_hint:
+            while self.min_part_size * 10000 < size_hint:
+                self.min_part_size *= 2
+        controller = controller or TransferController(num_threads, self.MIN_PART_SIZE,
+                                                      max_part_size=self.MAX_PART_SIZE)
+        self.mp = bucket.initiate_multipart_upload(keyname)
+        ConcurrentPartWriter.__init__(self, max(self.min_part_size, controller.part_size),
+                                      num_threads, on_complete, controller)
+
+    def _submit(self, data):
+        ConcurrentPartWriter._submit(self, data)
+        if not self._next_index % self.PARTS_PER_STEP:
+            self.min_part_size = min(self.min_part_size * 2, self.MAX_PART_SIZE)
+        self.part_size = min(max(self.min_part_size, self.controller.part_size), self.MAX_PART_SIZE)
+
+    def _upload_part(self, index, data):
+        from cStringIO import StringIO
+
+        self.mp.upload_part_from_file(StringIO(data), part_num=index + 1)
+
+    def _complete(self):
+        return self.mp.complete_upload()
+
+    def _abort(self):
+        self.mp.cancel_upload()
+
+
+class VolumeWriter(object):
+    """Cut a stream into fixed size volumes, each volume is written to its own writer.
+
+    A full volume is closed (i.e. its upload is completed) in a background thread
+    while the next one is being written, at most max_pending volumes are completing
+    at the same time.
+
+    :type open_volume: callable
+    :param open_volume: open_volume(index) returns a writer (see BakthatBackend.writer).
+
+    :type volume_size: int
+    :param volume_size: Volume size in bytes.
+
+    :type delete_volume: callable
+    :param delete_volume: delete_volume(index) deletes an uploaded volume, used on abort.
+
+    """
+    def __init__(self, open_volume, volume_size, max_pending=2, delete_volume=None):
+        self.open_volume = open_volume
+        self.volume_size = volume_size
+        self.delete_volume = delete_volume
+        self.size = 0
+        self.num_volumes = 0
+        self._current = None
+        self._current_size = 0
+        self._error = None
+        self._pending = threading.Semaphore(max_pending)
+        self._threads = []
+
+    def _close_volume(self, writer):
+        try:
+            if self._error is None:
+                writer.close()
+            else:
+                writer.abort()
+        except Exception, exc:
+            log.exception(exc)
+            self._error = exc
+        finally:
+            self._pending.release()
+
+    def _finish_current(self):
+        self._pending.acquire()
+        t = threading.Thread(target=self._close_volume, args=(self._current,))
+        t.daemon = True
+        t.start()
+        self._threads.append(t)
+        self._current = None
+
+    def write(self, data):
+        while data:
+            if self._error is not None:
+                raise self._error
+            if self._current is None:
+                self._current = self.open_volume(self.num_volumes)
+                self._current_size = 0
+                self.num_volumes += 1
+
+            chunk = data[:self.volume_size - self._current_size]
+            self._current.write(chunk)
+            self._current_size += len(chunk)
+            self.size += len(chunk)
+            data = data[len(chunk):]
+
+            if self._current_size >= self.volume_size:
+                self._finish_current()
+
+    def _wait(self):
+        for t in self._threads:
+            t.join()
+
+    def close(self):
+        if not self.num_volumes:
+            self._current = self.open_volume(0)
+            self.num_volumes = 1
+        if self._current is not None:
+            self._finish_current()
+        self._wait()
+        if self._error is not None:
+            self.abort()
+            raise self._error
+
+    def abort(self):
+        if self._current is not None:
+            self._current.abort()
+            self._current = None
+        if self._error is None:
+            self._error = Exception("Aborted")
+        self._wait()
+        if self.delete_volume:
+            for index in range(self.num_volumes):
+                try:
+                    self.delete_volume(index)
+                except Exception, exc:
+                    log.warning("Can't delete volume {0}: {1}".format(index, exc))
+
+
+class TeeWriter(object):
+    """Write a stream to several writers concurrently, a failing writer doesn't stop the others.
+
+    Each writer is fed by its own thread from a bounded queue, so a slow
+    destination only blocks the producer once max_pending chunks are waiting.
+    Once closed, results holds name => dict(size=...) or dict(error=...).
+
+    :type writers: list
+    :param writers: List of (name, writer) tuples.
+
+    :type max_pending: int
+    :param max_pending: Max number of chunks queued per writer.
+
+    """
+    _CLOSE = object()
+    _ABORT = object()
+
+    def __init__(self, writers, max_pending=8):
+        self.writers = list(writers)
+        self.size = 0
+        self.results = {}
+        self._errors = {}
+        self._queues = {}
+        self._threads = []
+        for name, writer in self.writers:
+            self._queues[name] = Queue.Queue(maxsize=max_pending)
+            t = threading.Thread(target=self._worker, args=(name, writer))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _fail(self, name, writer, exc):
+        log.error("{0} failed: {1}".format(name, exc))
+        self._errors[name] = exc
+        try:
+            writer.abort()
+        except Exception, abort_exc:
+            log.warning("Can't abort {0}: {1}".format(name, abort_exc))
+
+    def _worker(self, name, writer):
+        queue = self._queues[name]
+        while True:
+            data = queue.get()
+            if name in self._errors:
+                # Keep consuming so the producer is never blocked by a failed writer.
+                if data is self._CLOSE or data is self._ABORT:
+                    return
+                continue
+            try:
+                if data is self._ABORT:
+                    writer.abort()
+                    return
+                if data is self._CLOSE:
+                    writer.close()
+                    self.results[name] = dict(size=writer.size)
+                    return
+                writer.write(data)
+            except Exception, exc:
+                log.exception(exc)
+                self._fail(name, writer, exc)
+
+    @property
+    def failed(self):
+        """name => exception for the writers that failed."""
+        return dict(self._errors)
+
+    def write(self, data):
+        if len(self._errors) == len(self.writers):
+            raise self._errors[self.writers[0][0]]
+        for name, writer in self.writers:
+            if name not in self._errors:
+                self._queues[name].put(data)
+        self.size += len(data)
+
+    def _stop(self, sentinel):
+        for name, writer in self.writers:
+            self._queues[name].put(sentinel)
+        for t in self._threads:
+            t.join()
+
+    def close(self):
+        """Close every writer, raise only if all of them failed."""
+        self._stop(self._CLOSE)
+        for name, exc in self._errors.items():
+            self.results[name] = dict(error=str(exc) or exc.__class__.__name__)
+        if len(self._errors) == len(self.writers):
+            raise self._errors[self.writers[0][0]]
+        return self.results
+
+    def abort(self):
+        self._stop(self._ABORT)
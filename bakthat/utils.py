@@ -2,6 +2,7 @@
 import logging
 
 import bakthat
+from bakthat import scheduler
 from bakthat.conf import config, DEFAULT_DESTINATION, DEFAULT_LOCATION
 
 log = logging.getLogger(__name__)
@@ -19,12 +20,37 @@ class BakHelper:
     :type password: str
     :param password: Password (Empty string to disable encryption)
 
+    :type network_rate: float
+    :keyword network_rate: Network rate limit of the process in MB/s (see set_limits).
+
+    :type disk_rate: float
+    :keyword disk_rate: Disk read rate limit of the process in MB/s (see set_limits).
+
     """
     def __init__(self, set_name, destination=DEFAULT_DESTINATION, password="", **kwargs):
         self.set_name = set_name
         self.destination = destination
         self.password = password
         self.sync = None
+        if kwargs.get("network_rate") is not None or kwargs.get("disk_rate") is not None:
+            self.set_limits(kwargs.get("network_rate"), kwargs.get("disk_rate"))
+
+    def set_limits(self, network_rate=None, disk_rate=None, preempt=None):
+        """Set the bandwidth/IO limits of the process (see bakthat.scheduler),
+        they override the scheduler section of the config and apply to running transfers.
+
+        :type network_rate: float
+        :param network_rate: Network rate in MB/s (0 for unlimited, None to keep the current one).
+
+        :type disk_rate: float
+        :param disk_rate: Disk read rate in MB/s (0 for unlimited, None to keep the current one).
+
+        :type preempt: bool
+        :param preempt: Restores preempt backups, backups preempt verifications.
+
+        """
+        log.info("Setting limits: network {0} MB/s, disk {1} MB/s".format(network_rate, disk_rate))
+        scheduler.configure(network_rate, disk_rate, preempt)
 
     def enable_sync(self, api_url, auth=None):
         """Enable synchronization with BakSyncer (optional).
@@ -0,0 +1,222 @@
+# -*- encoding: utf-8 -*-
+"""Watch mode: backup directories when they change.
+
+Changes are detected with inotify (pyinotify, optional) or by polling
+(periodic scans, see bakthat.scan). Bursts of events are debounced: a set is
+backed up once it has been quiet for delay seconds (or max_delay seconds
+after the first change if it never stops changing). Backups run in a
+TaskPool, a set is never backed up twice at the same time, and the process
+keeps its backends (and their connections) between runs.
+
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from bakthat.scan import ExcludeRules, Scanner
+from bakthat.tasks import TaskPool
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DELAY = 60
+DEFAULT_MAX_DELAY = 600
+DEFAULT_POLL_INTERVAL = 300
+
+
+class Debouncer(object):
+    """Coalesce bursts of events per key.
+
+    :type delay: int
+    :param delay: A key is due once no event happened for delay seconds.
+
+    :type max_delay: int
+    :param max_delay: A key is due at most max_delay seconds after its first event.
+
+    """
+    def __init__(self, delay=DEFAULT_DELAY, max_delay=DEFAULT_MAX_DELAY, clock=time.time):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def trigger(self, key):
+        now = self.clock()
+        with self._lock:
+            first, last = self._events.get(key, (now, now))
+            self._events[key] = (first, now)
+
+    def pending(self):
+        with self._lock:
+            return sorted(self._events)
+
+    def due(self):
+        """Return (and forget) the keys ready to be processed."""
+        now = self.clock()
+        ready = []
+        with self._lock:
+            for key, (first, last) in self._events.items():
+                if now - last >= self.delay or now - first >= self.max_delay:
+                    ready.append(key)
+                    del self._events[key]
+        return sorted(ready)
+
+
+class PollingObserver(object):
+    """Detect changes by scanning the paths every interval seconds (fallback without inotify).
+
+    Only the metadata (size, mtime, inode...) is compared, files are never read.
+
+    """
+    def __init__(self, paths, callback, excludes=None, interval=DEFAULT_POLL_INTERVAL):
+        self.paths = paths
+        self.callback = callback
+        self.interval = interval
+        self.scanner = Scanner(excludes)
+        self._snapshots = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def snapshot(self, path):
+        digest = hashlib.sha1()
+        for entry in self.scanner.scan(path):
+            st = entry.stat
+            digest.update("{0}\0{1}\0{2}\0{3}\0{4}\n".format(entry.arcname, st.st_mode, st.st_size,
+                                                           st.st_mtime, st.st_ino))
+        return digest.digest()
+
+    def check(self):
+        """Scan every path, call callback for the changed ones."""
+        for path in self.paths:
+            try:
+                snapshot = self.snapshot(path)
+            except OSError, exc:
+                log.warning("Can't scan {0}: {1}".format(path, exc))
+                continue
+            if path in self._snapshots and self._snapshots[path] != snapshot:
+                self.callback(path)
+            self._snapshots[path] = snapshot
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.check()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self.check()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+class InotifyObserver(object):
+    """Detect changes with inotify (needs pyinotify), new directories are watched automatically."""
+    def __init__(self, paths, callback, excludes=None):
+        import pyinotify
+
+        self.paths = paths
+        self.callback = callback
+        self.excludes = excludes or ExcludeRules()
+        self.manager = pyinotify.WatchManager()
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_ATTRIB)
+
+        observer = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                observer.on_event(event.pathname, event.dir)
+
+        self.notifier = pyinotify.ThreadedNotifier(self.manager, Handler())
+        self.notifier.daemon = True
+        for path in paths:
+            self.manager.add_watch(path, mask, rec=True, auto_add=True)
+
+    def on_event(self, pathname, is_dir=False):
+        for path in self.paths:
+            if pathname == path or pathname.startswith(path.rstrip("/") + "/"):
+                relpath = os.path.relpath(pathname, path)
+                if not self.excludes or not self.excludes.excluded(relpath, is_dir):
+                    self.callback(path)
+                return
+
+    def start(self):
+        self.notifier.start()
+
+    def stop(self):
+        self.notifier.stop()
+
+
+def get_observer(paths, callback, excludes=None, poll_interval=DEFAULT_POLL_INTERVAL):
+    """Return an InotifyObserver if pyinotify is available, a PollingObserver otherwise."""
+    try:
+        return InotifyObserver(paths, callback, excludes)
+    except ImportError:
+        log.info("pyinotify not available, polling every {0}s".format(poll_interval))
+        return PollingObserver(paths, callback, excludes, poll_interval)
+
+
+class Watcher(object):
+    """Backup the watched paths (one backup set per path) when they change.
+
+    :type paths: list
+    :param paths: Directories to watch.
+
+    :type backup: callable
+    :param backup: backup(path) performs the backup (e.g. a partial of bakthat.backup).
+
+    :type max_workers: int
+    :param max_workers: Max number of backups running at the same time.
+
+    """
+    def __init__(self, paths, backup, excludes=None, delay=DEFAULT_DELAY, max_delay=DEFAULT_MAX_DELAY,
+                 poll_interval=DEFAULT_POLL_INTERVAL, max_workers=2, observer=None):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.backup = backup
+        self.debouncer = Debouncer(delay, max_delay)
+        self.pool = TaskPool(max_workers)
+        self.running = {}
+        self.observer = observer or get_observer(self.paths, self.debouncer.trigger,
+                                                 excludes, poll_interval)
+
+    def _backup(self, path, cancel=None):
+        log.info("Changes detected in {0}, backing up".format(path))
+        return self.backup(path)
+
+    def tick(self):
+        """Start the backups of the sets that are due, return the started tasks."""
+        started = []
+        for path, task in self.running.items():
+            if task.done():
+                del self.running[path]
+                if task.exception() is not None:
+                    log.error("Backup of {0} failed: {1}".format(path, task.exception()))
+
+        for path in self.debouncer.due():
+            if path in self.running:
+                # Changes during a backup, it will be backed up again once done.
+                self.debouncer.trigger(path)
+                continue
+            self.running[path] = self.pool.submit(self._backup, path)
+            started.append(self.running[path])
+        return started
+
+    def run(self, stop=None, tick_interval=1):
+        """Watch until stop (a threading.Event) is set or KeyboardInterrupt."""
+        stop = stop or threading.Event()
+        self.observer.start()
+        log.info("Watching {0}".format(", ".join(self.paths)))
+        try:
+            while not stop.is_set():
+                self.tick()
+                stop.wait(tick_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.observer.stop()
+            self.pool.shutdown(wait=True)
@@ -0,0 +1,130 @@
+# -*- encoding: utf-8 -*-
+"""Scale benchmark of the catalog and retention operations.
+
+An in-memory backend is populated with synthetic backup keys (hourly
+backups spread over several backup sets, some of them split in volumes),
+then listing, matching, grouping, rotation/prune planning and bulk
+deletions are timed, with the peak memory of the process::
+
+    $ python bench_bakthat.py
+    $ python bench_bakthat.py --keys 1000000 --sets 500
+
+"""
+import argparse
+import bisect
+import logging
+import os
+import resource
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import bakthat
+from bakthat import state
+
+ROTATION = dict(days=7, weeks=4, months=12, first_week_day=5)
+VOLUME_EVERY = 50
+VOLUMES = 3
+
+
+class MemoryBackend(object):
+    """Storage backend keeping sorted key names in memory (prefix listings like S3)."""
+    container = "memory"
+
+    def __init__(self, conf=None):
+        self.keys = []
+
+    def populate(self, keys):
+        self.keys = sorted(keys)
+
+    def ls(self, prefix=""):
+        start = bisect.bisect_left(self.keys, prefix)
+        end = len(self.keys)
+        if prefix:
+            end = bisect.bisect_left(self.keys, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        return self.keys[start:end]
+
+    def size(self, keyname):
+        i = bisect.bisect_left(self.keys, keyname)
+        return 0 if i < len(self.keys) and self.keys[i] == keyname else None
+
+    def delete(self, keyname):
+        self.delete_many([keyname])
+
+    def delete_many(self, keynames):
+        keynames = set(keynames)
+        self.keys = [key for key in self.keys if key not in keynames]
+
+
+def synthetic_keys(num_keys, num_sets, now):
+    """Return about num_keys keys: hourly backups of num_sets sets, going back from now."""
+    keys = []
+    per_set = max(1, num_keys // num_sets)
+    for set_index in range(num_sets):
+        name = "set-{0:05d}".format(set_index)
+        for i in range(per_set):
+            date_component = (now - timedelta(hours=i, minutes=set_index % 60)).strftime("%Y%m%d%H%M%S")
+            key = "{0}.{1}.tgz.enc".format(name, date_component)
+            if i % VOLUME_EVERY == VOLUME_EVERY - 1:
+                keys.extend("{0}.part{1:04d}".format(key, volume) for volume in range(VOLUMES))
+            else:
+                keys.append(key)
+    return keys
+
+
+def peak_memory():
+    """Peak resident memory of the process, in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def measure(results, num_keys, name, func):
+    start = time.time()
+    result = func()
+    results.append((num_keys, name, time.time() - start, peak_memory()))
+    print "{0:>9} {1:<28} {2:9.3f}s {3:9.1f}MB".format(*results[-1])
+    return result
+
+
+def run(num_keys, num_sets):
+    now = datetime.utcnow()
+    backend = bakthat.get_backend(MemoryBackend)
+    backend.populate(synthetic_keys(num_keys, num_sets, now))
+    num_keys = len(backend.keys)
+    results = []
+
+    measure(results, num_keys, "ls", backend.ls)
+    measure(results, num_keys, "match_filename", lambda: bakthat.match_filename("set-00001", "memory"))
+    measure(results, num_keys, "group backups", lambda: bakthat._group_backups(backend.ls()))
+    measure(results, num_keys, "rotation planning", lambda: bakthat.rotate_all("memory", dry_run=True, **ROTATION))
+    measure(results, num_keys, "prune planning", lambda: bakthat.prune_all("30D", "memory", dry_run=True))
+    measure(results, num_keys, "delete_older_than (1 set)",
+            lambda: bakthat.delete_older_than("set-00002", "30D", "memory"))
+    measure(results, num_keys, "rotate_backups (1 set)",
+            lambda: bakthat.rotate_backups("set-00003", "memory", **ROTATION))
+    measure(results, num_keys, "rotate_all", lambda: bakthat.rotate_all("memory", **ROTATION))
+    measure(results, num_keys, "prune_all", lambda: bakthat.prune_all("30D", "memory"))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--keys", type=int, action="append", help="Number of keys (can be repeated)")
+    parser.add_argument("--sets", type=int, default=100, help="Number of backup sets")
+    args = parser.parse_args()
+
+    logging.getLogger("bakthat").setLevel(logging.WARNING)
+    bakthat.STORAGE_BACKEND["memory"] = MemoryBackend
+    # Deleted backups checksums are forgotten, don't touch the real local state.
+    root = tempfile.mkdtemp()
+    state._state = state.LocalState(os.path.join(root, "state.sqlite"), legacy_path=None)
+    try:
+        for num_keys in args.keys or [100000, 1000000]:
+            run(num_keys, args.sets)
+            bakthat.clear_backend_cache()
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,15 +6,64 @@ import os
 import time
 import unittest
 import logging
+import subprocess
+import sys
+import threading
+from contextlib import closing
+from datetime import datetime, timedelta
 
 from bakthat.conf import config, DEFAULT_DESTINATION, DEFAULT_LOCATION
-from bakthat.backends import GlacierBackend
+from bakthat.backends import GlacierBackend, S3Backend, clear_backend_cache, get_backend
+from bakthat.cache import BackupCache, CachingWriter
+from bakthat.compression import AutoLevel, BlockCompressor, GzipStreamReader
+from bakthat.extract import ParallelExtractor
+from bakthat.delta import Signature, SignatureWriter, apply_delta, load_delta_state, read_header, write_delta
+from bakthat.integrity import BlockHasher, load_checksums, missing_volumes, save_checksums, verify_backup
+from bakthat.inventory import InventoryParseError, iter_inventory, reconcile
+from bakthat.scan import ExcludeRules, Scanner, add_to_tar, archive_size, total_size
+from bakthat.scheduler import BACKUP, DISK, RESTORE, TokenBucket, get_scheduler
+from bakthat.shard import plan_shards
+from bakthat.sparse import SparseTarFile
+from bakthat.state import LocalState, get_state
+from bakthat.stream import Cancelled, CancellableWriter, ChainReader, DecryptReader, EncryptWriter
+from bakthat.tasks import TaskPool, wait
+from bakthat.watch import Debouncer, PollingObserver, Watcher
+from bakthat.transfer import ChunkedDownloader, ConcurrentPartWriter, GlacierUploadWriter, S3MultipartWriter, \
+                              TeeWriter, TransferController, VolumeWriter, MEGABYTE
 
 log = logging.getLogger(__name__)
 
+
+def use_temp_state(testcase):
+    """Point the process-wide state (checksums, inventory, delta signatures) at a temporary
+    database until the end of the test, instead of ~/.bakthat.sqlite."""
+    import shutil
+    from bakthat import state
+
+    root = tempfile.mkdtemp()
+    previous = state._state
+    state._state = LocalState(os.path.join(root, "state.sqlite"), legacy_path=None)
+
+    def restore():
+        state._state.close()
+        state._state = previous
+        shutil.rmtree(root)
+    testcase.addCleanup(restore)
+
+
+def record_disk_reads(testcase):
+    """Return the list of the byte counts throttled by the disk bucket until the end of the test."""
+    bucket = get_scheduler().buckets[DISK]
+    reads = []
+    bucket.consume = lambda nbytes, priority=None: reads.append(nbytes)
+    testcase.addCleanup(delattr, bucket, "consume")
+    return reads
+
+
 class BakthatTestCase(unittest.TestCase):
 
     def setUp(self):
+        use_temp_state(self)
         self.test_file = tempfile.NamedTemporaryFile()
         self.test_file.write("Bakthat Test File")
         self.test_file.seek(0)
@@ -32,6 +81,15 @@ class BakthatTestCase(unittest.TestCase):
         self.assertEqual(bakthat._interval_string_to_seconds("2D1h"), 86400 * 2 + 3600)
         self.assertEqual(bakthat._interval_string_to_seconds("3M"), 3*30*86400)
 
+    def test_backend_cache(self):
+        conf = {"access_key": "key", "secret_key": "secret", "s3_bucket": "bucket"}
+
+        # Instantiating a backend must not hit the network.
+        backend = get_backend(S3Backend, conf)
+
+        self.assertTrue(backend is get_backend(S3Backend, dict(conf)))
+        self.assertFalse(backend is get_backend(S3Backend, dict(conf, s3_bucket="other")))
+        self.assertTrue(backend.connection is get_backend(S3Backend, dict(conf, s3_bucket="other")).connection)
 
     def test_s3_backup_restore(self):
         backup_data = bakthat.backup(self.test_file.name, "s3", password="")
@@ -171,5 +229,1355 @@ class BakthatTestCase(unittest.TestCase):
                 else:
                     time.sleep(600)
 
+
+class FakeBackend(object):
+    """In-memory backend, only used to test the catalog/rotation logic."""
+    container = "Fake"
+
+    def __init__(self, keys=()):
+        self.keys = set(keys)
+        self.ls_calls = 0
+        self.delete_calls = 0
+
+    def ls(self, prefix=""):
+        self.ls_calls += 1
+        return [key for key in self.keys if key.startswith(prefix)]
+
+    def delete(self, keyname):
+        self.delete_calls += 1
+        self.keys.discard(keyname)
+
+    def delete_many(self, keynames):
+        self.delete_calls += 1
+        self.keys.difference_update(keynames)
+
+
+class BakthatRotationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        use_temp_state(self)
+        now = datetime.utcnow()
+        self.keys = []
+        for backup_name in ("www", "db"):
+            for days in range(30):
+                date_component = (now - timedelta(days=days, hours=1)).strftime("%Y%m%d%H%M%S")
+                self.keys.append("{0}.{1}.tgz.enc".format(backup_name, date_component))
+        self.backend = FakeBackend(self.keys + ["bakthat_glacier_inventory"])
+        self._get_store_backend = bakthat._get_store_backend
+        bakthat._get_store_backend = lambda conf, destination=None: self.backend
+        self.policy = dict(days=7, weeks=0, months=0, first_week_day=5)
+
+    def tearDown(self):
+        bakthat._get_store_backend = self._get_store_backend
+
+    def test_rotate_all(self):
+        plan = bakthat.rotate_all(dry_run=True, **self.policy)
+
+        self.assertEqual(sorted(plan), ["db", "www"])
+        self.assertEqual(len(plan["www"]), 23)
+        self.assertEqual(self.backend.delete_calls, 0)
+
+        self.assertEqual(bakthat.rotate_all(**self.policy), plan)
+        self.assertEqual(self.backend.ls_calls, 2)
+        self.assertEqual(self.backend.delete_calls, 1)
+        self.assertEqual(len(self.backend.keys), 15)
+
+    def test_prune_all(self):
+        plan = bakthat.prune_all("10D")
+
+        self.assertEqual(len(plan["db"]), 20)
+        self.assertEqual(self.backend.ls_calls, 1)
+        self.assertEqual(self.backend.delete_calls, 1)
+
+    def test_rotation_candidates(self):
+        import grandfatherson
+
+        # Several backups a day, only the oldest of each day goes through grandfatherson.
+        now = datetime(2013, 3, 15, 12, 30)
+        backups = [dict(key=str(i), backup_date=now - timedelta(hours=5 * i - 20)) for i in range(400)]
+        policy = dict(days=5, weeks=3, months=2, first_week_day=5)
+        expected = grandfatherson.to_delete([backup["backup_date"] for backup in backups], days=5, weeks=3,
+                                            months=2, firstweekday=5, now=now)
+        to_delete = bakthat._rotation_to_delete(backups, policy, now)
+        self.assertEqual(set(backup["backup_date"] for backup in to_delete), expected)
+
+        # Single set commands delete in bulk
+        deleted = bakthat.rotate_backups("www", **self.policy)
+        self.assertEqual(len(deleted), 23)
+        self.assertEqual(self.backend.delete_calls, 1)
+
+    def test_delta_chains(self):
+        now = datetime.utcnow()
+
+        def key(days, ext):
+            return "vm.img.{0}.{1}".format((now - timedelta(days=days, hours=1)).strftime("%Y%m%d%H%M%S"), ext)
+        # An old chain, then a chain whose full backup is older than the kept deltas.
+        old_chain = [key(25, "tgz"), key(24, "delta"), key(23, "delta")]
+        chain = [key(days, "tgz" if days == 12 else "delta") for days in range(12, -1, -1) if days != 5]
+        self.backend.keys.update(old_chain + chain)
+
+        plan = bakthat.rotate_all(dry_run=True, **self.policy)
+        self.assertEqual(sorted(plan["vm.img"]), sorted(old_chain))
+        self.assertEqual(sorted(bakthat.prune_all("10D", dry_run=True)["vm.img"]), sorted(old_chain))
+
+        # A full backup made without --delta isn't part of the chain, the exact chain
+        # of the last version is read from the local state.
+        self.backend.keys.add(key(5, "tgz"))
+        get_state().set("deltas", "Fake:vm.img", dict(chain=chain, signature=Signature(1024).dumps()))
+        self.assertEqual(sorted(bakthat.delete_older_than("vm.img", "4D")), sorted(old_chain))
+        self.assertTrue(set(chain) <= self.backend.keys)
+
+    def test_volume_sets(self):
+        old_key = "big.20120101000000.tgz"
+        new_key = "big.{0}.tgz.enc".format(datetime.utcnow().strftime("%Y%m%d%H%M%S"))
+        volumes = ["{0}.part{1:04d}".format(new_key, i) for i in range(3)]
+        self.backend.keys.update(volumes + [old_key + ".part0000", old_key + ".part0001"])
+
+        backups = bakthat.match_filename("big")
+        self.assertEqual([backup["key"] for backup in backups], [new_key, old_key])
+        self.assertEqual(backups[0]["volumes"], volumes)
+        self.assertTrue(backups[0]["is_enc"])
+        self.assertEqual(missing_volumes(backups[0]), None)
+        self.assertEqual(missing_volumes(backups[0], dict(size=250, volume_size=100)), None)
+        self.assertTrue(missing_volumes(backups[0], dict(size=350, volume_size=100, num_volumes=4)))
+
+        # Sorted by index, not as strings, gaps are reported.
+        indexes = [10000, 2, 9999, 0, 1, 10001]
+        backups = bakthat._merge_volumes([bakthat._parse_key("{0}.part{1:04d}".format(new_key, i))
+                                          for i in indexes])
+        self.assertEqual(backups[0]["volumes"], ["{0}.part{1:04d}".format(new_key, i) for i in sorted(indexes)])
+        self.assertEqual(backups[0]["num_volumes"], 10002)
+        self.assertEqual(missing_volumes(backups[0]), "9996/10002 volumes of {0} are missing".format(new_key))
+
+        plan = bakthat.prune_all("10D")
+        self.assertEqual(plan["big"], [old_key + ".part0000", old_key + ".part0001"])
+
+        self.assertTrue(bakthat.delete("big"))
+        self.assertFalse([key for key in self.backend.keys if key.startswith("big")])
+
+
+class BakthatInventoryTestCase(unittest.TestCase):
+
+    def test_iter_inventory(self):
+        import json
+        from StringIO import StringIO
+
+        archives = [{"ArchiveId": "id{0}".format(i),
+                     "ArchiveDescription": "bak.20130101000000.tgz ]}[,",
+                     "Size": i} for i in range(100)]
+        inventory = json.dumps({"VaultARN": "arn", "InventoryDate": "date", "ArchiveList": archives}, indent=2)
+
+        for chunk_size in (1, 7, 1024):
+            self.assertEqual(list(iter_inventory(StringIO(inventory), chunk_size)), archives)
+
+        with self.assertRaises(InventoryParseError):
+            list(iter_inventory(StringIO(inventory[:-100])))
+
+        # Malformed entries fail without reading the rest of the inventory.
+        for broken in (inventory.replace('"Size": 3', '"Size": x', 1), inventory.replace('"Size": 3', '"Size": 3:', 1),
+                       inventory.replace('"id5"', '"id5', 1)):
+            stream = StringIO(broken + " " * 1024 * 1024)
+            with self.assertRaises(InventoryParseError):
+                list(iter_inventory(stream, 1024))
+            self.assertTrue(stream.tell() < 10 * 1024)
+
+    def test_reconcile(self):
+        remote = [{"ArchiveId": "1", "ArchiveDescription": "a"},
+                  {"ArchiveId": "2", "ArchiveDescription": "b"},
+                  {"ArchiveId": "3", "ArchiveDescription": "c"}]
+        merged = {}
+        report = reconcile(iter(remote), {"a": "1", "d": "4"}, batch_size=1, merge=merged.update)
+
+        self.assertEqual(report, dict(total=3, missing_locally=2, missing_in_vault=["d"]))
+        self.assertEqual(merged, {"b": "2", "c": "3"})
+
+
+class BakthatScanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for path in ("src/a.py", "src/a.pyc", "src/keep.pyc", "src/node_modules/x/y.js",
+                     "build/out.o", "src/build/b.py", "z.txt"):
+            path = os.path.join(self.root, "tree", path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, "w").write(path)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.root)
+
+    def test_exclude_rules(self):
+        rules = ExcludeRules(["# comment", "*.pyc", "!keep.pyc", "node_modules/", "/build", "docs/**/*.tmp"])
+
+        self.assertTrue(rules.excluded("src/a.pyc"))
+        self.assertFalse(rules.excluded("src/keep.pyc"))
+        self.assertTrue(rules.excluded("src/node_modules", is_dir=True))
+        self.assertFalse(rules.excluded("src/node_modules"))
+        self.assertTrue(rules.excluded("build", is_dir=True))
+        self.assertFalse(rules.excluded("src/build", is_dir=True))
+        self.assertTrue(rules.excluded("docs/x.tmp"))
+        self.assertTrue(rules.excluded("docs/a/b/x.tmp"))
+        self.assertFalse(rules.excluded("src/a.py"))
+
+    def test_scanner(self):
+        rules = ExcludeRules(["*.pyc", "!keep.pyc", "node_modules/", "/build"])
+        entries = Scanner(rules, num_threads=3).scan(os.path.join(self.root, "tree"))
+
+        self.assertEqual([entry.arcname for entry in entries],
+                         ["tree", "tree/src", "tree/src/a.py", "tree/src/build",
+                          "tree/src/build/b.py", "tree/src/keep.pyc", "tree/z.txt"])
+        self.assertEqual(total_size(entries), sum(len(os.path.join(self.root, entry.arcname))
+                                                  for entry in entries if entry.arcname.count(".")))
+
+        import tarfile
+        from StringIO import StringIO
+        buf = StringIO()
+        with closing(tarfile.open(fileobj=buf, mode="w|")) as tar:
+            add_to_tar(tar, entries)
+        self.assertTrue(len(buf.getvalue()) <= archive_size(entries))
+
+    def test_sparse_and_hardlinks(self):
+        from StringIO import StringIO
+        import tarfile
+
+        tree = os.path.join(self.root, "vm")
+        os.mkdir(tree)
+        with open(os.path.join(tree, "disk.img"), "wb") as f:
+            f.truncate(64 * MEGABYTE)
+            for i in range(6):
+                f.seek(i * 8 * MEGABYTE + 4096)
+                f.write(str(i) * 5000)
+        with open(os.path.join(tree, "a"), "wb") as f:
+            f.write("a" * 10000)
+        os.link(os.path.join(tree, "a"), os.path.join(tree, "b"))
+
+        import bakthat.scan
+        opened = []
+
+        def recording_open(path, *args):
+            opened.append(os.path.basename(path))
+            return open(path, *args)
+        bakthat.scan.open = recording_open
+        buf = StringIO()
+        try:
+            with closing(tarfile.open(fileobj=buf, mode="w|")) as tar:
+                add_to_tar(tar, Scanner().scan(tree))
+        finally:
+            del bakthat.scan.open
+        members = dict((m.name, m) for m in tarfile.open(fileobj=StringIO(buf.getvalue())))
+        self.assertTrue(members["vm/b"].islnk())
+        # The second name of a hardlinked file isn't opened
+        self.assertEqual(sorted(opened), ["a", "disk.img"])
+        # Only if the filesystem supports SEEK_DATA/SEEK_HOLE
+        if members["vm/disk.img"].issparse():
+            self.assertTrue(len(buf.getvalue()) < MEGABYTE)
+
+        out = os.path.join(self.root, "out")
+        with closing(SparseTarFile.open(fileobj=StringIO(buf.getvalue()), mode="r|")) as tar:
+            tar.extractall(out)
+        with open(os.path.join(tree, "disk.img"), "rb") as f1, open(os.path.join(out, "vm/disk.img"), "rb") as f2:
+            self.assertEqual(hashlib.sha1(f1.read()).digest(), hashlib.sha1(f2.read()).digest())
+        self.assertEqual(os.stat(os.path.join(out, "vm/a")).st_ino, os.stat(os.path.join(out, "vm/b")).st_ino)
+
+    def test_parallel_extractor(self):
+        from StringIO import StringIO
+        import tarfile
+
+        tree = os.path.join(self.root, "tree")
+        with open(os.path.join(tree, "large.bin"), "wb") as f:
+            f.write(os.urandom(3 * MEGABYTE))
+        os.link(os.path.join(tree, "z.txt"), os.path.join(tree, "z.lnk"))
+        os.chmod(os.path.join(tree, "src/a.py"), 0600)
+        os.utime(os.path.join(tree, "src/build/b.py"), (1000000000, 1000000000))
+        os.chmod(os.path.join(tree, "src/build"), 0500)
+
+        buf = StringIO()
+        with closing(tarfile.open(fileobj=buf, mode="w|")) as tar:
+            add_to_tar(tar, Scanner().scan(tree))
+
+        out = os.path.join(self.root, "out")
+        with closing(SparseTarFile.open(fileobj=StringIO(buf.getvalue()), mode="r|")) as tar:
+            ParallelExtractor(tar, out, num_threads=3).extractall()
+        try:
+            for entry in Scanner().scan(tree):
+                restored = os.path.join(out, entry.arcname)
+                self.assertEqual(os.stat(restored).st_mode, entry.stat.st_mode)
+                if not os.path.isdir(restored):
+                    self.assertEqual(int(os.stat(restored).st_mtime), int(entry.stat.st_mtime))
+                    with open(os.path.join(self.root, entry.arcname), "rb") as f1, open(restored, "rb") as f2:
+                        self.assertEqual(f1.read(), f2.read())
+            self.assertEqual(os.stat(os.path.join(out, "tree/z.txt")).st_ino,
+                             os.stat(os.path.join(out, "tree/z.lnk")).st_ino)
+        finally:
+            os.chmod(os.path.join(tree, "src/build"), 0700)
+            os.chmod(os.path.join(out, "tree/src/build"), 0700)
+
+
+class DirectoryBackend(object):
+    """Backend storing keys as files, shared with the worker processes of sharded backups."""
+    container = "bakthat-test-shards"
+
+    def __init__(self, path, fail=None):
+        self.path = path
+        self.fail = fail
+
+    def ls(self, prefix=""):
+        return [key for key in os.listdir(self.path) if key.startswith(prefix)]
+
+    def download(self, keyname, **kwargs):
+        return open(os.path.join(self.path, keyname), "rb")
+
+    def size(self, keyname):
+        path = os.path.join(self.path, keyname)
+        return os.path.getsize(path) if os.path.exists(path) else None
+
+    def delete(self, keyname):
+        os.remove(os.path.join(self.path, keyname))
+
+    def delete_many(self, keynames):
+        for keyname in keynames:
+            self.delete(keyname)
+
+    def writer(self, keyname, size_hint=None):
+        if self.fail and self.fail in keyname:
+            raise IOError("Upload failed")
+        backend = self
+
+        class Writer(file):
+            def close(self):
+                self.size = self.tell()
+                file.close(self)
+
+            def abort(self):
+                self.close()
+                backend.delete(keyname)
+
+        return Writer(os.path.join(self.path, keyname), "wb")
+
+
+class BakthatShardTestCase(unittest.TestCase):
+
+    def setUp(self):
+        use_temp_state(self)
+        self.root = tempfile.mkdtemp()
+        self.tree = os.path.join(self.root, "tree")
+        for i in range(20):
+            path = os.path.join(self.tree, "d{0}".format(i % 3), "f{0}".format(i))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as f:
+                f.write(os.urandom(1000 * (i + 1)))
+        os.link(os.path.join(self.tree, "d0", "f0"), os.path.join(self.tree, "d1", "link"))
+        os.mkdir(os.path.join(self.tree, "empty"))
+        os.chmod(os.path.join(self.tree, "d2"), 0555)
+        os.mkdir(os.path.join(self.root, "store"))
+        self._get_store_backend = bakthat._get_store_backend
+
+    def tearDown(self):
+        import shutil
+        bakthat._get_store_backend = self._get_store_backend
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            os.chmod(dirpath, 0755)
+        shutil.rmtree(self.root)
+
+    def test_plan_shards(self):
+        entries = Scanner().scan(self.tree)
+        shards = plan_shards(entries, 3)
+
+        self.assertEqual(len(shards), 4)
+        self.assertEqual([entry.arcname for entry in shards[0]], ["tree", "tree/d0", "tree/d1", "tree/d2", "tree/empty"])
+        sizes = [total_size(shard) for shard in shards[1:]]
+        self.assertEqual(sum(sizes), total_size(entries))
+        self.assertTrue(max(sizes) - min(sizes) <= 20000)
+        # Hardlinked files stay together, in scan order
+        for shard in shards[1:]:
+            arcnames = [entry.arcname for entry in shard]
+            self.assertEqual(arcnames, [entry.arcname for entry in entries if entry.arcname in arcnames])
+            self.assertEqual("tree/d0/f0" in arcnames, "tree/d1/link" in arcnames)
+
+    def test_sharded_backup_restore(self):
+        backend = DirectoryBackend(os.path.join(self.root, "store"))
+        bakthat._get_store_backend = lambda conf, destination=None: backend
+
+        backup_data = bakthat.backup(self.tree, password="password", prompt="no", shards=3)
+        self.assertEqual(len(backup_data["shards"]), 4)
+        backups = bakthat.match_filename("tree")
+        self.assertEqual(len(backups), 1)
+        self.assertEqual(backups[0]["shards"], backup_data["shards"])
+        self.assertEqual(bakthat.verify("tree")["summary"], {"ok": 1})
+
+        out = os.path.join(self.root, "out")
+        os.mkdir(out)
+        cwd = os.getcwd()
+        os.chdir(out)
+        try:
+            self.assertTrue(bakthat.restore("tree", password="password"))
+        finally:
+            os.chdir(cwd)
+        for dirpath, dirnames, filenames in os.walk(self.tree):
+            restored = os.path.join(out, os.path.relpath(dirpath, self.root))
+            self.assertEqual(os.stat(restored).st_mode, os.stat(dirpath).st_mode)
+            for name in filenames:
+                with open(os.path.join(dirpath, name), "rb") as f1, open(os.path.join(restored, name), "rb") as f2:
+                    self.assertEqual(f1.read(), f2.read())
+        self.assertEqual(os.stat(os.path.join(out, "tree/d0/f0")).st_ino, os.stat(os.path.join(out, "tree/d1/link")).st_ino)
+
+        self.assertTrue(bakthat.delete("tree"))
+        self.assertEqual(backend.ls(), [])
+
+        # The RNG already used by the parent is reseeded in the workers
+        EncryptWriter(tempfile.TemporaryFile(), "password").close()
+        bakthat.backup(self.tree, password="password", prompt="no", shards=3)
+        self.assertEqual(bakthat.verify("tree")["summary"], {"ok": 1})
+        self.assertTrue(bakthat.delete("tree"))
+
+        # Shards are queued when there are more shards than workers
+        backup_data = bakthat.backup(self.tree, password="", prompt="no", shards=3, workers=1)
+        self.assertEqual(sorted(backend.ls()), sorted(backup_data["shards"]))
+        self.assertEqual(bakthat.verify("tree")["summary"], {"ok": 1})
+        self.assertTrue(bakthat.delete("tree"))
+
+        # Uploaded shards are deleted if a shard fails
+        backend.fail = "shard0002"
+        self.assertRaises(Exception, bakthat.backup, self.tree, password="", prompt="no", shards=3)
+        self.assertEqual(backend.ls(), [])
+
+
+class BakthatStreamBackupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        use_temp_state(self)
+        self.root = tempfile.mkdtemp()
+        self.data = os.urandom(200000) + "Bakthat Test File\n" * 10000
+        self.path = os.path.join(self.root, "dump.sql")
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+        os.mkdir(os.path.join(self.root, "store"))
+        self.backend = DirectoryBackend(os.path.join(self.root, "store"))
+        self._get_store_backend = bakthat._get_store_backend
+        bakthat._get_store_backend = lambda conf, destination=None: self.backend
+
+    def tearDown(self):
+        import shutil
+        bakthat._get_store_backend = self._get_store_backend
+        shutil.rmtree(self.root)
+
+    def test_command_backup(self):
+        backup_data = bakthat.backup(command="cat {0}".format(self.path), name="db", password="password",
+                                     prompt="no")
+        self.assertTrue(backup_data["stored_filename"].endswith(".gz.enc"))
+        self.assertEqual(self.backend.ls(), [backup_data["stored_filename"]])
+        self.assertEqual(bakthat.match_filename("db")[0]["ext"], "gz")
+
+        out = os.path.join(self.root, "out")
+        self.assertTrue(bakthat.restore("db", password="password", target=out))
+        with open(os.path.join(out, "db"), "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+        stdout = sys.stdout
+        sys.stdout = tempfile.TemporaryFile()
+        try:
+            self.assertTrue(bakthat.restore("db", password="password", stdout=True))
+            sys.stdout.seek(0)
+            self.assertEqual(sys.stdout.read(), self.data)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        # A command failing after writing its output leaves no backup.
+        self.assertTrue(bakthat.delete("db"))
+        with self.assertRaises(Exception) as ar:
+            bakthat.backup(command="cat {0}; exit 3".format(self.path), name="db", password="", prompt="no")
+        self.assertTrue("exit code 3" in str(ar.exception))
+        self.assertEqual(self.backend.ls(), [])
+
+    def test_fileobj_backup(self):
+        with open(self.path, "rb") as f:
+            bakthat.backup(fileobj=f, name="dump", password="", prompt="no")
+
+        out = os.path.join(self.root, "out")
+        self.assertTrue(bakthat.restore("dump", target=out))
+        with open(os.path.join(out, "dump"), "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+        # Stream backups need a name.
+        with open(self.path, "rb") as f:
+            self.assertRaises(Exception, bakthat.backup, fileobj=f, password="", prompt="no")
+
+    def test_cached_restore(self):
+        cache_dir = os.path.join(self.root, "cache")
+        config.add_section("cache")
+        config.set("cache", "max_size", "10")
+        config.set("cache", "path", cache_dir)
+        self.addCleanup(config.remove_section, "cache")
+
+        stored_filename = bakthat.backup(fileobj=open(self.path, "rb"), name="dump", password="",
+                                         prompt="no")["stored_filename"]
+        # The restore reads the cached copy, checked as it's read.
+        with open(os.path.join(self.backend.path, stored_filename), "r+b") as f:
+            f.write("corrupted")
+        out = os.path.join(self.root, "out")
+        self.assertTrue(bakthat.restore("dump", target=out))
+        with open(os.path.join(out, "dump"), "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+        cached = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)]
+        self.assertEqual(len(cached), 1)
+        with open(cached[0], "r+b") as f:
+            f.seek(1000)
+            f.write("corrupted")
+        self.assertRaises(IOError, bakthat.restore, "dump", target=os.path.join(self.root, "out2"))
+        self.assertEqual(os.listdir(cache_dir), [])
+
+
+class BakthatDeltaBackupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        use_temp_state(self)
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, "vm.img")
+        os.mkdir(os.path.join(self.root, "store"))
+        self.backend = DirectoryBackend(os.path.join(self.root, "store"))
+        self._get_store_backend = bakthat._get_store_backend
+        bakthat._get_store_backend = lambda conf, destination=None: self.backend
+
+        # One backup per second at most (the date is part of the key).
+        now = [datetime(2013, 1, 1)]
+
+        class FakeDatetime(datetime):
+            @classmethod
+            def utcnow(cls):
+                now[0] += timedelta(seconds=1)
+                return now[0]
+        self._datetime = bakthat.datetime
+        bakthat.datetime = FakeDatetime
+
+    def tearDown(self):
+        import shutil
+        bakthat._get_store_backend = self._get_store_backend
+        bakthat.datetime = self._datetime
+        shutil.rmtree(self.root)
+
+    def test_delta_chain(self):
+        versions = [os.urandom(300000)]
+        for i in range(3):
+            data = bytearray(versions[-1])
+            data[i * 70000:i * 70000 + 100] = os.urandom(100)
+            versions.append(str(data) + os.urandom(1000))
+
+        keys = []
+        for data in versions:
+            with open(self.path, "wb") as f:
+                f.write(data)
+            keys.append(bakthat.backup(self.path, password="password", prompt="no", delta=True,
+                                       max_chain=2)["stored_filename"])
+            # The signature of the uploaded version is recorded without reading the file again.
+            with open(self.path, "rb") as f:
+                signature = Signature.compute(f, 64 * 1024)
+            self.assertEqual(load_delta_state(self.backend.container, "vm.img")["signature"].strong,
+                             signature.strong)
+
+        # A full backup, two deltas, then a full backup again (max_chain).
+        self.assertEqual([key.split(".")[-2] for key in keys], ["tgz", "delta", "delta", "tgz"])
+
+        for key, data in zip(keys, versions):
+            out = os.path.join(self.root, "out", key)
+            self.assertTrue(bakthat.restore(key, password="password", target=out))
+            with open(os.path.join(out, "vm.img"), "rb") as f:
+                self.assertEqual(f.read(), data)
+
+
+class BakthatStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(100000)
+
+    def test_decrypt_reader(self):
+        from beefish import encrypt
+        from StringIO import StringIO
+
+        for size in (0, 7, 8, 4096, len(self.data)):
+            encrypted = StringIO()
+            encrypt(StringIO(self.data[:size]), encrypted, "password")
+            encrypted.seek(0)
+
+            decrypted = DecryptReader(encrypted, "password")
+            self.assertEqual(decrypted.read(3) + decrypted.read(), self.data[:size])
+
+    def test_encrypt_writer(self):
+        from beefish import decrypt
+        from StringIO import StringIO
+
+        for size in (0, 7, 8, 4096, len(self.data)):
+            encrypted = StringIO()
+            encrypted.close = lambda: None
+            writer = EncryptWriter(encrypted, "password")
+            writer.write(self.data[:size / 2])
+            writer.write(self.data[size / 2:size])
+            writer.close()
+
+            encrypted.seek(0)
+            decrypted = StringIO()
+            decrypt(encrypted, decrypted, "password")
+            self.assertEqual(decrypted.getvalue(), self.data[:size])
+
+    def test_chain_reader(self):
+        from StringIO import StringIO
+
+        chunks = [self.data[:50000], self.data[50000:50001], "", self.data[50001:]]
+        chain = ChainReader([StringIO(chunk) for chunk in chunks])
+        parts = []
+        for size in (0, 10, 49990, 7, 1, -1, 10):
+            parts.append(chain.read(size))
+        self.assertEqual([len(part) for part in parts], [0, 10, 49990, 7, 1, 49992, 0])
+        self.assertEqual("".join(parts), self.data)
+
+    def test_glacier_upload_writer(self):
+        from boto.glacier.utils import tree_hash_from_str
+
+        class FakeLayer1(object):
+            def __init__(self):
+                self.parts = {}
+
+            def initiate_multipart_upload(self, vault_name, part_size, description):
+                self.part_size = part_size
+                return {"UploadId": "upload"}
+
+            def upload_part(self, vault_name, upload_id, linear_hash, tree_hash, byte_range, data):
+                assert tree_hash == tree_hash_from_str(data)
+                assert byte_range[0] % self.part_size == 0 and len(data) <= self.part_size
+                self.parts[byte_range[0]] = data
+
+            def abort_multipart_upload(self, vault_name, upload_id):
+                self.parts = {}
+
+            def complete_multipart_upload(self, vault_name, upload_id, tree_hash, size):
+                data = "".join(self.parts[k] for k in sorted(self.parts))
+                assert size == len(data)
+                return {"ArchiveId": tree_hash}
+
+        class FakeVault(object):
+            name = "vault"
+            layer1 = FakeLayer1()
+
+        class SmallPartsWriter(GlacierUploadWriter):
+            DEFAULT_PART_SIZE = MEGABYTE
+            MAX_PARTS = 3
+
+        data = self.data * 30
+        writer = SmallPartsWriter(FakeVault(), "test", size_hint=len(data))
+        for i in range(0, len(data), 12345):
+            writer.write(data[i:i + 12345])
+
+        self.assertEqual(writer.close(), tree_hash_from_str(data))
+        self.assertEqual(len(FakeVault.layer1.parts), 3)
+
+        # Fails as soon as the archive doesn't fit in MAX_PARTS parts.
+        writer = SmallPartsWriter(FakeVault(), "test", size_hint=len(data))
+        self.assertRaises(Exception, writer.write, data + data)
+        writer.abort()
+
+    def test_block_compressor(self):
+        import gzip
+        from StringIO import StringIO
+
+        text = "Bakthat Test File\n" * 20000
+        data = self.data + text + self.data
+
+        compressed = StringIO()
+        compressed.close = lambda: None
+        compressor = BlockCompressor(compressed, block_size=len(self.data))
+        for i in range(0, len(data), 10000):
+            compressor.write(data[i:i + 10000])
+        compressor.close()
+
+        # Random blocks are stored, the text is compressed.
+        self.assertEqual(sorted(compressor.stats), [0, 6])
+        self.assertTrue(len(compressed.getvalue()) < len(data) - len(text) / 2)
+
+        compressed.seek(0)
+        self.assertEqual(GzipStreamReader(compressed, chunk_size=777).read(), data)
+
+        # A stream cut anywhere, even in the trailer of the last member, is an error.
+        for size in (0, 5, len(compressed.getvalue()) / 2, len(compressed.getvalue()) - 1):
+            reader = GzipStreamReader(StringIO(compressed.getvalue()[:size]))
+            self.assertRaises(IOError, reader.read)
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(compressed.getvalue())).read(), data)
+
+    def test_auto_level(self):
+        now = [0.0]
+        level = AutoLevel(window=2, clock=lambda: now[0])
+        text = "Bakthat Test File\n" * 1000
+
+        def run_window(compress_time, write_time):
+            for i in range(2):
+                self.assertEqual(level(text), level.level)
+                now[0] += 1
+                level.feedback(compress_time, write_time)
+
+        # CPU bound
+        run_window(0.9, 0.05)
+        run_window(0.9, 0.05)
+        self.assertEqual(level.level, 4)
+        # Balanced
+        run_window(0.4, 0.4)
+        self.assertEqual(level.level, 4)
+        # Upload bound
+        for i in range(10):
+            run_window(0.1, 0.8)
+        self.assertEqual(level.level, 9)
+        self.assertEqual(level.changes[:3], [(2, 5), (4, 4), (8, 5)])
+        # Incompressible blocks are still stored
+        self.assertEqual(level(self.data), 0)
+
+    def test_chunked_downloader(self):
+        fetch = lambda start, end: self.data[start:end + 1]
+        reader = ChunkedDownloader(fetch, len(self.data), chunk_size=4096, num_threads=3)
+
+        chain = ChainReader([reader, lambda: ChunkedDownloader(fetch, 10, chunk_size=3)])
+        self.assertEqual(chain.read(), self.data + self.data[:10])
+
+    def test_transfer_controller(self):
+        now = [0.0]
+        controller = TransferController(2, MEGABYTE, MEGABYTE, 8 * MEGABYTE, memory_limit=12 * MEGABYTE,
+                                        clock=lambda: now[0])
+
+        def window(seconds):
+            for i in range(controller.limit):
+                now[0] += seconds
+                controller.success(controller.part_size, seconds)
+
+        # Fast parts: additive increase, bigger parts
+        window(0.1)
+        self.assertEqual((controller.limit, controller.part_size), (3, 2 * MEGABYTE))
+        # Bounded by the memory limit
+        for i in range(3):
+            window(0.1)
+            self.assertTrue(controller.limit * controller.part_size <= 12 * MEGABYTE)
+        self.assertEqual((controller.limit, controller.part_size), (3, 4 * MEGABYTE))
+        # Slow parts: smaller parts
+        window(40)
+        self.assertEqual(controller.part_size, 2 * MEGABYTE)
+
+        # Multiplicative decrease, once per window
+        limit = controller.limit
+        controller.error()
+        controller.error()
+        self.assertEqual(controller.limit, limit // 2)
+
+        # Adaptive chunks are aligned on their size
+        ranges = []
+
+        def fetch(start, end):
+            ranges.append((start, end))
+            return self.data[start:end + 1]
+        controller = TransferController(2, 1024, 1024, 16384)
+        self.assertEqual(ChunkedDownloader(fetch, len(self.data), controller=controller).read(), self.data)
+        self.assertTrue(all(start % (end - start + 1) == 0 for start, end in ranges[:-1]))
+        self.assertTrue(controller.part_size > 1024)
+
+        # Parts bigger than the controller part size are bounded by the memory limit too.
+        class Writer(ConcurrentPartWriter):
+            parts = {}
+            max_reserved = 0
+
+            def _upload_part(self, index, data):
+                Writer.max_reserved = max(Writer.max_reserved, self.controller.reserved)
+                time.sleep(0.01)
+                self.parts[index] = data
+
+            def _complete(self):
+                return "".join(self.parts[index] for index in sorted(self.parts))
+
+        controller = TransferController(4, 1024, memory_limit=5000)
+        writer = Writer(2048, controller=controller)
+        writer.write(self.data[:50000])
+        self.assertEqual(writer.close(), self.data[:50000])
+        self.assertTrue(2048 <= Writer.max_reserved <= 5000)
+        self.assertEqual(controller.reserved, 0)
+
+    def test_token_bucket(self):
+        # The burst is served at once, then the debt is paid back at 10MB/s.
+        bucket = TokenBucket(10 * MEGABYTE, preempt=False)
+        start = time.time()
+        for nbytes in (10 * MEGABYTE, 2 * MEGABYTE, 1):
+            bucket.consume(nbytes)
+        self.assertTrue(0.15 < time.time() - start < 1)
+
+        # Backups wait while a restore is active.
+        bucket = TokenBucket(idle=0.3)
+        bucket.consume(MEGABYTE, BACKUP)
+        bucket.consume(MEGABYTE, RESTORE)
+        start = time.time()
+        bucket.consume(MEGABYTE, RESTORE)
+        self.assertTrue(time.time() - start < 0.1)
+        bucket.consume(MEGABYTE, BACKUP)
+        self.assertTrue(0.25 < time.time() - start < 1)
+
+    def test_delta(self):
+        from StringIO import StringIO
+
+        base = tempfile.NamedTemporaryFile()
+        base.write(self.data)
+        base.flush()
+        base.seek(0)
+        signature = Signature.compute(base, 4096)
+        self.assertEqual(Signature.loads(signature.dumps()).strong, signature.strong)
+
+        # A change in place and an insertion shifting the rest of the file.
+        data = self.data[:1000] + "changed" + self.data[1007:50000] + "inserted" + self.data[50000:]
+        new = tempfile.NamedTemporaryFile()
+        new.write(data)
+        new.flush()
+
+        delta = StringIO()
+        new_signature = SignatureWriter(1024)
+        disk_reads = record_disk_reads(self)
+        stats = write_delta(open(new.name, "rb"), signature, ["full.tgz", "delta1"], delta, new_signature)
+        # The mmapped file is throttled like the other disk reads.
+        self.assertEqual(sum(disk_reads), len(data))
+        self.assertTrue(stats["literal"] < 3 * 4096)
+        # The signature of the new version is computed in the same pass.
+        self.assertEqual(new_signature.signature.strong, Signature.compute(open(new.name, "rb"), 1024).strong)
+        self.assertTrue(len(delta.getvalue()) < 4 * 4096)
+
+        delta.seek(0)
+        block_size, size, chain = read_header(delta)
+        self.assertEqual((block_size, size, chain), (4096, len(data), ["full.tgz", "delta1"]))
+        restored = StringIO()
+        apply_delta(base, delta, restored, block_size, size)
+        self.assertEqual(restored.getvalue(), data)
+
+    def test_volume_writer(self):
+        from StringIO import StringIO
+
+        volumes = {}
+
+        class FakeWriter(StringIO):
+            def __init__(self, index):
+                StringIO.__init__(self)
+                self.index = index
+
+            def close(self):
+                volumes[self.index] = self.getvalue()
+
+        writer = VolumeWriter(FakeWriter, 10000, delete_volume=volumes.pop)
+        for i in range(0, len(self.data), 3333):
+            writer.write(self.data[i:i + 3333])
+        writer.close()
+
+        self.assertEqual(writer.num_volumes, (len(self.data) + 9999) // 10000)
+        self.assertEqual(writer.size, len(self.data))
+        self.assertEqual("".join(volumes[i] for i in sorted(volumes)), self.data)
+        self.assertTrue(all(len(volumes[i]) == 10000 for i in range(writer.num_volumes - 1)))
+
+        writer.abort()
+        self.assertEqual(volumes, {})
+
+    def test_tee_writer(self):
+        from StringIO import StringIO
+
+        class FailingWriter(StringIO):
+            aborted = False
+
+            def write(self, data):
+                if self.len > 50000:
+                    raise IOError("Connection reset")
+                StringIO.write(self, data)
+
+            def abort(self):
+                self.aborted = True
+
+        class Writer(StringIO):
+            size = property(lambda self: self.len)
+
+            def close(self):
+                self.data = self.getvalue()
+
+        ok, failing = Writer(), FailingWriter()
+        tee = TeeWriter([("s3", ok), ("glacier", failing)], max_pending=2)
+        for i in range(0, len(self.data), 1000):
+            tee.write(self.data[i:i + 1000])
+        results = tee.close()
+
+        self.assertEqual(ok.data, self.data)
+        self.assertEqual(results["s3"], dict(size=len(self.data)))
+        self.assertEqual(results["glacier"], dict(error="Connection reset"))
+        self.assertTrue(failing.aborted)
+
+        tee = TeeWriter([("glacier", FailingWriter())])
+        tee.write(self.data)
+        tee.write(self.data)
+        self.assertRaises(IOError, tee.close)
+
+
+class FakeBucket(object):
+    """In-memory boto bucket, only handles what server-side copies need."""
+    name = "fake"
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.multipart_parts = []
+        self.lifecycle = []
+        # Keys failing multi-object delete requests
+        self.fail = set()
+
+    def get_key(self, name):
+        if name not in self.keys:
+            return None
+
+        class Key(object):
+            pass
+        k = Key()
+        k.name, k.size, k.storage_class, k.ongoing_restore = name, len(self.keys[name]), "STANDARD", None
+        k.get_contents_as_string = lambda: self.keys[name]
+        return k
+
+    def list(self, prefix=""):
+        return [self.get_key(name) for name in sorted(self.keys) if name.startswith(prefix)]
+
+    def delete_keys(self, names, quiet=False):
+        class Error(object):
+            def __init__(self, key):
+                self.key, self.message = key, "AccessDenied"
+
+        class Result(object):
+            errors = [Error(name) for name in names if name in self.fail]
+        for name in names:
+            if name not in self.fail:
+                self.keys.pop(name, None)
+        return Result()
+
+    def get_lifecycle_config(self):
+        return self.lifecycle
+
+    def configure_lifecycle(self, lifecycle):
+        self.lifecycle = lifecycle
+
+    def copy_key(self, new_key_name, src_bucket_name, src_key_name, storage_class="STANDARD"):
+        self.keys[new_key_name] = self.keys[src_key_name]
+
+    def initiate_multipart_upload(self, key_name, headers=None):
+        bucket, parts = self, {}
+
+        class MultiPartUpload(object):
+            def copy_part_from_key(self, src_bucket_name, src_key_name, part_num, start, end):
+                parts[part_num] = bucket.keys[src_key_name][start:end + 1]
+
+            def upload_part_from_file(self, fp, part_num):
+                parts[part_num] = fp.read()
+
+            def complete_upload(self):
+                bucket.multipart_parts.append(len(parts))
+                bucket.keys[key_name] = "".join(parts[i] for i in sorted(parts))
+
+            def cancel_upload(self):
+                pass
+        return MultiPartUpload()
+
+
+class BakthatS3TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.bucket = FakeBucket({"www.20121016120000.tgz": "x" * 1000, "other": "y"})
+        conf = dict(access_key="", secret_key="", region_name=DEFAULT_LOCATION, s3_bucket="fake")
+        self.source = S3Backend(conf)
+        self.target = S3Backend(dict(conf, s3_prefix="longterm/"))
+        self.source._bucket = self.target._bucket = self.bucket
+
+    def test_copy(self):
+        self.source.copy("www.20121016120000.tgz", self.target)
+        self.assertEqual(self.bucket.keys["longterm/www.20121016120000.tgz"], "x" * 1000)
+        self.assertEqual(self.target.ls(), ["www.20121016120000.tgz"])
+        self.assertEqual(self.target.storage_class("www.20121016120000.tgz"), "STANDARD")
+
+        self.source.max_single_copy_size = self.source.copy_part_size = 300
+        self.target.prefix = "archive/"
+        self.source.copy("www.20121016120000.tgz", self.target)
+        self.assertEqual(self.bucket.multipart_parts, [4])
+        self.assertEqual(self.bucket.keys["archive/www.20121016120000.tgz"], "x" * 1000)
+
+    def test_delete_many_failure(self):
+        use_temp_state(self)
+        self.addCleanup(setattr, bakthat, "_get_store_backend", bakthat._get_store_backend)
+        bakthat._get_store_backend = lambda conf, destination=None: self.source
+        self.bucket.keys["www.20121015120000.tgz"] = "z" * 1000
+        for key in ("www.20121015120000.tgz", "www.20121016120000.tgz"):
+            save_checksums(self.source.container, key, {"size": 1000})
+
+        self.bucket.fail.add("www.20121015120000.tgz")
+        self.assertRaises(Exception, bakthat.delete_older_than, "www", "1D")
+        self.assertEqual(sorted(self.bucket.keys), ["other", "www.20121015120000.tgz"])
+        # The checksums of the backup that still exists are kept
+        self.assertEqual(load_checksums(self.source.container, "www.20121015120000.tgz"), {"size": 1000})
+
+    def test_lifecycle(self):
+        self.assertRaises(Exception, self.source.configure_lifecycle, glacier_days=30)
+        self.assertEqual(self.bucket.lifecycle, [])
+        lifecycle = self.target.configure_lifecycle(glacier_days=30)
+        self.assertEqual([(rule.id, rule.prefix) for rule in lifecycle], [("bakthat-longterm/", "longterm/")])
+
+    def test_inventory_backup(self):
+        conf = dict(access_key="", secret_key="", region_name=DEFAULT_LOCATION, s3_bucket="fake-inventory",
+                    glacier_vault="vault")
+        self.addCleanup(clear_backend_cache)
+        get_backend(S3Backend, conf)._bucket = self.bucket
+        glacier_backend = GlacierBackend(conf)
+
+        # A missing inventory backup isn't an empty inventory
+        self.assertRaises(Exception, glacier_backend.load_archives_from_s3)
+        self.bucket.keys[glacier_backend.backup_key] = '{"www.20121016120000.tgz": "archive_id"}'
+        self.assertEqual(glacier_backend.load_archives_from_s3(), {"www.20121016120000.tgz": "archive_id"})
+
+    def test_stream_writer(self):
+        class Writer(S3MultipartWriter):
+            MIN_PART_SIZE = 100
+            PARTS_PER_STEP = 2
+
+        writer = Writer(self.bucket, "db.20121016120000.gz")
+        for i in range(100):
+            writer.write(str(i % 10) * 10)
+        writer.close()
+        self.assertEqual(writer.size, 1000)
+        # 100, 100 then 200, 200 then 400 bytes parts
+        self.assertEqual(self.bucket.multipart_parts, [5])
+        self.assertEqual(self.bucket.keys["db.20121016120000.gz"], "".join(str(i % 10) * 10 for i in range(100)))
+
+        key = bakthat._parse_key("db.20121016120000.gz.enc")
+        self.assertEqual((key["filename"], key["is_enc"], key["ext"]), ("db", True, "gz"))
+        self.assertEqual(bakthat._parse_key("db.20121016120000.tgz")["ext"], "tgz")
+
+
+class BakthatTasksTestCase(unittest.TestCase):
+
+    def test_task_pool(self):
+        pool = TaskPool(max_workers=4)
+        started = threading.Event()
+
+        def work(value, cancel=None):
+            if value is None:
+                started.set()
+                while not cancel.is_set():
+                    time.sleep(0.01)
+                raise Cancelled()
+            return value * 2
+
+        blocked = pool.submit(work, None)
+        tasks = [pool.submit(work, i) for i in range(10)]
+        self.assertEqual([task.result(5) for task in wait(tasks)], [i * 2 for i in range(10)])
+
+        done = []
+        blocked.add_done_callback(done.append)
+        started.wait(5)
+        self.assertTrue(blocked.cancel())
+        self.assertRaises(Cancelled, blocked.result, 5)
+        self.assertTrue(blocked.cancelled())
+        self.assertEqual(done, [blocked])
+        self.assertTrue(len(pool._threads) <= 4)
+        pool.shutdown()
+
+    def test_cancellable_writer(self):
+        from StringIO import StringIO
+
+        class Writer(StringIO):
+            aborted = False
+
+            def abort(self):
+                self.aborted = True
+
+        cancel = threading.Event()
+        writer = CancellableWriter(Writer(), cancel)
+        writer.write("data")
+        cancel.set()
+        self.assertRaises(Cancelled, writer.write, "data")
+        writer.abort()
+        self.assertTrue(writer.fileobj.aborted)
+        self.assertEqual(writer.fileobj.getvalue(), "data")
+
+
+class BakthatWatchTestCase(unittest.TestCase):
+
+    def test_debouncer(self):
+        now = [0]
+        debouncer = Debouncer(delay=10, max_delay=30, clock=lambda: now[0])
+        debouncer.trigger("a")
+        now[0] = 5
+        debouncer.trigger("a")
+        self.assertEqual(debouncer.due(), [])
+
+        # b never stops changing
+        for now[0] in range(10, 45, 5):
+            debouncer.trigger("b")
+            if now[0] == 15:
+                self.assertEqual(debouncer.due(), ["a"])
+            elif now[0] < 40:
+                self.assertEqual(debouncer.due(), [])
+        self.assertEqual(debouncer.due(), ["b"])
+        self.assertEqual(debouncer.pending(), [])
+
+    def test_watcher(self):
+        root = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(root, "www"))
+            os.makedirs(os.path.join(root, "db"))
+            backups = []
+            backed_up = threading.Event()
+
+            def backup(path):
+                backups.append(os.path.basename(path))
+                backed_up.set()
+
+            paths = [os.path.join(root, "www"), os.path.join(root, "db")]
+            watcher = Watcher(paths, backup, delay=0,
+                              observer=PollingObserver(paths, lambda path: watcher.debouncer.trigger(path)))
+            watcher.observer.check()
+            open(os.path.join(root, "www", "index.html"), "w").write("hello")
+            watcher.observer.check()
+
+            tasks = watcher.tick()
+            self.assertEqual(len(tasks), 1)
+            wait(tasks)
+            self.assertEqual(backups, ["www"])
+            self.assertEqual(watcher.tick(), [])
+            watcher.pool.shutdown()
+        finally:
+            import shutil
+            shutil.rmtree(root)
+
+
+class BakthatIntegrityTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from StringIO import StringIO
+
+        use_temp_state(self)
+        self.data = os.urandom(2500)
+        store = self.store = {}
+
+        class Backend(object):
+            container = "bakthat-test-integrity"
+
+            def size(self, keyname):
+                return len(store[keyname]) if keyname in store else None
+
+            def read_range(self, keyname, start, end):
+                return store[keyname][start:end + 1]
+
+            def download(self, keyname):
+                return StringIO(store[keyname])
+
+        class Sink(StringIO):
+            def close(self):
+                store["www.20121016120000.tgz"] = self.getvalue()
+
+        hasher = BlockHasher(Sink(), block_size=1000)
+        for i in range(0, len(self.data), 700):
+            hasher.write(self.data[i:i + 700])
+        hasher.close()
+        self.checksums = hasher.checksums
+        self.backend = Backend()
+        self.backup = dict(key="www.20121016120000.tgz", is_enc=False)
+        save_checksums(self.backend.container, self.backup["key"], self.checksums)
+
+    def test_verify_backup(self):
+        self.assertEqual(len(self.checksums["blocks"]), 3)
+        self.assertEqual(self.checksums["sha256"], hashlib.sha256(self.data).hexdigest())
+
+        for mode in ("quick", "spot", "full"):
+            self.assertEqual(verify_backup(self.backend, self.backup, mode)["status"], "ok")
+
+        self.store[self.backup["key"]] = self.data[:1500] + "x" + self.data[1501:]
+        self.assertEqual(verify_backup(self.backend, self.backup, "quick")["status"], "ok")
+        self.assertEqual(verify_backup(self.backend, self.backup, "full")["status"], "corrupted")
+
+        self.store[self.backup["key"]] = self.data[:-1]
+        self.assertEqual(verify_backup(self.backend, self.backup, "quick")["status"], "corrupted")
+        del self.store[self.backup["key"]]
+        self.assertEqual(verify_backup(self.backend, self.backup, "spot")["status"], "missing")
+
+    def test_verify_without_checksums(self):
+        import tarfile
+        from StringIO import StringIO
+
+        buf = StringIO()
+        with closing(tarfile.open(fileobj=buf, mode="w:gz")) as tar:
+            tarinfo = tarfile.TarInfo("data")
+            tarinfo.size = len(self.data)
+            tar.addfile(tarinfo, StringIO(self.data))
+        backup = dict(key="legacy.20121016120000.tgz", is_enc=False)
+        self.store[backup["key"]] = buf.getvalue()
+        self.assertEqual(verify_backup(self.backend, backup, "full")["status"], "ok")
+
+        # Cut in the gzip trailer, the tar archive itself is complete.
+        self.store[backup["key"]] = buf.getvalue()[:-4]
+        self.assertEqual(verify_backup(self.backend, backup, "full")["status"], "corrupted")
+
+
+class BakthatCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = BackupCache(self.root, max_size=250000)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.root)
+
+    def _store(self, keyname, data, container="vault"):
+        from StringIO import StringIO
+
+        hasher = BlockHasher(StringIO(), block_size=4096)
+        entry = self.cache.entry(container, keyname)
+        writer = CachingWriter(hasher, entry)
+        writer.write(data)
+        writer.close()
+        return hasher.checksums
+
+    def test_cache(self):
+        from StringIO import StringIO
+
+        data = os.urandom(100000)
+        checksums = self._store("a.tgz", data)
+        disk_reads = record_disk_reads(self)
+        self.assertEqual(self.cache.open("vault", "a.tgz", checksums).read(), data)
+        self.assertEqual(sum(disk_reads), len(data))
+        # Never read without checksums
+        self.assertEqual(self.cache.open("vault", "a.tgz", None), None)
+        # Entries are per destination
+        self.assertEqual(self.cache.open("other", "a.tgz", checksums), None)
+
+        # Corrupted entries are detected as they're read, and discarded
+        path = self.cache.entries()[0][2]
+        with open(path, "r+b") as f:
+            f.write("corrupted")
+        cached = self.cache.open("vault", "a.tgz", checksums)
+        self.assertEqual(len(cached.read(len(data))), len(data))
+        self.assertRaises(IOError, cached.read, 1)
+        self.assertEqual(self.cache.entries(), [])
+
+        # Also when the reader stops before the end
+        self._store("a.tgz", data)
+        with open(path, "r+b") as f:
+            f.write("corrupted")
+        cached = self.cache.open("vault", "a.tgz", checksums)
+        cached.read(1000)
+        self.assertRaises(IOError, cached.close)
+        self.assertEqual(self.cache.entries(), [])
+
+        # Downloads are cached once read entirely
+        reader = self.cache.reader(StringIO(data), "vault", "a.tgz", len(data))
+        reader.read(len(data) - 100)
+        reader.close()
+        cached = self.cache.open("vault", "a.tgz", checksums)
+        self.assertEqual(cached.read(), data)
+        cached.close()
+
+        # Least recently used entries are evicted
+        os.utime(path, (0, 0))
+        self._store("b.tgz", os.urandom(100000))
+        self._store("c.tgz", os.urandom(100000))
+        self.assertEqual(self.cache.open("vault", "a.tgz", checksums), None)
+        self.assertEqual(len(self.cache.entries()), 2)
+
+        # Bigger than the cache
+        self.assertEqual(self.cache.entry("vault", "d.tgz", size_hint=300000), None)
+
+
+def _write_state(args):
+    path, worker = args
+    state = LocalState(path, legacy_path=None)
+    for i in range(50):
+        state.set_many([("archives", "{0}-{1}".format(worker, i), "id"), ("sizes", "{0}-{1}".format(worker, i), i)])
+    state.close()
+
+
+class BakthatStateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, "state.sqlite")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.root)
+
+    def test_concurrent_processes(self):
+        import multiprocessing
+
+        pool = multiprocessing.Pool(4)
+        pool.map(_write_state, [(self.path, worker) for worker in range(4)])
+        pool.close()
+        pool.join()
+
+        state = LocalState(self.path, legacy_path=None)
+        self.assertEqual(len(state.all("archives")), 200)
+        self.assertEqual(state.get("sizes", "3-49"), 49)
+        state.delete("archives", ["3-49"])
+        self.assertEqual(state.get("archives", "3-49"), None)
+
+    def test_legacy_shelve(self):
+        import shelve
+
+        legacy_path = os.path.join(self.root, "legacy.db")
+        legacy = shelve.open(legacy_path)
+        legacy["archives"] = {"www.20121016120000.tgz": "archive_id"}
+        legacy["jobs"] = {"www.20121016120000.tgz": "job_id"}
+        legacy["checksums:vault:www.20121016120000.tgz"] = {"blocks": ["\xff" * 32]}
+        legacy.close()
+
+        state = LocalState(self.path, legacy_path=legacy_path)
+        self.assertEqual(state.all("archives"), {"www.20121016120000.tgz": "archive_id"})
+        self.assertEqual(state.get("jobs", "www.20121016120000.tgz"), "job_id")
+        self.assertEqual(state.get("checksums", "vault:www.20121016120000.tgz"), {"blocks": ["\xff" * 32]})
+
+        # Only imported once
+        state.delete("archives", ["www.20121016120000.tgz"])
+        state.close()
+        self.assertEqual(LocalState(self.path, legacy_path=legacy_path).all("archives"), {})
+
+
+    def test_glacier_delete_many_failure(self):
+        class FakeVault(object):
+            deleted = []
+
+            def delete_archive(self, archive_id):
+                if archive_id == "id-b":
+                    raise IOError("delete failed")
+                self.deleted.append(archive_id)
+
+        use_temp_state(self)
+        get_state().update("archives", {"a": "id-a", "b": "id-b", "c": "id-c"})
+        backend = GlacierBackend.__new__(GlacierBackend)
+        backend._vault = FakeVault()
+        backend.backup_inventory = lambda: None
+
+        self.assertRaises(IOError, backend.delete_many, ["a", "b", "c"])
+        self.assertEqual(FakeVault.deleted, ["id-a"])
+        self.assertEqual(sorted(backend.ls()), ["b", "c"])
+
+
+class BakthatImportTestCase(unittest.TestCase):
+    # Seconds, bakthat is invoked from cron/monitoring scripts many times a day.
+    IMPORT_TIME_BUDGET = 0.5
+    HEAVY_MODULES = ["boto", "beefish", "Crypto", "grandfatherson", "mimetypes"]
+
+    def test_lazy_import(self):
+        script = "; ".join(["import sys, time",
+                            "start = time.time()",
+                            "import bakthat",
+                            "elapsed = time.time() - start",
+                            "from bakthat.conf import config",
+                            "heavy = [m for m in {0!r} if m in sys.modules]".format(self.HEAVY_MODULES),
+                            "print heavy, config.loaded, elapsed"])
+        output = subprocess.check_output([sys.executable, "-c", script],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        heavy, config_loaded, elapsed = output.strip().rsplit(" ", 2)
+
+        self.assertEqual(heavy, "[]")
+        self.assertEqual(config_loaded, "False")
+        self.assertTrue(float(elapsed) < self.IMPORT_TIME_BUDGET)
+
+
 if __name__ == '__main__':
     unittest.main()